@@ -11,12 +11,28 @@ import typing  # for type hints
 from typing import Callable, Any
 import pathlib
 from .safetimestring import datetime_to_safestring, safestring_to_datetime, timefolders
+from .storage import RotationEngine, resolve_storage_profile
+from .catalog import Catalog
+from .connections import BrokerConnection, broker_key
+from .rollup import resolve_rollups
+from .metrics import MetricsServer, StreamMetrics
+from .state import PROCESSING_SAMPLE_MASK, StreamState
+from .writer import BatchWriter
+from .spool import SPOOL_FILE_NAME, SpoolWriter
+from .shards import ShardedRotation, ShardedWriter, ShardState, shard_folder_name
+from .processes import ProcessSupervisor
+from .asyncio_engine import AsyncioEngine
 import json
+import sys
+import importlib
 
 from paho.mqtt import client as mqtt
 
 stdout = print
 
+# how the streams are run, see `engine` in the configuration file
+ENGINES = ('threads', 'processes', 'asyncio')
+
 # The work function generator, to create the function that will be called "on message" #
 ########################################################################################
 
@@ -24,136 +40,158 @@ def make_on_message_callback(
         q_stream_idx: int,
         intended_topic: str,
         q_stream_path: str = "",
-        log_rotation_time: int = 600):
+        log_rotation_time: int = 600,
+        rotation_prepare_lead: float = 5.0,
+        rotation_max_rows: typing.Optional[int] = None,
+        rotation_max_bytes: typing.Optional[int] = None,
+        rotation_align: bool = False,
+        rollups: typing.Optional[dict] = None,
+        schemas: typing.Optional[typing.Sequence[dict]] = None,
+        storage_profile: typing.Optional[dict] = None,
+        catalog: typing.Optional[Catalog] = None,
+        writer_thread: bool = False,
+        writer_queue_size: int = 100000,
+        writer_batch_size: int = 1000,
+        writer_batch_seconds: float = 1.0,
+        writer_factory: typing.Optional[Callable[..., Any]] = None,
+        rotation_executor=None,
+        spool: bool = False,
+        spool_size_bytes: int = 64 << 20,
+        spool_overflow: str = 'block',
+        spool_stop_seconds: float = 2.0,
+        shards: int = 1):
     global shared_state
 
-    # at this point, the SharedState['streams'][q_stream_idx]=dict() needs to be already there, created by the caller.
+    # at this point, the SharedState['streams'] list needs to be already there, created by the caller.
     # this is because this function cannot assume the order in which the threads will be created.
     debug_mode = True
     if debug_mode:
         stdout(f'{len(shared_state["streams"])=} {q_stream_idx=}')
-    shared_state['streams'][q_stream_idx] = dict(
-        messageCount=0,
-        intendedTopic=intended_topic,
-        lastMessage=None,
-        sqlite_cursor=None,
-        sqlite_connection=None,
-        next_rotation_time=0,
-        stop_request=False,
-        stop_request_ack=False,
-        process_start_time=0.0,
-        process_end_time=time.time(),  # todo: convert to datetime.datetime.now() format everywhere.
-        previous_end_time=0.0,
-        totalIdleTime=0.0,
-        totalProcessingTime=0.0,
-    )
-
-    # closure: captures locals, in particular the q_stream_idx, intendedTopic, q_stream_path, logRotationTime
+    # the rotation engine owns the log files of this stream: it prepares the next file ahead of time,
+    # and seals the old one in the background.
+    # latency histograms of this stream, see attic.metrics
+    metrics = StreamMetrics()
+    # when to rotate, besides every log_rotation_time: see storage.ROTATION_TRIGGERS
+    # (with an executor, the rotation jobs run in that thread pool, rather than in a thread per rotation engine)
+    rotation_policy = dict(max_rows=rotation_max_rows, max_bytes=rotation_max_bytes, align=rotation_align,
+                           executor=rotation_executor,
+                           rollups=rollups, schemas=schemas)
+    if shards > 1:
+        # sharded: one rotation engine, and one writer stage, per shard, each in its own folder; see attic.shards
+        writer_thread = True
+        stream_name = pathlib.Path(q_stream_path).name
+        rotations = [RotationEngine(os.path.join(q_stream_path, shard_folder_name(shard_idx)), log_rotation_time,
+                                    prepare_lead_seconds=rotation_prepare_lead, profile=storage_profile,
+                                    catalog=catalog, name=f'attic-rotation-{q_stream_idx}-{shard_idx}',
+                                    metrics=metrics, stream_name=stream_name, **rotation_policy)
+                     for shard_idx in range(shards)]
+        rotation = ShardedRotation(rotations)
+    else:
+        rotation = RotationEngine(q_stream_path, log_rotation_time, prepare_lead_seconds=rotation_prepare_lead,
+                                  profile=storage_profile, catalog=catalog, name=f'attic-rotation-{q_stream_idx}',
+                                  metrics=metrics, **rotation_policy)
+        rotations = [rotation]
+    # the closures below hold the state object directly; the monitor reads it with state.snapshot().
+    # see attic.state for the clock handling and the sampled processing time.
+    state = StreamState(q_stream_idx, intended_topic, rotation, metrics)
+    shared_state['streams'][q_stream_idx] = state
+    monotonic = time.monotonic
+    wall_clock = time.time
+
+    if spool and writer_factory is None:
+        # optional spool: the messages land in a memory-mapped file first, and a writer stage drains it into sqlite.
+        # one spool per shard, in the folder of its files. see attic.spool
+        writer_thread = True
+
+        def writer_factory(writer_state, writer_rotation, **kwargs):
+            return SpoolWriter(writer_state, writer_rotation,
+                               spool_path=os.path.join(writer_rotation.q_stream_path, SPOOL_FILE_NAME),
+                               spool_size_bytes=spool_size_bytes, overflow=spool_overflow,
+                               stop_seconds=spool_stop_seconds, **kwargs)
+
+    if writer_thread:
+        # optional writer stage: the mqtt network thread only time-stamps the message and hands it over,
+        # the disk work (executemany, commit, rotation) happens in a dedicated thread.
+        # (the asyncio engine brings its own writer, which writes from a thread pool instead,
+        # and the spool its own, which drains the spool instead of a queue)
+        writer_states = [state] if shards <= 1 else ShardState.group_of(state, shards)
+        writers = [(writer_factory or BatchWriter)(
+            writer_state,
+            writer_rotation,
+            queue_size=writer_queue_size,
+            batch_size=writer_batch_size,
+            batch_seconds=writer_batch_seconds,
+            name=f'attic-writer-{q_stream_idx}' if shards <= 1 else f'attic-writer-{q_stream_idx}-{shard_idx}',
+        ) for shard_idx, (writer_state, writer_rotation) in enumerate(zip(writer_states, rotations))]
+        writer = writers[0] if shards <= 1 else ShardedWriter(writers)
+        state.writer = writer
+        writer.start()
+        put = writer.put
+
+        def curried_on_message_queued(_1, _2, msg):
+            now = monotonic()
+            if state.stop_request:
+                return  # the writer is flushing and will acknowledge the stop request by itself.
+            timestamp_unix = int(1e6 * (now + state.clock_offset))  # microseconds since epoch
+            put(timestamp_unix, msg.topic, msg.payload)  # payload: bytes ! important. Do not decode.
+            state.sequence += 1
+            if state.sampled_end_time is not None:
+                state.sampled_idle_time += now - state.sampled_end_time
+                state.sampled_end_time = None
+            message_count = state.message_count
+            state.last_rx_timestamp_unix = timestamp_unix
+            state.message_count = message_count + 1
+            if not message_count & PROCESSING_SAMPLE_MASK:
+                end_time = monotonic()
+                state.clock_offset = wall_clock() - end_time
+                state.sampled_processing_time += end_time - now
+                state.sampled_end_time = end_time
+                metrics.processing_seconds.record(end_time - now)
+            state.sequence += 1
+
+        return curried_on_message_queued
+
+    # closure: captures locals, in particular the state, the rotation engine and the metrics of this stream
     def curried_on_message(_1, _2, msg):
-        global shared_state
-        shared_state['streams'][q_stream_idx]['process_previous_start_time'] = \
-            shared_state['streams'][q_stream_idx]['process_start_time']
-        shared_state['streams'][q_stream_idx]['process_start_time'] = time.time()
-        shared_state['streams'][q_stream_idx]['previous_end_time'] = shared_state['streams'][q_stream_idx][
-            'process_end_time']
-
-        # builds new database connection as needed.
-        def renew_database_link() -> typing.Tuple[sqlite3.Cursor, sqlite3.Connection]:
-            global shared_state
-            pathlib.Path(q_stream_path).mkdir(parents=True, exist_ok=True)
-            safedatestring = datetime_to_safestring(datetime.datetime.now(tz=pytz.UTC))
-            file_name = f'{safedatestring}.sqlite'
-            # prepare folder name
-            # folder per day should be sufficient for this application
-            full_folder_name = timefolders(q_stream_path, datetime.datetime.now(tz=pytz.UTC))
-            full_folder_name.mkdir(parents=True, exist_ok=True)
-            sqlite_db_path = full_folder_name.joinpath(file_name)
-            stdout(f'{q_stream_idx=} | topic={shared_state['configs'][q_stream_idx]['prefix']} |  creating new file {sqlite_db_path}')
-            sqlite_connection_r = sqlite3.connect(sqlite_db_path)
-            sqlite_cursor_r = sqlite_connection_r.cursor()
-            sqlite_cursor_r.execute(
-                'CREATE TABLE IF NOT EXISTS data (reception_timestamp INTEGER, topic TEXT, payload BLOB)')
-            # this is so that at read time, the data can be quickly filtered by topic.
-            sqlite_cursor_r.execute(
-                'CREATE INDEX IF NOT EXISTS topics ON data (topic)')
-            sqlite_connection_r.commit()
-            # save the cursor and connection to the shared state for use by interested parties.
-            shared_state['streams'][q_stream_idx]['sqlite_cursor'] = sqlite_cursor_r
-            shared_state['streams'][q_stream_idx]['sqlite_connection'] = sqlite_connection_r
-            # important: set the expiration time for the next rotation
-            next_rotation_time_r = time.time() + log_rotation_time
-            shared_state['streams'][q_stream_idx]['next_rotation_time'] = next_rotation_time_r
-            return sqlite_cursor_r, sqlite_connection_r
-
+        now = monotonic()
         try:
-            # the case of the cursor being None is a special case.
-            if shared_state['streams'][q_stream_idx]['sqlite_cursor'] is None:
-                # create the cursor and connection.
-                # this is because the object must be created and used in the same thread.
-                if not (shared_state['streams'][q_stream_idx]['stop_request']):
-                    sqlite_cursor, sqlite_connection = renew_database_link()
-                else:
-                    # except if the stop request has been issued, in which case, ignore the message and return.
-                    sqlite_cursor = None
-                    sqlite_connection = None
-                    shared_state['streams'][q_stream_idx]['stop_request_ack'] = True
-                    return  # early return (ignores message). Note that such implementation means that it may take forever to exit the program, as it can only exit when a message is received.
-            else:  # the cursor is not None, the typical happy case.
-                # load the cursor and connection from the shared state.
-                sqlite_cursor = shared_state['streams'][q_stream_idx]['sqlite_cursor']
-                sqlite_connection = shared_state['streams'][q_stream_idx]['sqlite_connection']
-
-                # if the stop request has been issued, make an effort to gracefully stop the database.
-                if shared_state['streams'][q_stream_idx]['stop_request']:
-                    sqlite_connection.commit()
-                    sqlite_cursor.close()
-                    sqlite_connection.close()
-                    shared_state['streams'][q_stream_idx]['sqlite_cursor'] = None
-                    shared_state['streams'][q_stream_idx]['sqlite_connection'] = None
-                    shared_state['streams'][q_stream_idx]['stop_request_ack'] = True
-                    return
-
-                # Regular operation. The music doesn't stop! Make an effort to save the data.
-                # but, first, check for rotation time
-                next_rotation_time = shared_state['streams'][q_stream_idx]['next_rotation_time']
-                if time.time() > next_rotation_time:
-                    # rotate the log
-                    print(f'{q_stream_idx=} rotating log...')
-                    sqlite_connection.commit()
-                    sqlite_cursor.close()
-                    sqlite_connection.close()
-                    shared_state['streams'][q_stream_idx]['sqlite_cursor'] = None
-                    shared_state['streams'][q_stream_idx]['sqlite_connection'] = None
-                    # re-open the log with next file name. This will give us a fresh database connection.
-                    sqlite_cursor, sqlite_connection = renew_database_link()
-            # at this point, we should have a good sqlite_cursor and sqlite_connection
+            # if the stop request has been issued, make an effort to gracefully stop the database.
+            if state.stop_request:
+                rotation.close()
+                state.stop_request_ack = True
+                return  # early return (ignores message). Note that such implementation means that it may take forever to exit the program, as it can only exit when a message is received.
+
+            # Regular operation. The music doesn't stop! Make an effort to save the data.
+            # the rotation engine swaps in the next, already prepared, file when the rotation time has passed.
+            timestamp = now + state.clock_offset
+            log_file = rotation.log_file_for(timestamp)
             # write the data to the database
-            topic = msg.topic
-            payload = msg.payload  # bytes ! important. Do not decode. Store the bytes as-is, as it may be e.g. an avro packet or other binary data.
-            timestamp_unix = int(1e6 * time.time())  # microseconds since epoch
-            timestamp_iso_string = datetime.datetime.now(tz=pytz.UTC).isoformat(timespec='microseconds')
-            shared_state['streams'][q_stream_idx]['lastRxTimestamp_unix'] = timestamp_unix
-            shared_state['streams'][q_stream_idx]['lastRxTimestamp_iso_string'] = timestamp_iso_string
-            if sqlite_cursor is not None:
-                sqlite_cursor.execute("INSERT INTO data VALUES (?, ?, ?)", (timestamp_unix, topic, payload))
-                # sqlite_connection.commit()  # no need to commit as this is done in the rotation code
-                # finally, internal performance monitoring.
-                shared_state['totalMessageCount'] += 1
-                shared_state['streams'][q_stream_idx]['messageCount'] += 1
-                shared_state['streams'][q_stream_idx]['process_end_time'] = time.time()
-                # compute idle time
-                q_idle_time = shared_state['streams'][q_stream_idx]['process_start_time'] - \
-                              shared_state['streams'][q_stream_idx]['previous_end_time']
-                # compute processing time
-                q_processing_time = shared_state['streams'][q_stream_idx]['process_end_time'] - \
-                                    shared_state['streams'][q_stream_idx]['process_start_time']
-                # store the idle time and processing time
-                # this is so that I can estimate the leftover node capacity.
-                shared_state['streams'][q_stream_idx]['totalIdleTime'] += q_idle_time
-                shared_state['streams'][q_stream_idx]['totalProcessingTime'] += q_processing_time
-
+            # payload: bytes ! important. Do not decode. Store the bytes as-is, as it may be e.g. an avro packet or other binary data.
+            timestamp_unix = int(1e6 * timestamp)  # microseconds since epoch
+            message_count = state.message_count
+            sampled = not message_count & PROCESSING_SAMPLE_MASK
+            if sampled:
+                insert_start_time = monotonic()
+                log_file.insert(timestamp_unix, msg.topic, msg.payload)
+                end_time = monotonic()
+                metrics.insert_seconds.record(end_time - insert_start_time)
             else:
-                print(f'{q_stream_idx=} sqlite_cursor is None, ignoring message. This is probably a bug.')
+                log_file.insert(timestamp_unix, msg.topic, msg.payload)
+            # no need to commit as this is done in the rotation code
+            # finally, internal performance monitoring.
+            # the idle and processing times are there so that I can estimate the leftover node capacity.
+            state.sequence += 1
+            if state.sampled_end_time is not None:
+                state.sampled_idle_time += now - state.sampled_end_time
+                state.sampled_end_time = None
+            state.last_rx_timestamp_unix = timestamp_unix
+            state.message_count = message_count + 1
+            if sampled:
+                state.clock_offset = wall_clock() - end_time
+                state.sampled_processing_time += end_time - now
+                state.sampled_end_time = end_time
+                metrics.processing_seconds.record(end_time - now)
+            state.sequence += 1
 
         except Exception as ex:
             print(f'error in on_message: {ex}')
@@ -200,12 +238,231 @@ def signal_handler(sig, frame):
     # we need a graceful stop so that the data in the sqlite database is not corrupted and readable.
     # this enables reading partially captured data.
     stdout('Abort signal received! Attempting a graceful stop, hold on ...')
-    for stream_idx2 in range(len(shared_state['streams'])):
+    # within shutdown-timeout-seconds, whether messages come in or not; see stop_streams.
+    stop_engine(shared_state.get('shutdown_timeout'))
+
+    from sys import exit
+    exit(0)
+
+
+def prepare_shared_state(config: dict):
+    global shared_state
+    stream_count = len(config['streams'])
+    # indexed by stream number, StreamState objects; a worker process fills in only the streams it runs.
+    shared_state['streams'] = [None] * stream_count
+    shared_state['configs'] = list(config['streams'])
+    shared_state['clients'] = [None] * stream_count
+    shared_state['shutdown_timeout'] = config.get('shutdown-timeout-seconds', 10.0)
+
+
+def stream_folder(stream_config: dict, data_path: str) -> str:
+    # prepare path to save the data to:
+    folder_prefix = stream_config['prefix']
+    if folder_prefix == '':
+        raise ValueError('folder prefix cannot be empty.')
+    folder_suffix = stream_config['suffix']
+    folder_name = folder_prefix + folder_suffix
+    return os.path.join(data_path, folder_name)
+
+
+def make_stream_callback(
+        stream_idx: int,
+        config: dict,
+        data_path: str,
+        catalog: typing.Optional[Catalog],
+        writer_factory: typing.Optional[Callable[..., Any]] = None,
+        rotation_executor=None) -> Callable:
+    """ the on_message closure of a stream, configured from the stream's section of the config. """
+    stream_config = config['streams'][stream_idx]
+    stream_path = stream_folder(stream_config, data_path)
+    spool = stream_config.get('spool', False)
+    max_mib = stream_config.get('file-rotation-max-mib')
+    if spool and writer_factory is not None:
+        stdout(f'stream {stream_idx}: the spool is not supported by this engine, ignored.')
+    # this pattern is called "making a closure",
+    # that is, a function that returns a function that closes over some variables provided from the outer scope
+    return make_on_message_callback(
+        stream_idx,
+        intended_topic=stream_config['topic'],
+        q_stream_path=stream_path,
+        log_rotation_time=stream_config['file-rotation-time-seconds'],
+        rotation_prepare_lead=stream_config.get('file-rotation-prepare-seconds', 5.0),
+        rotation_max_rows=stream_config.get('file-rotation-max-rows'),
+        rotation_max_bytes=None if max_mib is None else int(max_mib * (1 << 20)),
+        rotation_align=stream_config.get('file-rotation-align', False),
+        rollups=resolve_rollups(stream_config.get('rollups'), stream_path),
+        # see attic.schemas
+        schemas=stream_config.get('schemas'),
+        storage_profile=resolve_storage_profile(stream_config.get('storage-profile', 'default'),
+                                                config.get('storage-profiles')),
+        catalog=catalog,
+        writer_thread=writer_factory is not None or stream_config.get('writer-thread', False),
+        writer_queue_size=stream_config.get('writer-queue-size', 100000),
+        writer_batch_size=stream_config.get('writer-batch-size', 1000),
+        writer_batch_seconds=stream_config.get('writer-batch-seconds', 1.0),
+        writer_factory=writer_factory,
+        rotation_executor=rotation_executor,
+        spool=spool,
+        spool_size_bytes=int(stream_config.get('spool-size-mib', 64) * (1 << 20)),
+        spool_overflow=stream_config.get('spool-overflow', 'block'),
+        spool_stop_seconds=stream_config.get('spool-stop-seconds', 2.0),
+        shards=stream_config.get('shards', 1),
+    )
+
+
+def make_stream_client(
+        stream_idx: int,
+        config: dict,
+        data_path: str,
+        catalog: typing.Optional[Catalog],
+        writer_factory: typing.Optional[Callable[..., Any]] = None,
+        rotation_executor=None) -> mqtt.Client:
+    """ create the mqtt client of a stream, with its on_message closure, not connected yet. """
+    global shared_state
+    stream_config = config['streams'][stream_idx]
+
+    # create the mqtt client and pass on the curried on_message function
+
+    mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    shared_state['clients'][stream_idx] = mqtt_client
+
+    # TODO: Do not connect here. Connect in the root thread.
+    on_connect = make_on_connect([stream_config['topic']])
+    mqtt_client.on_connect = on_connect  # this will also subscribe to the topic
+    mqtt_client.on_disconnect = on_disconnect  # update: now only handle re-connecting in the root thread.
+
+    mqtt_client.on_message = make_stream_callback(stream_idx, config, data_path, catalog, writer_factory,
+                                                  rotation_executor)
+    if stream_config['user'] != "":
+        mqtt_client.username_pw_set(stream_config['user'], stream_config['password'])
+    return mqtt_client
+
+
+def start_stream(stream_idx: int, config: dict, data_path: str, catalog: typing.Optional[Catalog]) -> mqtt.Client:
+    """ create the mqtt client of a stream, connect it, and start its network thread. """
+    stream_config = config['streams'][stream_idx]
+    mqtt_client = make_stream_client(stream_idx, config, data_path, catalog)
+    mqtt_client.connect(stream_config['mqtt-broker-address'], stream_config['mqtt-broker-port'], 10)
+
+    # ! This starts the mqtt client in a separate thread.
+    mqtt_client.loop_start()
+    return mqtt_client
+
+
+def shares_connection(stream_config: dict, share_connections: typing.Optional[bool] = None) -> bool:
+    """
+    whether a stream joins the shared connection of its broker. By default, only if it writes from a writer stage:
+    a stream that writes in its on_message would hold the shared network thread, and the other streams with it,
+    for every insert.
+    """
+    if share_connections is not None:
+        return bool(share_connections)
+    return bool(stream_config.get('writer-thread', False) or stream_config.get('spool', False)
+                or stream_config.get('shards', 1) > 1)
+
+
+def start_streams(stream_indices: typing.Iterable[int], config: dict, data_path: str, catalog: typing.Optional[Catalog]):
+    """
+    start the streams, as start_stream does. The streams of the same broker and credentials can share one mqtt client,
+    that dispatches the messages to them; see attic.connections. `share-connections`: true shares all of them,
+    false none, and by default, only the streams with a writer stage, see shares_connection.
+    """
+    global shared_state
+    share_connections = config.get('share-connections')
+    connections = shared_state.setdefault('connections', {})
+    for stream_idx in stream_indices:
+        stream_config = config['streams'][stream_idx]
+        if not shares_connection(stream_config, share_connections):
+            start_stream(stream_idx, config, data_path, catalog)
+            continue
+        key = broker_key(stream_config)
+        connection = connections.get(key)
+        if connection is None:
+            connection = connections[key] = BrokerConnection(key)
+        connection.add(stream_config['topic'], make_stream_callback(stream_idx, config, data_path, catalog))
+        shared_state['clients'][stream_idx] = connection.client
+    for connection in connections.values():
+        connection.start()
+
+
+def reconnect_stream(stream_idx: int, config: dict, reconnected: typing.Optional[set] = None):
+    """
+    connect the client of a stream again. `reconnected`: the connections reconnected so far in this monitoring pass;
+    a shared connection is reconnected once per pass, not once per stream, as it reports not connected
+    until its CONNACK arrives.
+    """
+    global shared_state
+    # trying to work the client from another thread is risky, do not do this now.
+    h_client = shared_state['clients'][stream_idx]
+    if h_client.is_connected():
+        return
+    connection = shared_state.get('connections', {}).get(broker_key(config['streams'][stream_idx]))
+    key = connection.key if connection is not None and connection.client is h_client else ('stream', stream_idx)
+    if reconnected is not None:
+        if key in reconnected:
+            return
+        reconnected.add(key)
+    stdout(f"stream {stream_idx} is not connected, attempting to reconnect ...")
+    try:
+        stream_config = config['streams'][stream_idx]
+        time.sleep(0.1)
+        h_client.loop_stop()
+        time.sleep(0.1)
+        h_client.disconnect()
+        time.sleep(0.1)
+        # now, connect again with refreshed settings
+        if stream_config['user'] != "":
+            h_client.username_pw_set(username=stream_config['user'],
+                                     password=stream_config['password'])
+        time.sleep(0.1)
+        # the client keeps its on_connect, which subscribes to the topics again
+
+        h_client.connect(host=stream_config['mqtt-broker-address'],
+                         port=stream_config['mqtt-broker-port'],
+                         keepalive=10)
+        time.sleep(0.1)
+        h_client.loop_start()
+        time.sleep(0.1)
+        # h_client.reconnect()
+        # !! After the server reboots, it doesn't know
+        # !! what the client would like to subscribe to. We need to tell it again.
+        # !! Update: this is now done in curried on_connect (it is curried with the topics to subscribe to)
+    except Exception as ex:
+        stdout(f"error {ex} when reconnecting stream {stream_idx}, not retrying.")
+
+
+def thread_stream_snapshot(stream_idx: int) -> dict:
+    """ the counters of a stream that runs in this process, for the monitoring loop. """
+    global shared_state
+    stream_state = shared_state['streams'][stream_idx]
+    details = stream_state.rotation.performance_report()
+    writer = stream_state.writer
+    if writer is not None:
+        details.update(writer.performance_report())
+    snapshot = stream_state.snapshot()
+    snapshot.update(
+        is_connected=shared_state['clients'][stream_idx].is_connected(),
+        details=details,
+    )
+    return snapshot
+
+
+def stop_streams(stream_indices: typing.Iterable[int], timeout: typing.Optional[float] = None):
+    """
+    ask the streams to flush and close their files, then stop their mqtt clients.
+    With a timeout, the streams that did not acknowledge in time (no message came in) are closed
+    after their client is stopped, when no more on_message calls can happen.
+    """
+    global shared_state
+    deadline = None if timeout is None else time.time() + timeout
+    for stream_idx2 in stream_indices:
         try:
             stdout(f'sending stop signal to {stream_idx2=}...')
             # note that there must be a mqtt message coming in for the stop request to be processed
-            shared_state['streams'][stream_idx2]['stop_request'] = True
-            while not shared_state['streams'][stream_idx2]['stop_request_ack']:
+            shared_state['streams'][stream_idx2].stop_request = True
+            while not shared_state['streams'][stream_idx2].stop_request_ack:
+                if deadline is not None and time.time() > deadline:
+                    break
                 # if ctrl-c is pressed again during this time, the program will exit immediately.
                 time.sleep(0.2)
                 stdout('.', end='', flush=True)
@@ -213,7 +470,10 @@ def signal_handler(sig, frame):
             stdout(f'error {ex1} when stopping sqlite on {stream_idx2=}, not retrying.')
             pass
 
-    for client in shared_state['clients']:
+    # once per client: streams can share one, see start_streams
+    clients = {id(shared_state['clients'][stream_idx2]): shared_state['clients'][stream_idx2]
+               for stream_idx2 in stream_indices}
+    for client in clients.values():
         try:
             stdout(f'stopping client {client} ...')
             client.loop_stop()
@@ -222,8 +482,50 @@ def signal_handler(sig, frame):
             stdout(f'error {ex2} when stopping client {client}, not retrying.')
             pass
 
-    from sys import exit
-    exit(0)
+    for stream_idx2 in stream_indices:
+        stream_state = shared_state['streams'][stream_idx2]
+        if not stream_state.stop_request_ack and stream_state.writer is None:
+            try:
+                stream_state.rotation.close()
+                stream_state.stop_request_ack = True
+            except Exception as ex3:
+                stdout(f'error {ex3} when closing sqlite on {stream_idx2=}, not retrying.')
+
+
+def start_engine(config: dict, data_path: str, catalog: typing.Optional[Catalog]) -> Callable[[int], dict]:
+    """ start all streams with the configured engine. Returns the function that takes a snapshot of a stream. """
+    global shared_state
+    engine = config.get('engine', 'threads')
+    if engine == 'threads':
+        start_streams(range(len(config['streams'])), config, data_path, catalog)
+        return thread_stream_snapshot
+    elif engine == 'processes':
+        # each stream, or group of streams, runs in its own worker process, with its own GIL.
+        supervisor = ProcessSupervisor(config, data_path)
+        shared_state['supervisor'] = supervisor
+        supervisor.start()
+        return supervisor.stream_snapshot
+    elif engine == 'asyncio':
+        # all streams driven by a few event loops, their data written from a thread pool.
+        # the streams keep their state in this process, as with the threads engine.
+        supervisor = AsyncioEngine(config, data_path, catalog)
+        shared_state['supervisor'] = supervisor
+        supervisor.start()
+        return thread_stream_snapshot
+    else:
+        raise ValueError(f'unknown engine {engine!r}, expected one of {ENGINES}')
+
+
+def stop_engine(timeout: typing.Optional[float] = None):
+    """ flush and close the files of all streams, and stop their mqtt clients, whatever the engine. """
+    global shared_state
+    if 'supervisor' in shared_state:
+        if timeout is None:
+            shared_state['supervisor'].stop()
+        else:
+            shared_state['supervisor'].stop(timeout)
+    else:
+        stop_streams(range(len(shared_state['streams'])), timeout)
 
 
 def run():
@@ -299,49 +601,14 @@ def run():
         os.makedirs(stream_path, exist_ok=True)
 
 
-    # for each stream, create mqtt client and subscribe to topic
-    shared_state['streams'] = []
-    shared_state['configs'] = []
-    shared_state['clients'] = []
+    # the catalog of sealed files, at the root of the data folder
+    catalog = Catalog(data_path) if config.get('catalog', True) else None
 
-    for stream_idx in range(stream_count):
-        stream_config = config['streams'][stream_idx]
-        shared_state['configs'].append(stream_config)
-
-        # prepare path to save the data to:
-        folder_prefix = config['streams'][stream_idx]['prefix']
-        if folder_prefix == '':
-            raise ValueError('folder prefix cannot be empty.')
-        folder_suffix = config['streams'][stream_idx]['suffix']
-        folder_name = folder_prefix + folder_suffix
-        stream_path = os.path.join(data_path, folder_name)
-
-        # create the mqtt client and pass on the curried on_message function
-
-        mqtt_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
-        shared_state['clients'].append(mqtt_client)
-        shared_state['streams'].append(dict())
-
-        # TODO: Do not connect here. Connect in the root thread.
-        on_connect = make_on_connect([stream_config['topic']])
-        mqtt_client.on_connect = on_connect  # this will also subscribe to the topic
-        mqtt_client.on_disconnect = on_disconnect  # update: now only handle re-connecting in the root thread.
-
-        # this pattern is called "making a closure",
-        # that is, a function that returns a function that closes over some variables provided from the outer scope
-        this_on_message = make_on_message_callback(
-            stream_idx,
-            intended_topic=stream_config['topic'],
-            q_stream_path=stream_path,
-            log_rotation_time=stream_config['file-rotation-time-seconds']
-        )
-        mqtt_client.on_message = this_on_message
-        if stream_config['user'] != "":
-            mqtt_client.username_pw_set(stream_config['user'], stream_config['password'])
-        mqtt_client.connect(stream_config['mqtt-broker-address'], stream_config['mqtt-broker-port'], 10)
+    # for each stream, create mqtt client and subscribe to topic
+    prepare_shared_state(config)
 
-        # ! This starts the mqtt client in a separate thread.
-        mqtt_client.loop_start()
+    engine = config.get('engine', 'threads')
+    snapshot_stream = start_engine(config, data_path, catalog)
 
     # final preparation before starting the main loop
     ##############################################################################################
@@ -350,16 +617,33 @@ def run():
 
     last_message_count = 0
     feedback_period = config['console-feedback-period-seconds']
+    # per stream: the histogram counts at the previous performance message, to summarize what came since
+    previous_metric_counts = [None] * stream_count
+
+    # optional: the histograms and counters on a Prometheus-style /metrics http endpoint
+    if config.get('metrics-port') is not None:
+        stream_names = [config['streams'][stream_idx]['prefix'] + config['streams'][stream_idx]['suffix']
+                        for stream_idx in range(stream_count)]
+
+        def collect_metrics():
+            return [(stream_names[stream_idx], snapshot_stream(stream_idx)) for stream_idx in range(stream_count)]
+
+        MetricsServer(collect_metrics, config.get('metrics-address', '127.0.0.1'), config['metrics-port']).start()
 
     if config['log-performance']:
         performance_topic = config['log-performance-stream']['topic']
-        performance_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
-        if config['log-performance-stream']['user'] != "":
-            performance_client.username_pw_set(config['log-performance-stream']['user'],
-                                               config['log-performance-stream']['password'])
-        performance_client.connect(config['log-performance-stream']['mqtt-broker-address'],
-                                   config['log-performance-stream']['mqtt-broker-port'], 60)
-        performance_client.loop_start()
+        # the connection of the streams of the same broker and credentials, if there is one
+        shared_connection = shared_state.get('connections', {}).get(broker_key(config['log-performance-stream']))
+        if shared_connection is not None:
+            performance_client = shared_connection.client
+        else:
+            performance_client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+            if config['log-performance-stream']['user'] != "":
+                performance_client.username_pw_set(config['log-performance-stream']['user'],
+                                                   config['log-performance-stream']['password'])
+            performance_client.connect(config['log-performance-stream']['mqtt-broker-address'],
+                                       config['log-performance-stream']['mqtt-broker-port'], 60)
+            performance_client.loop_start()
     else:
         performance_client = None
         performance_topic = None
@@ -369,68 +653,50 @@ def run():
     while True:
         # The main thread is a monitoring thread. The real work is done in the mqtt client threads.
         time.sleep(feedback_period)
+        if engine == 'processes':
+            # restart the worker processes that died
+            shared_state['supervisor'].check_workers()
 
+        stream_snapshots = [snapshot_stream(stream_idx) for stream_idx in range(stream_count)]
         current_time = time.time()
         elapsed_time = current_time - start_time
-        totalMessageCount = shared_state['totalMessageCount']
+        totalMessageCount = sum(snapshot['messageCount'] for snapshot in stream_snapshots)
         messages_per_second_total = totalMessageCount / elapsed_time
         messages_per_second_recent = (totalMessageCount - last_message_count) / feedback_period
         last_message_count = totalMessageCount
         elapsed_time_hours = elapsed_time / 3600
         performance_details = []
+        # the connections reconnected in this pass, see reconnect_stream
+        reconnected = set()
         # compute idle time to total time ratio, per stream
         # this is important to estimate the leftover node capacity.
-        for stream_idx in range(len(shared_state['streams'])):
-            idle_time = shared_state['streams'][stream_idx]['totalIdleTime']
-            processing_time = shared_state['streams'][stream_idx]['totalProcessingTime']
+        for stream_idx, snapshot in enumerate(stream_snapshots):
+            idle_time = snapshot['totalIdleTime']
+            processing_time = snapshot['totalProcessingTime']
             total_time = idle_time + processing_time
             if total_time > 0:
                 idle_time_ratio = idle_time / total_time
                 utilisation_ratio = 100 * (1.0 - idle_time_ratio)
                 # stdout(f"{stream_idx=} {utilisation_ratio=:06.3f} %")
-                stream_connected = shared_state['clients'][stream_idx].is_connected()
-                if not stream_connected:
-                    stdout(f"stream {stream_idx} is not connected, attempting to reconnect ...")
-                    try:
-                        # trying to work the client from another thread is risky, do not do this now.
-                        h_client = shared_state['clients'][stream_idx]
-                        stream_config = config['streams'][stream_idx]
-                        time.sleep(0.1)
-                        h_client.loop_stop()
-                        time.sleep(0.1)
-                        h_client.disconnect()
-                        time.sleep(0.1)
-                        # now, connect again with refreshed settings
-                        if stream_config['user'] != "":
-                            h_client.username_pw_set(username=stream_config['user'],
-                                                     password=stream_config['password'])
-                        time.sleep(0.1)
-                        on_connect = make_on_connect([stream_config['topic']])
-                        h_client.on_connect = on_connect  # this will also subscribe to the topic
-
-                        h_client.connect(host=stream_config['mqtt-broker-address'],
-                                         port=stream_config['mqtt-broker-port'],
-                                         keepalive=10)
-                        time.sleep(0.1)
-                        h_client.loop_start()
-                        time.sleep(0.1)
-                        # h_client.reconnect()
-                        # !! After the server reboots, it doesn't know
-                        # !! what the client would like to subscribe to. We need to tell it again.
-                        # !! Update: this is now done in curried on_connect (it is curried with the topics to subscribe to)
-                    except Exception as ex:
-                        stdout(f"error {ex} when reconnecting stream {stream_idx}, not retrying.")
+                stream_connected = snapshot['is_connected']
+                if not stream_connected and engine == 'threads':
+                    # (the worker processes, and the event loops, reconnect their own clients)
+                    reconnect_stream(stream_idx, config, reconnected)
                     # after this, do not update the status yet, report the state as seen before the attempt to reconnect.
 
                 performance_detail = dict(
                     stream_prefix=config['streams'][stream_idx]['prefix'],
                     stream_idx=stream_idx,
                     utilisation_ratio=utilisation_ratio,
-                    messages_this_channel=shared_state['streams'][stream_idx]['messageCount'],
-                    last_rx_timestamp_unix=shared_state['streams'][stream_idx]['lastRxTimestamp_unix'],
-                    last_rx_timestamp_iso=shared_state['streams'][stream_idx]['lastRxTimestamp_iso_string'],
+                    messages_this_channel=snapshot['messageCount'],
+                    last_rx_timestamp_unix=snapshot['lastRxTimestamp_unix'],
+                    last_rx_timestamp_iso=snapshot['lastRxTimestamp_iso_string'],
                     is_connected=stream_connected,
                 )
+                performance_detail.update(snapshot['details'])
+                # p50, p99 and max_bound of the histograms, since the previous performance message
+                performance_detail['histograms'] = snapshot['metrics'].summary(previous_metric_counts[stream_idx])
+                previous_metric_counts[stream_idx] = snapshot['metrics'].counts()
                 performance_details.append(performance_detail)
             else:
                 pass
@@ -442,6 +708,7 @@ def run():
 
         if performance_client is not None:
             performance_message = dict(
+                engine=engine,
                 elapsed_time_hours=elapsed_time_hours,
                 totalMessageCount=totalMessageCount,
                 messages_per_second_total=messages_per_second_total,
@@ -452,3 +719,21 @@ def run():
                 topic=performance_topic,
                 payload=json.dumps(performance_message)
                 )
+
+
+# offline tools, run as `attic <tool> ...`
+TOOLS = {
+    'bench': 'attic.bench',
+    'catalog': 'attic.catalog',
+    'compact': 'attic.compact',
+    'replay': 'attic.replay',
+}
+
+
+def main():
+    # `attic <tool> ...` runs one of the offline tools, plain `attic [--config ...]` runs the logger.
+    if len(sys.argv) > 1 and sys.argv[1] in TOOLS:
+        tool = importlib.import_module(TOOLS[sys.argv[1]])
+        tool.main(sys.argv[2:])
+    else:
+        run()
@@ -0,0 +1,330 @@
+import asyncio
+import concurrent.futures
+import functools
+import threading
+import time
+import typing
+
+from paho.mqtt import client as mqtt
+
+from .state import StreamState
+from .storage import RotationEngine
+
+stdout = print
+
+# The `asyncio` engine: all mqtt clients are driven by one, or a few, asyncio event loops,
+# through paho's external socket integration (on_socket_open / loop_read / loop_write / loop_misc),
+# instead of one paho network thread per stream.
+#
+# * the on_message closure is the same as with the writer stage of the threads engine:
+#   it only time-stamps the message and hands it over to the stream's writer.
+# * the writer of each stream is a task on the event loop that collects the rows,
+#   and writes and commits them in batches in a thread pool shared by all streams, so that no disk work
+#   happens on the event loop. At most one batch per stream is being written at any time, hence the rows
+#   are written in order. The rows are handed to the rotation engine at the time of the stream's clock
+#   (see attic.state), the same clock that time-stamps them.
+# * the rotation engines prepare and seal the files in a second, smaller thread pool shared by all streams,
+#   rather than in a thread each: hundreds of streams cost the two pools, not hundreds of threads.
+#   (a pool of its own: the writes wait for the prepared files, and must not hold the threads that prepare them)
+# * when more than `writer-queue-size` rows of a stream are waiting, the event loop stops reading that stream's
+#   socket until the batch in progress is written, which pushes back to the broker through TCP.
+# * the event loops also send the keepalive pings, and reconnect the clients that lost their connection.
+
+# how many packets a readable socket is read for, before the event loop moves on to the other sockets.
+READ_BURST = 64
+# how often the keepalive and reconnection check runs, per event loop
+HOUSEKEEPING_PERIOD = 1.0
+# a disconnected client is reconnected at most this often. Note that the connect itself blocks its event loop.
+RECONNECT_PERIOD = 5.0
+# how long `stop` waits for the writers to flush, and for the event loops to disconnect the clients
+STOP_TIMEOUT = 10.0
+
+
+class ExecutorWriter:
+    """
+    The writer stage of a stream in the asyncio engine; has the interface of `BatchWriter`.
+
+    `put` is called on the event loop. The rows are written, and committed, every `batch_size` rows
+    or every `batch_seconds`, whichever comes first, in the storage thread pool.
+    """
+
+    def __init__(
+            self,
+            stream_state: StreamState,
+            rotation: RotationEngine,
+            driver: 'LoopDriver' = None,
+            stream_idx: int = 0,
+            executor: concurrent.futures.Executor = None,
+            queue_size: int = 100000,
+            batch_size: int = 1000,
+            batch_seconds: float = 1.0,
+            name: str = 'attic-writer'):
+        self.stream_state = stream_state
+        self.rotation = rotation
+        self.driver = driver
+        self.stream_idx = stream_idx
+        self.executor = executor
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        self.name = name
+        self.pending = []
+        self.in_flight = 0
+        self.reading_paused = False
+        # created on the event loop, by `run`
+        self.wakeup: typing.Optional[asyncio.Event] = None
+        self.written_count = 0
+        self.commit_count = 0
+        # the stream's StreamMetrics, if any
+        self.metrics = stream_state.metrics
+
+    def start(self):
+        self.driver.loop.call_soon_threadsafe(self.driver.loop.create_task, self.run())
+
+    def put(self, timestamp_unix: int, topic: str, payload: bytes):
+        self.pending.append((timestamp_unix, topic, payload))
+        if len(self.pending) >= self.batch_size and self.wakeup is not None:
+            self.wakeup.set()
+        if len(self.pending) >= self.queue_size and not self.reading_paused:
+            self.reading_paused = True
+            self.driver.pause_reading(self.stream_idx)
+
+    def queue_depth(self) -> int:
+        return len(self.pending) + self.in_flight
+
+    def performance_report(self) -> dict:
+        return dict(
+            queue_depth=self.queue_depth(),
+            messages_written=self.written_count,
+            commit_count=self.commit_count,
+        )
+
+    def write_batch(self, batch: list):
+        # runs in the storage thread pool. The rotation engine commits the rows still pending in a rotated file.
+        # the rows go into the files of their reception timestamps, see BatchWriter.run
+        now = self.stream_state.now()
+        insert_start_time = time.perf_counter()
+        rows = batch
+        while rows:
+            log_file = self.rotation.log_file_for(rows[0][0] / 1e6)
+            count = self.rotation.rows_for_current(rows)
+            log_file.insert_many(rows if count == len(rows) else rows[:count])
+            rows = rows[count:]
+        commit_start_time = time.perf_counter()
+        log_file.commit()
+        if self.metrics is not None:
+            self.metrics.insert_seconds.record(commit_start_time - insert_start_time)
+            self.metrics.commit_seconds.record(time.perf_counter() - commit_start_time)
+            self.metrics.write_delay_seconds.record(now - batch[0][0] / 1e6)
+        self.written_count += len(batch)
+        self.commit_count += 1
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        next_write_time = time.time() + self.batch_seconds
+        while True:
+            stop_request = self.stream_state.stop_request
+            if not stop_request and len(self.pending) < self.batch_size:
+                # wake up at least every 0.2 seconds, so that a stop request is noticed even on a quiet topic.
+                timeout = min(next_write_time - time.time(), 0.2)
+                if timeout > 0:
+                    try:
+                        await asyncio.wait_for(self.wakeup.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                self.wakeup.clear()
+
+            now = time.time()
+            if self.pending and (stop_request or len(self.pending) >= self.batch_size or now >= next_write_time):
+                batch, self.pending = self.pending, []
+                self.in_flight = len(batch)
+                if self.metrics is not None:
+                    self.metrics.queue_depth.record(len(batch))
+                try:
+                    await loop.run_in_executor(self.executor, self.write_batch, batch)
+                except Exception as ex:
+                    stdout(f'{self.name} | error in writer: {ex}')
+                    import traceback
+                    stdout(traceback.format_exc())
+                    stdout(f'{self.name} | {len(batch)} messages lost, not retrying.')
+                self.in_flight = 0
+                if self.reading_paused and len(self.pending) < self.queue_size:
+                    self.reading_paused = False
+                    self.driver.resume_reading(self.stream_idx)
+            if now >= next_write_time:
+                next_write_time = now + self.batch_seconds
+
+            # the stop request is honoured only once everything received before it has been written.
+            if stop_request and not self.pending:
+                try:
+                    await loop.run_in_executor(self.executor, self.rotation.close)
+                except Exception as ex:
+                    stdout(f'{self.name} | error {ex} when closing the database, not retrying.')
+                self.stream_state.stop_request_ack = True
+                return
+
+
+class LoopDriver:
+    """ one asyncio event loop, in its own thread, driving the mqtt clients of a share of the streams. """
+
+    def __init__(self, loop_idx: int):
+        self.name = f'attic-asyncio-{loop_idx}'
+        self.loop = asyncio.new_event_loop()
+        # stream number -> mqtt client
+        self.clients: typing.Dict[int, mqtt.Client] = {}
+        self.next_reconnect_time: typing.Dict[int, float] = {}
+        self.stopping = False
+        self.housekeeping_task: typing.Optional[asyncio.Task] = None
+        self.thread = threading.Thread(target=self.run, name=self.name, daemon=True)
+
+    def run(self):
+        asyncio.set_event_loop(self.loop)
+        self.housekeeping_task = self.loop.create_task(self.housekeeping())
+        self.loop.run_forever()
+        self.loop.close()
+
+    def call(self, function: typing.Callable, *args, timeout: typing.Optional[float] = None):
+        """ run a function on the event loop, from another thread, and wait for its result. """
+        async def call_on_loop():
+            return function(*args)
+
+        return asyncio.run_coroutine_threadsafe(call_on_loop(), self.loop).result(timeout)
+
+    # paho's external socket integration
+    ###############################################################################################
+
+    def attach(self, stream_idx: int, client: mqtt.Client):
+        self.clients[stream_idx] = client
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.add_reader(sock, self.read_socket, client)
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        self.loop.remove_writer(sock)
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+
+    @staticmethod
+    def read_socket(client: mqtt.Client):
+        # loop_read reads only one packet at a time; read a few, so that a busy stream does not pay
+        # for one trip around the event loop per message.
+        for _ in range(READ_BURST):
+            if client.loop_read() != mqtt.MQTT_ERR_SUCCESS or client.socket() is None:
+                return
+
+    def pause_reading(self, stream_idx: int):
+        sock = self.clients[stream_idx].socket()
+        if sock is not None:
+            self.loop.remove_reader(sock)
+
+    def resume_reading(self, stream_idx: int):
+        client = self.clients[stream_idx]
+        sock = client.socket()
+        if sock is not None:
+            self.loop.add_reader(sock, self.read_socket, client)
+
+    async def housekeeping(self):
+        # keepalive pings, and reconnection of the clients that lost their connection.
+        while not self.stopping:
+            for stream_idx, client in list(self.clients.items()):
+                if client.loop_misc() == mqtt.MQTT_ERR_SUCCESS or self.stopping:
+                    continue
+                now = time.time()
+                if now < self.next_reconnect_time.get(stream_idx, 0.0):
+                    continue
+                self.next_reconnect_time[stream_idx] = now + RECONNECT_PERIOD
+                stdout(f"stream {stream_idx} is not connected, attempting to reconnect ...")
+                try:
+                    # the topics are subscribed to again by the on_connect closure.
+                    client.reconnect()
+                except Exception as ex:
+                    stdout(f"error {ex} when reconnecting stream {stream_idx}, will retry.")
+            await asyncio.sleep(HOUSEKEEPING_PERIOD)
+
+    def disconnect_all(self):
+        self.stopping = True
+        self.housekeeping_task.cancel()
+        for client in self.clients.values():
+            try:
+                client.disconnect()
+            except Exception as ex:
+                stdout(f'error {ex} when stopping client {client}, not retrying.')
+
+    def stop(self, timeout: float):
+        try:
+            self.call(self.disconnect_all, timeout=timeout)
+            # give the event loop a moment to send the DISCONNECT packets
+            time.sleep(0.1)
+        except Exception as ex:
+            stdout(f'{self.name} | error {ex} when disconnecting, not retrying.')
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join(timeout)
+
+
+class AsyncioEngine:
+    """
+    Runs the streams of this process with `asyncio-loops` event loops (default 1), and writes their data
+    with a pool of `asyncio-storage-threads` threads (default 4), and prepares and seals their files with a pool of
+    `asyncio-rotation-threads` threads (default 2). The streams are dealt out to the loops in turn.
+
+    The streams keep their state in `shared_state`, as with the threads engine, for the monitoring loop.
+    """
+
+    def __init__(self, config: dict, data_path: str, catalog=None):
+        self.config = config
+        self.data_path = data_path
+        self.catalog = catalog
+        self.stream_count = len(config['streams'])
+        loop_count = max(1, min(config.get('asyncio-loops', 1), self.stream_count))
+        self.drivers = [LoopDriver(loop_idx) for loop_idx in range(loop_count)]
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=config.get('asyncio-storage-threads', 4), thread_name_prefix='attic-storage')
+        self.rotation_executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=config.get('asyncio-rotation-threads', 2), thread_name_prefix='attic-rotation')
+
+    def start(self):
+        import attic
+        for driver in self.drivers:
+            driver.thread.start()
+        for stream_idx in range(self.stream_count):
+            driver = self.drivers[stream_idx % len(self.drivers)]
+            writer_factory = functools.partial(ExecutorWriter, driver=driver, stream_idx=stream_idx,
+                                               executor=self.executor)
+            client = attic.make_stream_client(stream_idx, self.config, self.data_path, self.catalog,
+                                              writer_factory=writer_factory,
+                                              rotation_executor=self.rotation_executor)
+            # connect on the event loop, so that the socket callbacks run there too.
+            driver.call(driver.attach, stream_idx, client)
+            stream_config = self.config['streams'][stream_idx]
+            driver.call(client.connect, stream_config['mqtt-broker-address'], stream_config['mqtt-broker-port'], 10)
+
+    def stop(self, timeout: float = STOP_TIMEOUT):
+        import attic
+        stream_states = attic.shared_state['streams']
+        for stream_idx in range(self.stream_count):
+            stdout(f'sending stop signal to {stream_idx=}...')
+            stream_states[stream_idx].stop_request = True
+        # the writers flush and close their files on the event loops, without waiting for a message to come in.
+        deadline = time.time() + timeout
+        while not all(stream_state is None or stream_state.stop_request_ack for stream_state in stream_states):
+            if time.time() > deadline:
+                stdout('some streams did not flush in time.')
+                break
+            time.sleep(0.1)
+            stdout('.', end='', flush=True)
+        stdout()
+        for driver in self.drivers:
+            driver.stop(timeout=max(deadline - time.time(), 1.0))
+        self.executor.shutdown(wait=True)
+        # after the writers: closing a stream seals its last file in this pool
+        self.rotation_executor.shutdown(wait=True)
@@ -0,0 +1,481 @@
+import argparse
+import datetime
+import itertools
+import json
+import multiprocessing
+import os
+import pathlib
+import platform
+import random
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import typing
+
+stdout = print
+
+# Ingest benchmark: drives the real ingest path from a local stand-in for the broker, and measures it.
+#
+#   attic bench --source broker --rate 1000,10000 --payload-size 64,1024 --streams 1,4 --duration 10 \
+#               --output bench.json [--baseline previous-bench.json]
+#
+# Sources:
+# * synthetic: the on_message closure of each stream is called directly, from one thread per stream,
+#   as the paho network thread would; no sockets. This measures the callback, writer and rotation alone.
+# * broker: an embedded minimal MQTT broker (attic.fakebroker) runs in a child process, generates the messages,
+#   and the streams connect to it over localhost with the configured engine, as in production.
+#
+# Every combination of the swept parameters (rate, payload size, topic count, stream count, rotation period)
+# is one run, with a fresh data folder. The messages are sent open-loop, at the offered rate:
+# each payload starts with its scheduled send time, in microseconds, hence
+# latency = reception_timestamp - scheduled send time, read back from the files after the run,
+# and a logger that falls behind shows it as latency rather than as a slower source.
+#
+# Per run: messages/s sustained, latency percentiles, CPU seconds per message of the logger process
+# (and of its worker processes, with engine "processes"; in synthetic mode, the source is included),
+# rotation count and stall, and bytes on disk. The result is a JSON document; with --baseline,
+# the runs are compared with the same runs of an earlier result.
+
+STAMP = struct.Struct('>q')
+# at most this many messages per batch from a source; also the batch size as fast as possible (rate 0)
+SOURCE_BATCH = 1000
+# how long to wait for the logger to catch up after the source is done, without progress
+DRAIN_TIMEOUT = 5.0
+LATENCY_PERCENTILES = (50, 90, 99, 99.9)
+
+
+class SyntheticMessage:
+    """ stands in for paho's MQTTMessage, for the synthetic source """
+    __slots__ = ('topic', 'payload')
+
+    def __init__(self, topic: str, payload: bytes):
+        self.topic = topic
+        self.payload = payload
+
+
+def stream_topics(stream_idx: int, topic_count: int) -> typing.List[str]:
+    return [f'bench/{stream_idx}/sensor/{topic_idx}' for topic_idx in range(topic_count)]
+
+
+def payload_pool(payload_size: int, count: int = 256, seed: int = 0) -> typing.List[bytes]:
+    """ the payload bodies, after the time stamp; half random bytes, half repetitive text, as sensors send. """
+    rng = random.Random(seed)
+    body_size = max(payload_size - STAMP.size, 0)
+    pool = []
+    for index in range(count):
+        if index % 2:
+            body = bytes(rng.getrandbits(8) for _ in range(body_size))
+        else:
+            text = f'{{"value": {rng.random():.6f}, "unit": "degC", "status": "ok"}}'
+            body = (text * (body_size // len(text) + 1)).encode()[:body_size]
+        pool.append(body)
+    return pool
+
+
+def paced_batches(
+        rate: float,
+        duration: float,
+        topics: typing.List[str],
+        pool: typing.List[bytes]) -> typing.Iterator[typing.List[typing.Tuple[str, bytes]]]:
+    """
+    the messages of one source, in batches, each message as soon as its scheduled time has come.
+    rate 0 means as fast as possible, and then the messages are stamped with the actual send time.
+    """
+    start = time.time()
+    end = start + duration
+    sent = 0
+    while True:
+        now = time.time()
+        if now >= end:
+            return
+        if rate > 0:
+            count = min(int((now - start) * rate) + 1 - sent, SOURCE_BATCH)
+            if count <= 0:
+                time.sleep(min(0.001, start + sent / rate - now))
+                continue
+        else:
+            count = SOURCE_BATCH
+        batch = []
+        for index in range(sent, sent + count):
+            scheduled = start + index / rate if rate > 0 else now
+            batch.append((topics[index % len(topics)],
+                          STAMP.pack(int(1e6 * scheduled)) + pool[index % len(pool)]))
+        sent += count
+        yield batch
+
+
+def bench_config(run: dict, data_folder: str, port: int = 0) -> dict:
+    """ an attic configuration for one run, as it would be written in config.yaml. """
+    rotation_seconds = run['rotation_seconds']
+    streams = []
+    for stream_idx in range(run['streams']):
+        streams.append({
+            'mqtt-broker-address': '127.0.0.1',
+            'mqtt-broker-port': port,
+            'user': '',
+            'password': '',
+            'topic': f'bench/{stream_idx}/#',
+            'prefix': f'bench-{stream_idx}',
+            'suffix': '',
+            'file-rotation-time-seconds': rotation_seconds,
+            'file-rotation-prepare-seconds': min(5.0, rotation_seconds / 2),
+            'storage-profile': run['storage_profile'],
+            'writer-thread': run['writer_thread'],
+            'spool': run.get('spool', False),
+            'shards': run.get('shards', 1),
+            # drain the spool completely on stop, so that every message is counted
+            'spool-stop-seconds': 60.0,
+        })
+    return {
+        'console-feedback-period-seconds': 1,
+        'data-folder': data_folder,
+        'catalog': run['catalog'],
+        'engine': run['engine'],
+        'streams': streams,
+        'log-performance': False,
+    }
+
+
+def cpu_seconds() -> float:
+    """ CPU time of this process, and of its child processes that have been waited for. """
+    seconds = time.process_time()
+    try:
+        import resource
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        seconds += usage.ru_utime + usage.ru_stime
+    except ImportError:
+        pass  # not on windows
+    return seconds
+
+
+def wait_for_drain(snapshot_stream: typing.Callable[[int], dict], stream_count: int, expected: int) -> int:
+    """ wait until the streams have received `expected` messages, or make no progress. Returns the count. """
+    last_count = -1
+    last_progress = time.time()
+    while True:
+        count = sum(snapshot_stream(stream_idx)['messageCount'] for stream_idx in range(stream_count))
+        if count >= expected:
+            return count
+        if count != last_count:
+            last_count = count
+            last_progress = time.time()
+        elif time.time() - last_progress > DRAIN_TIMEOUT:
+            return count
+        time.sleep(0.1)
+
+
+def rotation_report(snapshots: typing.List[dict]) -> dict:
+    details = [snapshot['details'] for snapshot in snapshots]
+    return dict(
+        rotation_count=sum(int(detail.get('rotation_count', 0)) for detail in details),
+        rotation_stall_max_seconds=max((detail.get('rotation_stall_max_seconds', 0.0) for detail in details),
+                                       default=0.0),
+        rotation_stall_total_seconds=sum(detail.get('rotation_stall_total_seconds', 0.0) for detail in details),
+    )
+
+
+def run_synthetic(run: dict, data_folder: str) -> dict:
+    """ call the on_message closures directly, one source thread per stream. """
+    import attic
+    from .catalog import Catalog
+    config = bench_config(run, data_folder)
+    attic.shared_state = {'totalMessageCount': 0, 'streams': []}
+    attic.prepare_shared_state(config)
+    catalog = Catalog(data_folder) if config['catalog'] else None
+    callbacks = [attic.make_stream_callback(stream_idx, config, data_folder, catalog)
+                 for stream_idx in range(run['streams'])]
+    pool = payload_pool(run['payload_size'])
+    sent_counts = [0] * run['streams']
+
+    def source(stream_idx: int):
+        on_message = callbacks[stream_idx]
+        for batch in paced_batches(run['rate'] / run['streams'], run['duration'],
+                                   stream_topics(stream_idx, run['topics']), pool):
+            for topic, payload in batch:
+                on_message(None, None, SyntheticMessage(topic, payload))
+            sent_counts[stream_idx] += len(batch)
+
+    threads = [threading.Thread(target=source, args=(stream_idx,), name=f'attic-bench-source-{stream_idx}')
+               for stream_idx in range(run['streams'])]
+    cpu_start = cpu_seconds()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    stream_states = attic.shared_state['streams']
+    snapshots = [dict(messageCount=stream_state.message_count,
+                      details=stream_state.rotation.performance_report())
+                 for stream_state in stream_states]
+    # as stop_streams does, without mqtt clients: the writers flush by themselves, the direct streams are closed here.
+    for stream_state in stream_states:
+        stream_state.stop_request = True
+    for stream_state in stream_states:
+        if stream_state.writer is not None:
+            stream_state.writer.join()
+        else:
+            stream_state.rotation.close()
+    cpu = cpu_seconds() - cpu_start
+    result = dict(messages_sent=sum(sent_counts), messages_received=sum(snapshot['messageCount']
+                                                                        for snapshot in snapshots),
+                  cpu_seconds=cpu)
+    result.update(rotation_report(snapshots))
+    return result
+
+
+def broker_source_main(run: dict, connection):
+    """ child process of the broker source: the broker, and the message generators, one per stream. """
+    from .fakebroker import FakeBroker
+    broker = FakeBroker().start()
+    connection.send(('port', broker.port))
+    # wait for the streams to subscribe, and for the go
+    deadline = time.time() + 30
+    while broker.subscription_count() < run['streams'] and time.time() < deadline:
+        time.sleep(0.01)
+    connection.send(('subscribed', broker.subscription_count()))
+    connection.recv()
+    pool = payload_pool(run['payload_size'])
+    sent_counts = [0] * run['streams']
+
+    def generate(stream_idx: int):
+        for batch in paced_batches(run['rate'] / run['streams'], run['duration'],
+                                   stream_topics(stream_idx, run['topics']), pool):
+            broker.publish_many(batch)
+            sent_counts[stream_idx] += len(batch)
+
+    threads = [threading.Thread(target=generate, args=(stream_idx,)) for stream_idx in range(run['streams'])]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    connection.send(('done', sum(sent_counts)))
+    connection.recv()
+    broker.stop()
+
+
+def run_broker(run: dict, data_folder: str) -> dict:
+    """ the streams connect to the embedded broker, with the configured engine. """
+    import attic
+    from .catalog import Catalog
+    context = multiprocessing.get_context('spawn')
+    connection, child_connection = context.Pipe()
+    broker_process = context.Process(target=broker_source_main, args=(run, child_connection),
+                                     name='attic-bench-broker', daemon=True)
+    broker_process.start()
+    try:
+        _, port = connection.recv()
+        config = bench_config(run, data_folder, port)
+        attic.shared_state = {'totalMessageCount': 0, 'streams': []}
+        attic.prepare_shared_state(config)
+        catalog = Catalog(data_folder) if config['catalog'] else None
+        snapshot_stream = attic.start_engine(config, data_folder, catalog)
+        _, subscription_count = connection.recv()
+        if subscription_count < run['streams']:
+            raise RuntimeError(f'only {subscription_count} of {run["streams"]} streams subscribed to the broker')
+        if run['engine'] == 'processes':
+            # the workers report their first counters only after a moment
+            time.sleep(1.0)
+
+        cpu_start = cpu_seconds()
+        connection.send('go')
+        _, messages_sent = connection.recv()
+        messages_received = wait_for_drain(snapshot_stream, run['streams'], messages_sent)
+        snapshots = [snapshot_stream(stream_idx) for stream_idx in range(run['streams'])]
+        attic.stop_engine(timeout=10.0)
+        cpu = cpu_seconds() - cpu_start
+        connection.send('exit')
+    finally:
+        broker_process.join(5)
+        if broker_process.is_alive():
+            broker_process.terminate()
+    result = dict(messages_sent=messages_sent, messages_received=messages_received, cpu_seconds=cpu)
+    result.update(rotation_report(snapshots))
+    return result
+
+
+def measure_files(data_folder: str, stream_count: int) -> dict:
+    """
+    the latency of every stored message, and the bytes on disk, read back from the files.
+    The spool files are counted apart, as `spool_bytes_on_disk`: their size is fixed, whatever is stored.
+    """
+    import numpy as np
+    from .reader import read_rows
+    from .spool import SPOOL_FILE_NAME
+    latencies = []
+    first_sent = None
+    last_received = None
+    bytes_on_disk = 0
+    spool_bytes_on_disk = 0
+    for stream_idx in range(stream_count):
+        stream_path = pathlib.Path(data_folder, f'bench-{stream_idx}')
+        for reception_timestamp, _, payload in read_rows(stream_path):
+            sent = STAMP.unpack_from(payload)[0]
+            latencies.append(reception_timestamp - sent)
+            first_sent = sent if first_sent is None else min(first_sent, sent)
+            last_received = reception_timestamp if last_received is None else max(last_received, reception_timestamp)
+        for path in stream_path.rglob('*'):
+            if not path.is_file():
+                continue
+            if path.name == SPOOL_FILE_NAME:
+                spool_bytes_on_disk += path.stat().st_size
+            else:
+                bytes_on_disk += path.stat().st_size
+    result = dict(messages_stored=len(latencies), bytes_on_disk=bytes_on_disk)
+    if spool_bytes_on_disk:
+        result['spool_bytes_on_disk'] = spool_bytes_on_disk
+    if latencies:
+        latency = np.array(latencies, dtype=np.int64)
+        result.update(
+            messages_per_second=len(latencies) / max((last_received - first_sent) / 1e6, 1e-6),
+            latency_us={**{f'p{percentile:g}': float(np.percentile(latency, percentile))
+                           for percentile in LATENCY_PERCENTILES},
+                        'mean': float(latency.mean()), 'max': int(latency.max())},
+            bytes_per_message=bytes_on_disk / len(latencies),
+        )
+    return result
+
+
+def run_once(run: dict, data_folder: str) -> dict:
+    if run['source'] == 'synthetic':
+        result = run_synthetic(run, data_folder)
+    else:
+        result = run_broker(run, data_folder)
+    result.update(measure_files(data_folder, run['streams']))
+    result['messages_lost'] = result['messages_sent'] - result['messages_stored']
+    if result['messages_stored']:
+        result['cpu_us_per_message'] = 1e6 * result['cpu_seconds'] / result['messages_stored']
+    return result
+
+
+def sweep(parameters: dict) -> typing.List[dict]:
+    """ one run per combination of the swept (list-valued) parameters """
+    names = list(parameters)
+    values = [value if isinstance(value, list) else [value] for value in parameters.values()]
+    return [dict(zip(names, combination)) for combination in itertools.product(*values)]
+
+
+def run_key(run: dict) -> str:
+    return json.dumps({name: value for name, value in run.items() if name != 'duration'}, sort_keys=True)
+
+
+def environment() -> dict:
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return dict(
+        git_commit=commit,
+        python=sys.version.split()[0],
+        platform=platform.platform(),
+        cpu_count=os.cpu_count(),
+        started_at=datetime.datetime.now(tz=datetime.timezone.utc).isoformat(timespec='seconds'),
+    )
+
+
+def compare(baseline: dict, current: dict) -> typing.List[str]:
+    """ one line per run present in both results: the change of messages/s, p99 latency and CPU per message. """
+    baseline_runs = {run_key(entry['run']): entry['result'] for entry in baseline['runs']}
+    lines = []
+    for entry in current['runs']:
+        before = baseline_runs.get(run_key(entry['run']))
+        if before is None:
+            continue
+        after = entry['result']
+
+        def change(value_before, value_after):
+            if not value_before or value_after is None:
+                return 'n/a'
+            return f'{100 * (value_after - value_before) / value_before:+.1f}%'
+
+        lines.append(
+            f"{entry['run']['source']} rate={entry['run']['rate']} payload={entry['run']['payload_size']} "
+            f"topics={entry['run']['topics']} streams={entry['run']['streams']} "
+            f"rotation={entry['run']['rotation_seconds']}: "
+            f"msg/s {change(before.get('messages_per_second'), after.get('messages_per_second'))}, "
+            f"p99 {change(before.get('latency_us', {}).get('p99'), after.get('latency_us', {}).get('p99'))}, "
+            f"cpu/msg {change(before.get('cpu_us_per_message'), after.get('cpu_us_per_message'))}")
+    return lines
+
+
+def number_list(kind: typing.Callable) -> typing.Callable[[str], list]:
+    return lambda text: [kind(value) for value in text.split(',')]
+
+
+def main(argv: typing.Optional[typing.List[str]] = None):
+    parser = argparse.ArgumentParser(prog='attic bench', description='benchmark the ingest path')
+    parser.add_argument('--source', type=str, default='synthetic', choices=['synthetic', 'broker'],
+                        help='call the on_message closures directly, or go through an embedded broker')
+    parser.add_argument('--engine', type=str, default='threads', help='broker source: the engine to run the streams')
+    parser.add_argument('--rate', type=number_list(float), default=[1000.0],
+                        help='offered messages/s, in total, comma separated to sweep; 0: as fast as possible')
+    parser.add_argument('--payload-size', type=number_list(int), default=[128], help='bytes, comma separated')
+    parser.add_argument('--topics', type=number_list(int), default=[10], help='topics per stream, comma separated')
+    parser.add_argument('--streams', type=number_list(int), default=[1], help='stream count, comma separated')
+    parser.add_argument('--rotation-seconds', type=number_list(float), default=[600.0],
+                        help='file rotation period, comma separated')
+    parser.add_argument('--duration', type=float, default=10.0, help='seconds of traffic per run')
+    parser.add_argument('--storage-profile', type=str, default='default')
+    parser.add_argument('--writer-thread', action='store_true', help='use the writer stage')
+    parser.add_argument('--spool', action='store_true', help='spool the messages to a memory-mapped file first')
+    parser.add_argument('--shards', type=number_list(int), default=None,
+                        help='shards per stream, comma separated; implies the writer stage')
+    parser.add_argument('--no-catalog', action='store_true', help='do not register the sealed files in a catalog')
+    parser.add_argument('--data-folder', type=str, default=None,
+                        help='keep the files of each run here; default: a temporary folder, removed after each run')
+    parser.add_argument('--output', type=str, default=None, help='write the result as JSON to this file')
+    parser.add_argument('--baseline', type=str, default=None, help='compare with an earlier JSON result')
+    args = parser.parse_args(argv)
+
+    runs = sweep(dict(
+        source=args.source,
+        engine=args.engine if args.source == 'broker' else 'threads',
+        rate=args.rate,
+        payload_size=args.payload_size,
+        topics=args.topics,
+        streams=args.streams,
+        rotation_seconds=args.rotation_seconds,
+        duration=args.duration,
+        storage_profile=args.storage_profile,
+        writer_thread=args.writer_thread,
+        catalog=not args.no_catalog,
+        # only when set, so that the runs still match baselines from before these options
+        **(dict(spool=True) if args.spool else {}),
+        **(dict(shards=args.shards) if args.shards else {}),
+    ))
+    document = dict(environment=environment(), runs=[])
+    for run_idx, run in enumerate(runs):
+        stdout(f'bench | run {run_idx + 1}/{len(runs)}: {run}')
+        if args.data_folder is not None:
+            data_folder = os.path.abspath(os.path.join(args.data_folder, f'run-{run_idx}'))
+            shutil.rmtree(data_folder, ignore_errors=True)
+            os.makedirs(data_folder)
+        else:
+            data_folder = tempfile.mkdtemp(prefix='attic-bench-')
+        try:
+            result = run_once(run, data_folder)
+        finally:
+            if args.data_folder is None:
+                shutil.rmtree(data_folder, ignore_errors=True)
+        stdout(f'bench | {json.dumps(result)}')
+        document['runs'].append(dict(run=run, result=result))
+
+    if args.output is not None:
+        with open(args.output, 'w') as stream:
+            json.dump(document, stream, indent=2)
+        stdout(f'bench | result written to {args.output}')
+    else:
+        stdout(json.dumps(document, indent=2))
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as stream:
+            baseline = json.load(stream)
+        stdout(f'bench | compared with {args.baseline} (commit {baseline["environment"].get("git_commit")}):')
+        for line in compare(baseline, document):
+            stdout(f'bench | {line}')
+
+
+if __name__ == '__main__':
+    main()
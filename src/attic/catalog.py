@@ -0,0 +1,238 @@
+import argparse
+import os
+import pathlib
+import sqlite3
+import time
+import typing
+
+import yaml
+
+from .reader import TimeBound, list_stream_files, to_microseconds
+from .schemas import decoded_only_topics
+
+stdout = print
+
+# The catalog: one sqlite file at the root of the data folder, with one row per sealed log file.
+#
+# * files: the stream folder (prefix + suffix), the path relative to the data folder,
+#   the min and max reception_timestamp, the row count and the size in bytes.
+# * file_topics: per file, the row count and the min and max reception_timestamp of each topic.
+#
+# The rotation engine registers each file once it is sealed. `attic catalog rebuild` scans an existing archive.
+# With it, "which files have topic X between T1 and T2" is one query, rather than opening every file.
+
+CATALOG_FILE_NAME = 'catalog.sqlite'
+
+
+def catalog_path(data_folder: typing.Union[str, pathlib.Path]) -> pathlib.Path:
+    return pathlib.Path(data_folder, CATALOG_FILE_NAME)
+
+
+def open_catalog(data_folder: typing.Union[str, pathlib.Path]) -> sqlite3.Connection:
+    # several rotation threads may register files at the same time, hence the generous timeout, and WAL.
+    connection = sqlite3.connect(catalog_path(data_folder), timeout=60)
+    connection.execute('PRAGMA journal_mode = WAL')
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS files (id INTEGER PRIMARY KEY, stream TEXT, path TEXT UNIQUE, '
+        'min_timestamp INTEGER, max_timestamp INTEGER, row_count INTEGER, byte_size INTEGER, registered_at INTEGER)')
+    connection.execute(
+        'CREATE INDEX IF NOT EXISTS files_stream_time ON files (stream, min_timestamp, max_timestamp)')
+    connection.execute(
+        'CREATE TABLE IF NOT EXISTS file_topics (file_id INTEGER, topic TEXT, row_count INTEGER, '
+        'min_timestamp INTEGER, max_timestamp INTEGER)')
+    connection.execute(
+        'CREATE INDEX IF NOT EXISTS file_topics_topic ON file_topics (topic, file_id)')
+    connection.execute(
+        'CREATE INDEX IF NOT EXISTS file_topics_file ON file_topics (file_id)')
+    connection.commit()
+    return connection
+
+
+def describe_file(path: typing.Union[str, pathlib.Path]) -> typing.List[typing.Tuple[str, int, int, int]]:
+    """
+    per topic of a log file: (topic, row count, min reception_timestamp, max reception_timestamp).
+    Also the rows that are in a typed table only, see attic.schemas.
+    """
+    connection = sqlite3.connect(f'file:{pathlib.Path(path).as_posix()}?mode=ro', uri=True)
+    try:
+        if connection.execute('PRAGMA user_version').fetchone()[0] < 2:
+            query = 'SELECT topic, count(*), min(reception_timestamp), max(reception_timestamp) FROM data GROUP BY topic'
+        else:
+            # not through the data view, which the compressed files do not have
+            query = ('SELECT topics.name, count(*), min(records.reception_timestamp), max(records.reception_timestamp) '
+                     'FROM records JOIN topics ON topics.id = records.topic_id GROUP BY topics.name')
+        topics = {}
+        for topic, row_count, min_timestamp, max_timestamp in connection.execute(
+                query).fetchall() + decoded_only_topics(connection):
+            if topic in topics:
+                known_count, known_min, known_max = topics[topic]
+                row_count += known_count
+                min_timestamp = min(min_timestamp, known_min)
+                max_timestamp = max(max_timestamp, known_max)
+            topics[topic] = (row_count, min_timestamp, max_timestamp)
+        return [(topic, *span) for topic, span in sorted(topics.items())]
+    finally:
+        connection.close()
+
+
+def register_file(
+        connection: sqlite3.Connection,
+        data_folder: typing.Union[str, pathlib.Path],
+        stream: str,
+        path: typing.Union[str, pathlib.Path]):
+    """ add a sealed log file to the catalog, or update its entry. """
+    path = pathlib.Path(path)
+    relative_path = path.relative_to(data_folder).as_posix()
+    topics = describe_file(path)
+    row_count = sum(topic[1] for topic in topics)
+    min_timestamp = min((topic[2] for topic in topics), default=None)
+    max_timestamp = max((topic[3] for topic in topics), default=None)
+    with connection:
+        unregister_file(connection, relative_path)
+        file_id = connection.execute(
+            'INSERT INTO files (stream, path, min_timestamp, max_timestamp, row_count, byte_size, registered_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (stream, relative_path, min_timestamp, max_timestamp, row_count, path.stat().st_size,
+             int(1e6 * time.time()))).lastrowid
+        connection.executemany(
+            'INSERT INTO file_topics (file_id, topic, row_count, min_timestamp, max_timestamp) VALUES (?, ?, ?, ?, ?)',
+            [(file_id, *topic) for topic in topics])
+
+
+def unregister_file(connection: sqlite3.Connection, relative_path: str):
+    for (file_id,) in connection.execute('SELECT id FROM files WHERE path = ?', (relative_path,)).fetchall():
+        connection.execute('DELETE FROM file_topics WHERE file_id = ?', (file_id,))
+        connection.execute('DELETE FROM files WHERE id = ?', (file_id,))
+
+
+class Catalog:
+    """ registers the files sealed by the rotation engines of one data folder. """
+
+    def __init__(self, data_folder: typing.Union[str, pathlib.Path]):
+        self.data_folder = pathlib.Path(data_folder)
+        open_catalog(self.data_folder).close()
+
+    def register(self, stream: str, path: typing.Union[str, pathlib.Path]):
+        connection = open_catalog(self.data_folder)
+        try:
+            register_file(connection, self.data_folder, stream, path)
+        finally:
+            connection.close()
+
+
+def find_files(
+        data_folder: typing.Union[str, pathlib.Path],
+        stream: typing.Optional[str] = None,
+        start: TimeBound = None,
+        end: TimeBound = None,
+        topics: typing.Optional[typing.Sequence[str]] = None) -> typing.List[pathlib.Path]:
+    """
+    the cataloged files with rows in [start, end), of the given stream and topics, oldest first.
+    Topics are exact topic names here. Files that are not sealed yet are not in the catalog.
+    """
+    conditions = []
+    parameters = []
+    time_table = 'files'
+    source = 'files'
+    if topics is not None:
+        if isinstance(topics, str):
+            topics = [topics]
+        # the time span of the topic itself, not of the whole file
+        source = 'files JOIN file_topics ON file_topics.file_id = files.id'
+        time_table = 'file_topics'
+        conditions.append(f'file_topics.topic IN ({", ".join("?" * len(topics))})')
+        parameters.extend(topics)
+    if stream is not None:
+        conditions.append('files.stream = ?')
+        parameters.append(stream)
+    if start is not None:
+        conditions.append(f'{time_table}.max_timestamp >= ?')
+        parameters.append(to_microseconds(start))
+    if end is not None:
+        conditions.append(f'{time_table}.min_timestamp < ?')
+        parameters.append(to_microseconds(end))
+    where = f' WHERE {" AND ".join(conditions)}' if conditions else ''
+    connection = open_catalog(data_folder)
+    try:
+        rows = connection.execute(
+            f'SELECT DISTINCT files.path, files.min_timestamp FROM {source}{where} ORDER BY files.min_timestamp',
+            parameters).fetchall()
+    finally:
+        connection.close()
+    return [pathlib.Path(data_folder, path) for path, _ in rows]
+
+
+def cataloged_spans(
+        data_folder: typing.Union[str, pathlib.Path],
+        stream: str) -> typing.Dict[str, typing.Tuple[int, int, typing.Set[str]]]:
+    """ relative path -> (min timestamp, max timestamp, topics), for the cataloged files of a stream. """
+    connection = open_catalog(data_folder)
+    try:
+        spans = {}
+        for path, min_timestamp, max_timestamp in connection.execute(
+                'SELECT path, min_timestamp, max_timestamp FROM files WHERE stream = ?', (stream,)):
+            spans[path] = (min_timestamp, max_timestamp, set())
+        for path, topic in connection.execute(
+                'SELECT files.path, file_topics.topic FROM files JOIN file_topics ON file_topics.file_id = files.id '
+                'WHERE files.stream = ?', (stream,)):
+            spans[path][2].add(topic)
+        return spans
+    finally:
+        connection.close()
+
+
+def rebuild(data_folder: typing.Union[str, pathlib.Path]) -> int:
+    """ scan every stream folder of the data folder, and catalog all the log files found. Returns the file count. """
+    data_folder = pathlib.Path(data_folder)
+    connection = open_catalog(data_folder)
+    file_count = 0
+    try:
+        with connection:
+            connection.execute('DELETE FROM file_topics')
+            connection.execute('DELETE FROM files')
+        for stream_folder in sorted(path for path in data_folder.iterdir() if path.is_dir()):
+            for _, path in list_stream_files(stream_folder):
+                try:
+                    register_file(connection, data_folder, stream_folder.name, path)
+                    file_count += 1
+                except sqlite3.Error as ex:
+                    stdout(f'catalog | skipping {path}: {ex}')
+    finally:
+        connection.close()
+    return file_count
+
+
+def data_folder_from_arguments(args) -> str:
+    if args.data_folder is not None:
+        return args.data_folder
+    with open(args.config, 'r') as stream:
+        return os.path.abspath(yaml.safe_load(stream)['data-folder'])
+
+
+def main(argv: typing.Optional[typing.List[str]] = None):
+    parser = argparse.ArgumentParser(prog='attic catalog', description='the catalog of sealed log files')
+    parser.add_argument('command', choices=['rebuild', 'find'])
+    parser.add_argument('--config', type=str, default='config/config.yaml',
+                        help='fully qualified path to the configuration file, yaml format; gives the data folder')
+    parser.add_argument('--data-folder', type=str, default=None, help='data folder, instead of the one in --config')
+    parser.add_argument('--stream', type=str, default=None, help='find: stream folder name')
+    parser.add_argument('--topic', type=str, action='append', default=None, help='find: topic, can be repeated')
+    parser.add_argument('--start', type=str, default=None, help='find: start time, ISO 8601')
+    parser.add_argument('--end', type=str, default=None, help='find: end time, ISO 8601')
+    args = parser.parse_args(argv)
+    data_folder = data_folder_from_arguments(args)
+
+    if args.command == 'rebuild':
+        started = time.time()
+        file_count = rebuild(data_folder)
+        stdout(f'cataloged {file_count} files in {time.time() - started:0.1f} s, into {catalog_path(data_folder)}')
+    else:
+        import datetime
+        start = None if args.start is None else datetime.datetime.fromisoformat(args.start)
+        end = None if args.end is None else datetime.datetime.fromisoformat(args.end)
+        for path in find_files(data_folder, args.stream, start, end, args.topic):
+            stdout(path)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+import argparse
+import datetime
+import heapq
+import os
+import pathlib
+import sqlite3
+import time
+import typing
+
+import yaml
+
+from .catalog import catalog_path, open_catalog, register_file, unregister_file
+from .compression import PayloadDecoder, is_compressed
+from .dedup import payload_source
+from .reader import file_start_microseconds, list_folder_files, shard_folders, to_microseconds
+from .rollup import merge_rollup_tables
+from .safetimestring import timefolders
+from .schemas import merge_typed_tables
+from .storage import LogFile, resolve_storage_profile
+
+stdout = print
+
+# Offline compaction: merge the rotated files of a stream, for one day or one hour, into one file.
+#
+#   attic compact --config config/config.yaml --stream everything --day 2024-03-01 [--hour 13] [--parquet]
+#
+# * the rows are written sorted by (topic, reception_timestamp);
+#   the compacted file gets an index on reception_timestamp too, so that the reader still reads it in time order.
+# * the data is streamed through: for each topic, the rows of all the files are merged on reception_timestamp.
+# * the compacted file takes the name of the first file it replaces, so that the folder layout stays the same.
+# * the row counts are verified before the originals are removed.
+# * with --parquet, the same rows are also written to a .parquet file next to it, with a row group per topic.
+# * the rollup tables and the typed tables of the schemas are carried over into the compacted file.
+#
+# The two newest files of a stream are never compacted, as the logger may still be writing to them.
+# A sharded stream is compacted shard by shard: each shard folder keeps its own sequence of files.
+
+PARQUET_MAX_ROW_GROUP_ROWS = 1_000_000
+
+
+class SourceFile:
+    """ one of the files to compact, read topic by topic. """
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self.connection = sqlite3.connect(f'file:{path.as_posix()}?mode=ro', uri=True)
+        self.schema_version = max(self.connection.execute('PRAGMA user_version').fetchone()[0], 1)
+        self.decoder = PayloadDecoder(self.connection)
+        if self.schema_version == 1:
+            # topic -> key used in the query
+            self.topic_keys = {topic: topic for (topic,) in self.connection.execute('SELECT DISTINCT topic FROM data')}
+            self.query = 'SELECT reception_timestamp, payload, NULL FROM data WHERE topic = ? ORDER BY rowid'
+            self.row_count = self.connection.execute('SELECT count(*) FROM data').fetchone()[0]
+        else:
+            self.topic_keys = {name: topic_id for topic_id, name in self.connection.execute('SELECT id, name FROM topics')}
+            dictionary_column = 'dictionary_id' if is_compressed(self.connection) else 'NULL'
+            payload_column, blobs_join = payload_source(self.connection)
+            self.query = (f'SELECT records.reception_timestamp, {payload_column}, {dictionary_column} '
+                          f'FROM records{blobs_join} WHERE records.topic_id = ? ORDER BY records.rowid')
+            self.row_count = self.connection.execute('SELECT count(*) FROM records').fetchone()[0]
+
+    def rows(self, topic: str, fetch_size: int = 4096) -> typing.Iterator[typing.Tuple[int, bytes]]:
+        if topic not in self.topic_keys:
+            return
+        cursor = self.connection.execute(self.query, (self.topic_keys[topic],))
+        decode = self.decoder.decode
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                return
+            for reception_timestamp, payload, dictionary_id in rows:
+                yield reception_timestamp, decode(payload, dictionary_id)
+
+    def close(self):
+        self.connection.close()
+
+
+def select_files_to_compact(
+        stream_path: pathlib.Path,
+        day: datetime.date,
+        hour: typing.Optional[int] = None) -> typing.List[pathlib.Path]:
+    start = datetime.datetime(day.year, day.month, day.day, hour or 0, tzinfo=datetime.timezone.utc)
+    end = start + (datetime.timedelta(hours=1) if hour is not None else datetime.timedelta(days=1))
+    start_us, end_us = to_microseconds(start), to_microseconds(end)
+    files = list_folder_files(stream_path)
+    in_use = {path for _, path in files[-2:]}
+    return [path for file_start, path in files
+            if start_us <= file_start < end_us and path not in in_use]
+
+
+def write_parquet(rows: typing.Iterator[typing.Tuple[int, str, bytes]], path: pathlib.Path) -> int:
+    """ write (reception_timestamp, topic, payload) rows, sorted by topic, with one row group per topic. """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    schema = pa.schema([('reception_timestamp', pa.int64()), ('topic', pa.string()), ('payload', pa.binary())])
+    row_count = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        group = []
+        group_topic = None
+
+        def flush():
+            timestamps, topics, payloads = zip(*group)
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(timestamps, type=pa.int64()), pa.array(topics, type=pa.string()),
+                 pa.array(payloads, type=pa.binary())], schema=schema), row_group_size=len(group))
+
+        for row in rows:
+            if group and (row[1] != group_topic or len(group) >= PARQUET_MAX_ROW_GROUP_ROWS):
+                flush()
+                group = []
+            group_topic = row[1]
+            group.append(row)
+            row_count += 1
+        if group:
+            flush()
+    return row_count
+
+
+def merged_rows(sources: typing.List[SourceFile]) -> typing.Iterator[typing.Tuple[int, str, bytes]]:
+    """ the rows of all sources, sorted by (topic, reception_timestamp). """
+    topics = sorted(set().union(*(source.topic_keys for source in sources)))
+    for topic in topics:
+        for reception_timestamp, payload in heapq.merge(*(source.rows(topic) for source in sources),
+                                                        key=lambda row: row[0]):
+            yield reception_timestamp, topic, payload
+
+
+def compact_files(
+        paths: typing.List[pathlib.Path],
+        profile: dict,
+        parquet: bool = False,
+        batch_size: int = 10000) -> pathlib.Path:
+    """
+    merge the files into one, verify, and replace the originals with it. Returns the path of the compacted file.
+    """
+    paths = sorted(paths, key=file_start_microseconds)
+    target = paths[0]
+    temporary = target.with_suffix('.compacting')
+    temporary.unlink(missing_ok=True)
+    sources = [SourceFile(path) for path in paths]
+    try:
+        expected_rows = sum(source.row_count for source in sources)
+        output = LogFile(temporary, profile)
+        written_rows = 0
+        batch = []
+        for row in merged_rows(sources):
+            batch.append(row)
+            if len(batch) >= batch_size:
+                output.insert_many(batch)
+                written_rows += len(batch)
+                batch = []
+        if batch:
+            output.insert_many(batch)
+            written_rows += len(batch)
+        merge_rollup_tables((source.connection for source in sources), output.connection)
+        merge_typed_tables((source.connection for source in sources), output.connection)
+        output.seal()
+
+        parquet_path = target.with_suffix('.parquet')
+        if parquet:
+            parquet_rows = write_parquet(merged_rows(sources), parquet_path)
+        else:
+            parquet_rows = expected_rows
+    finally:
+        for source in sources:
+            source.close()
+
+    connection = sqlite3.connect(temporary)
+    try:
+        # so that the reader can still read the file in time order
+        table = 'data' if profile['schema-version'] == 1 else 'records'
+        connection.execute(f'CREATE INDEX IF NOT EXISTS {table}_reception_timestamp ON {table} (reception_timestamp)')
+        connection.commit()
+        stored_rows = connection.execute(f'SELECT count(*) FROM {table}').fetchone()[0]
+    finally:
+        connection.close()
+    if not (expected_rows == written_rows == stored_rows == parquet_rows):
+        temporary.unlink(missing_ok=True)
+        if parquet:
+            parquet_path.unlink(missing_ok=True)
+        raise RuntimeError(f'compaction of {len(paths)} files into {target} failed: '
+                           f'{expected_rows=} {written_rows=} {stored_rows=} {parquet_rows=}, originals kept.')
+
+    # the compacted file atomically takes the place of the first original; then the other originals go.
+    # if interrupted in between, some rows are in two files, but none is lost.
+    os.replace(temporary, target)
+    for path in paths[1:]:
+        path.unlink()
+    return target
+
+
+def compact_stream(
+        data_folder: pathlib.Path,
+        stream: str,
+        day: datetime.date,
+        hour: typing.Optional[int],
+        profile: dict,
+        parquet: bool = False,
+        shard: typing.Optional[str] = None) -> typing.Optional[pathlib.Path]:
+    """ compact the files of a stream, or, with `shard`, of that shard folder of it. """
+    stream_path = data_folder.joinpath(stream)
+    name = stream
+    if shard is not None:
+        stream_path = stream_path.joinpath(shard)
+        name = f'{stream}/{shard}'
+    paths = select_files_to_compact(stream_path, day, hour)
+    if len(paths) < 2:
+        stdout(f'compact | {name}: {len(paths)} files to compact, nothing to do.')
+        return None
+    stdout(f'compact | {name}: compacting {len(paths)} files ...')
+    started = time.time()
+    target = compact_files(paths, profile, parquet=parquet)
+    stdout(f'compact | {name}: done in {time.time() - started:0.1f} s, into {target}')
+    if catalog_path(data_folder).exists():
+        connection = open_catalog(data_folder)
+        try:
+            with connection:
+                for path in paths:
+                    unregister_file(connection, path.relative_to(data_folder).as_posix())
+            register_file(connection, data_folder, stream, target)
+        finally:
+            connection.close()
+    return target
+
+
+def main(argv: typing.Optional[typing.List[str]] = None):
+    parser = argparse.ArgumentParser(prog='attic compact',
+                                     description='merge the rotated files of a day, or an hour, into one file')
+    parser.add_argument('--config', type=str, default='config/config.yaml',
+                        help='fully qualified path to the configuration file, yaml format')
+    parser.add_argument('--data-folder', type=str, default=None, help='data folder, instead of the one in --config')
+    parser.add_argument('--stream', type=str, action='append', default=None,
+                        help='stream folder name, can be repeated; default: all streams in the data folder')
+    parser.add_argument('--day', type=str, required=True, help='UTC day to compact, YYYY-MM-DD')
+    parser.add_argument('--hour', type=int, default=None, help='compact only the files created in this UTC hour')
+    parser.add_argument('--storage-profile', type=str, default='max-throughput',
+                        help='storage profile of the compacted file')
+    parser.add_argument('--parquet', action='store_true', help='also write the compacted data as parquet')
+    args = parser.parse_args(argv)
+
+    config = {}
+    if os.path.exists(args.config):
+        with open(args.config, 'r') as stream:
+            config = yaml.safe_load(stream)
+    data_folder = pathlib.Path(os.path.abspath(args.data_folder or config['data-folder']))
+    profile = resolve_storage_profile(args.storage_profile, config.get('storage-profiles'))
+    day = datetime.date.fromisoformat(args.day)
+    streams = args.stream or sorted(path.name for path in data_folder.iterdir()
+                                    if path.is_dir() and any(timefolders(folder, datetime.datetime(
+                                        day.year, day.month, day.day)).exists() for folder in shard_folders(path)))
+    for stream in streams:
+        stream_path = data_folder.joinpath(stream)
+        for folder in shard_folders(stream_path):
+            compact_stream(data_folder, stream, day, args.hour, profile, parquet=args.parquet,
+                           shard=None if folder == stream_path else folder.name)
+
+
+if __name__ == '__main__':
+    main()
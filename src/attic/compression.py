@@ -0,0 +1,122 @@
+import sqlite3
+import typing
+
+# optional dependency: only needed when a storage profile enables compression, or to read compressed files.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+stdout = print
+
+COMPRESSION_MODES = (None, 'zstd')
+DICTIONARY_MODES = ('topic', 'stream')
+
+
+def require_zstandard():
+    if zstandard is None:
+        raise RuntimeError('payload compression needs the zstandard package: pip install zstandard')
+
+
+class PayloadCompressor:
+    """
+    Compresses the payloads of one log file with zstd dictionaries that are stored in that same file.
+
+    A dictionary is trained per topic (or, with `compression-dictionary: stream`, one for the whole file)
+    from the first `compression-train-messages` payloads. Those first payloads are stored as they are.
+    A payload is stored compressed only if that makes it smaller.
+    If a dictionary can not be trained (e.g. the payloads are too few or too small), the payloads stay uncompressed.
+
+    The rows refer to the dictionary in `records.dictionary_id`; NULL means the payload is stored as-is.
+    """
+
+    def __init__(self, connection: sqlite3.Connection, profile: dict):
+        require_zstandard()
+        self.connection = connection
+        self.level = profile['compression-level']
+        self.per_topic = profile['compression-dictionary'] == 'topic'
+        self.train_messages = profile['compression-train-messages']
+        self.dictionary_bytes = profile['compression-dictionary-bytes']
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS dictionaries (id INTEGER PRIMARY KEY, topic_id INTEGER, dictionary BLOB)')
+        # key (topic id, or 0 for the whole file) -> (dictionary id, compressor); (None, None) if training failed.
+        self.compressors = {}
+        # key -> payloads collected for training
+        self.samples = {}
+
+    def encode(self, topic_id: int, payload: bytes) -> typing.Tuple[bytes, typing.Optional[int]]:
+        key = topic_id if self.per_topic else 0
+        entry = self.compressors.get(key)
+        if entry is None:
+            samples = self.samples.setdefault(key, [])
+            samples.append(payload)
+            if len(samples) >= self.train_messages:
+                self.train(key)
+            return payload, None
+        dictionary_id, compressor = entry
+        if compressor is None:
+            return payload, None
+        compressed = compressor.compress(payload)
+        if len(compressed) < len(payload):
+            return compressed, dictionary_id
+        return payload, None
+
+    def train(self, key: int):
+        samples = self.samples.pop(key)
+        try:
+            dictionary = zstandard.train_dictionary(self.dictionary_bytes, samples)
+        except zstandard.ZstdError as ex:
+            stdout(f'compression | could not train a dictionary for topic id {key}: {ex}, storing uncompressed.')
+            self.compressors[key] = (None, None)
+            return
+        dictionary_id = self.connection.execute(
+            'INSERT INTO dictionaries (topic_id, dictionary) VALUES (?, ?)',
+            (key if self.per_topic else None, dictionary.as_bytes())).lastrowid
+        compressor = zstandard.ZstdCompressor(
+            level=self.level, dict_data=dictionary, write_checksum=False, write_dict_id=False)
+        self.compressors[key] = (dictionary_id, compressor)
+
+
+def is_compressed(connection: sqlite3.Connection) -> bool:
+    return bool(connection.execute(
+        "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'dictionaries'").fetchone()[0])
+
+
+class PayloadDecoder:
+    """
+    Restores the original payloads of a log file written with compression.
+
+        decoder = PayloadDecoder(connection)
+        for reception_timestamp, topic, payload, dictionary_id in connection.execute(
+                'SELECT records.reception_timestamp, topics.name, records.payload, records.dictionary_id '
+                'FROM records JOIN topics ON topics.id = records.topic_id'):
+            payload = decoder.decode(payload, dictionary_id)
+
+    For files without compression, `decode` returns the payload unchanged.
+    """
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.decompressors = {}
+        if is_compressed(connection):
+            require_zstandard()
+            for dictionary_id, dictionary in connection.execute('SELECT id, dictionary FROM dictionaries'):
+                self.decompressors[dictionary_id] = zstandard.ZstdDecompressor(
+                    dict_data=zstandard.ZstdCompressionDict(dictionary))
+
+    def decode(self, payload: bytes, dictionary_id: typing.Optional[int]) -> bytes:
+        if dictionary_id is None:
+            return payload
+        return self.decompressors[dictionary_id].decompress(payload)
+
+
+def read_data(connection: sqlite3.Connection) -> typing.Iterator[typing.Tuple[int, str, bytes]]:
+    """ all rows of a log file, as (reception_timestamp, topic, payload), with the original payloads. """
+    if not is_compressed(connection):
+        yield from connection.execute('SELECT reception_timestamp, topic, payload FROM data')
+        return
+    # a compressed file has no data view, see storage.SCHEMA_VERSIONS
+    decoder = PayloadDecoder(connection)
+    for reception_timestamp, topic, payload, dictionary_id in connection.execute(
+            'SELECT records.reception_timestamp, topics.name, records.payload, records.dictionary_id '
+            'FROM records JOIN topics ON topics.id = records.topic_id'):
+        yield reception_timestamp, topic, decoder.decode(payload, dictionary_id)
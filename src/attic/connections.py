@@ -0,0 +1,197 @@
+import typing
+
+import paho.mqtt.client as mqtt
+
+stdout = print
+
+# Shared broker connections: the streams that use the same broker, with the same credentials, share one mqtt client.
+# By default, only the streams with a writer stage (writer-thread, spool or shards) share it;
+# `share-connections: true` shares it between all of them, `false` between none. See attic.shares_connection.
+#
+# * the connection subscribes once to each topic filter of its streams, leaving out the filters that another one
+#   covers ("sensors/+/temperature" is covered by "sensors/#"), so that the broker sends each message once.
+# * a message is dispatched to the on_message callback of every stream whose filter matches its topic,
+#   from a trie of the filters; the result is cached per topic.
+# * the streams of a connection are called one after the other, from its one network thread: a stream that
+#   writes in the callback delays the others, hence the default above.
+# * the performance messages go through the connection of the same broker and credentials, if there is one.
+
+# the topic -> callbacks cache is cleared when it grows past this, in case the topics never repeat
+DISPATCH_CACHE_SIZE = 65536
+
+
+def broker_key(broker_config: dict) -> tuple:
+    """ what identifies a connection: the broker address and port, and the credentials """
+    return (broker_config['mqtt-broker-address'], broker_config['mqtt-broker-port'],
+            broker_config.get('user', ''), broker_config.get('password', ''))
+
+
+def filter_covers(general: str, specific: str) -> bool:
+    """ whether every topic that matches the filter `specific` also matches the filter `general` """
+    general_levels = general.split('/')
+    specific_levels = specific.split('/')
+    if specific_levels[0].startswith('$') and general_levels[0] in ('+', '#'):
+        # wildcards at the first level do not match the $SYS topics
+        return False
+    for index, level in enumerate(general_levels):
+        if level == '#':
+            # "a/#" also matches "a"
+            return True
+        if index >= len(specific_levels):
+            return False
+        if level == '+':
+            if specific_levels[index] == '#':
+                return False
+        elif level != specific_levels[index]:
+            return False
+    return len(general_levels) == len(specific_levels)
+
+
+def filters_overlap(first: str, second: str) -> bool:
+    """ whether some topic matches both filters """
+    first_levels = first.split('/')
+    second_levels = second.split('/')
+    for first_level, second_level in zip(first_levels, second_levels):
+        if first_level == '#' or second_level == '#':
+            return True
+        if first_level != second_level and '+' not in (first_level, second_level):
+            return False
+    if len(first_levels) == len(second_levels):
+        return True
+    # "a/#" also matches "a"
+    longer = first_levels if len(first_levels) > len(second_levels) else second_levels
+    return len(longer) == min(len(first_levels), len(second_levels)) + 1 and longer[-1] == '#'
+
+
+def covering_filters(topic_filters: typing.Iterable[str]) -> typing.List[str]:
+    """ the distinct filters, without those covered by another one; in the order given """
+    distinct = list(dict.fromkeys(topic_filters))
+    return [topic_filter for topic_filter in distinct
+            if not any(other != topic_filter and filter_covers(other, topic_filter) for other in distinct)]
+
+
+class TrieNode:
+    __slots__ = ('children', 'values', 'multi_level_values')
+
+    def __init__(self):
+        self.children: typing.Dict[str, 'TrieNode'] = {}
+        # the values of the filters that end here
+        self.values = []
+        # the values of the filters that end here with "/#"
+        self.multi_level_values = []
+
+
+class TopicTrie:
+    """
+    Topic filters, with `+` and `#` wildcards, by level:
+
+        trie.add('sensors/+/temperature', a)
+        trie.add('sensors/#', b)
+        trie.match('sensors/1/temperature')  # [a, b]
+
+    `match` returns the values in the order they were added.
+    """
+
+    def __init__(self):
+        self.root = TrieNode()
+        self.order: typing.Dict[int, int] = {}
+
+    def add(self, topic_filter: str, value):
+        node = self.root
+        levels = topic_filter.split('/')
+        for index, level in enumerate(levels):
+            if level == '#':
+                node.multi_level_values.append(value)
+                break
+            node = node.children.setdefault(level, TrieNode())
+        else:
+            node.values.append(value)
+        self.order.setdefault(id(value), len(self.order))
+
+    def match(self, topic: str) -> list:
+        levels = topic.split('/')
+        matched = []
+        nodes = [self.root]
+        for index, level in enumerate(levels):
+            next_nodes = []
+            for node in nodes:
+                if index > 0 or not level.startswith('$'):
+                    matched.extend(node.multi_level_values)
+                    wildcard = node.children.get('+')
+                    if wildcard is not None:
+                        next_nodes.append(wildcard)
+                child = node.children.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+            nodes = next_nodes
+            if not nodes:
+                break
+        else:
+            for node in nodes:
+                matched.extend(node.values)
+                matched.extend(node.multi_level_values)
+        # once each, in the order added
+        return sorted({id(value): value for value in matched}.values(), key=lambda value: self.order[id(value)])
+
+
+class BrokerConnection:
+    """ one mqtt client, shared by the streams of one broker and credential set; see the top of this module. """
+
+    def __init__(self, key: tuple):
+        self.key = key
+        self.address, self.port, self.user, self.password = key
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        if self.user != '':
+            self.client.username_pw_set(self.user, self.password)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.topic_filters: typing.List[str] = []
+        self.callbacks = []
+        self.trie = TopicTrie()
+        # topic -> the callbacks of the streams it goes to
+        self.routes: typing.Dict[str, list] = {}
+
+    def add(self, topic_filter: str, on_message: typing.Callable):
+        self.topic_filters.append(topic_filter)
+        self.callbacks.append(on_message)
+        self.trie.add(topic_filter, on_message)
+        self.routes = {}
+
+    def subscriptions(self) -> typing.List[str]:
+        return covering_filters(self.topic_filters)
+
+    def on_connect(self, client, userdata, flags, reason_code, properties):
+        if reason_code == 5:
+            stdout('mqtt broker rejected connection. This is probably because the username and password are incorrect.')
+            stdout('continue...')
+            return
+        stdout(f'connected to mqtt broker {self.address}:{self.port} with result code {reason_code} '
+               f'and flags {flags}, for {len(self.callbacks)} streams |', end='')
+        for topic_filter in self.subscriptions():
+            client.subscribe(topic_filter)
+            stdout(f'| subscribed to {topic_filter} |', end='')
+        stdout()
+
+    def on_disconnect(self, client, userdata, flags, reason_code, properties):
+        stdout(f'disconnected from mqtt broker {self.address}:{self.port} with reason code {reason_code} '
+               f'and flags {flags}')
+
+    def on_message(self, client, userdata, msg):
+        callbacks = self.routes.get(msg.topic)
+        if callbacks is None:
+            if len(self.routes) >= DISPATCH_CACHE_SIZE:
+                self.routes = {}
+            callbacks = self.routes[msg.topic] = self.trie.match(msg.topic)
+        for callback in callbacks:
+            callback(client, userdata, msg)
+
+    def start(self):
+        """ connect, and start the network thread """
+        if len(self.callbacks) == 1:
+            # a connection of its own: no dispatch needed
+            self.client.on_message = self.callbacks[0]
+        else:
+            self.client.on_message = self.on_message
+        self.client.connect(self.address, self.port, 10)
+        # ! This starts the mqtt client in a separate thread.
+        self.client.loop_start()
@@ -0,0 +1,79 @@
+import collections
+import hashlib
+import sqlite3
+import typing
+
+stdout = print
+
+# Payload deduplication, with `dedup: true` in a storage profile. Needs schema version 2, and no compression.
+#
+# Many devices republish the same payload: heartbeats, retained status, unchanged readings.
+# A payload of at least `dedup-min-bytes` is hashed, and stored once per file, in `blobs (id, hash, payload)`;
+# the row refers to it in `records.blob_id`, with a NULL `records.payload`.
+# Smaller payloads are stored in the row as usual, with a NULL `records.blob_id`:
+# a reference would not be smaller than them.
+#
+# The `data` view joins the blobs back in, so that it still returns the full payloads.
+#
+# The hash is a 128 bit blake2b digest of the payload. The last `dedup-cache-entries` hashes seen are kept in memory,
+# so that a repeated payload is resolved without a query; older ones are looked up in the UNIQUE index of `blobs`.
+
+DIGEST_BYTES = 16
+
+
+def is_deduplicated(connection: sqlite3.Connection) -> bool:
+    return bool(connection.execute(
+        "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'blobs'").fetchone()[0])
+
+
+def payload_source(connection: sqlite3.Connection) -> typing.Tuple[str, str]:
+    """
+    for the queries on `records` of a schema 2 file: the payload column, and the join that it needs.
+    The full payload in both cases, also for a file written with deduplication.
+    """
+    if is_deduplicated(connection):
+        return 'ifnull(records.payload, blobs.payload)', ' LEFT JOIN blobs ON blobs.id = records.blob_id'
+    return 'records.payload', ''
+
+
+class PayloadDeduplicator:
+    """
+    Stores each distinct payload of one log file once, in its `blobs` table.
+
+    `encode` returns what goes into the (payload, blob_id) columns of the row:
+    (payload, None) for a payload stored in the row, (None, blob id) for a deduplicated one.
+    """
+
+    def __init__(self, connection: sqlite3.Connection, profile: dict):
+        self.connection = connection
+        self.min_bytes = profile['dedup-min-bytes']
+        self.cache_entries = profile['dedup-cache-entries']
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS blobs (id INTEGER PRIMARY KEY, hash BLOB NOT NULL UNIQUE, payload BLOB)')
+        # hash -> blob id, the most recently used last
+        self.recent: typing.OrderedDict[bytes, int] = collections.OrderedDict()
+        # statistics
+        self.blob_count = 0
+        self.reference_count = 0
+
+    def encode(self, payload: bytes) -> typing.Tuple[typing.Optional[bytes], typing.Optional[int]]:
+        if len(payload) < self.min_bytes:
+            return payload, None
+        digest = hashlib.blake2b(payload, digest_size=DIGEST_BYTES).digest()
+        recent = self.recent
+        blob_id = recent.get(digest)
+        if blob_id is not None:
+            recent.move_to_end(digest)
+        else:
+            row = self.connection.execute('SELECT id FROM blobs WHERE hash = ?', (digest,)).fetchone()
+            if row is not None:
+                blob_id = row[0]
+            else:
+                blob_id = self.connection.execute(
+                    'INSERT INTO blobs (hash, payload) VALUES (?, ?)', (digest, payload)).lastrowid
+                self.blob_count += 1
+            recent[digest] = blob_id
+            if len(recent) > self.cache_entries:
+                recent.popitem(last=False)
+        self.reference_count += 1
+        return None, blob_id
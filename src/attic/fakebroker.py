@@ -0,0 +1,214 @@
+import socket
+import struct
+import threading
+import typing
+
+from paho.mqtt.client import topic_matches_sub
+
+from .mqttpacket import (CONNECT, DISCONNECT, PINGREQ, PUBLISH, PUBREL, SUBSCRIBE, UNSUBSCRIBE,
+                         encode_remaining_length, publish_packet)
+
+stdout = print
+
+# A minimal MQTT 3.1.1 broker, for benchmarks and tests on localhost. Not for production.
+#
+#   broker = FakeBroker()          # port 0: any free port
+#   broker.start()
+#   ... connect clients to ('127.0.0.1', broker.port) ...
+#   broker.publish_many([('sensors/1', b'payload'), ...])   # inject messages, as if a client had published them
+#   broker.stop()
+#
+# * CONNECT, SUBSCRIBE, UNSUBSCRIBE, PUBLISH (QoS 0, 1 and 2 in, always QoS 0 out), PINGREQ, DISCONNECT
+# * subscriptions with `+` and `#` wildcards; no retained messages, no sessions, no authentication
+# * one thread per connection; the messages to a slow subscriber wait for its socket, which pushes back to
+#   the publisher, as TCP would.
+
+class Connection:
+    """ one connected client: its socket, and its subscriptions. """
+
+    def __init__(self, broker: 'FakeBroker', sock: socket.socket):
+        self.broker = broker
+        self.sock = sock
+        self.reader = sock.makefile('rb')
+        self.send_lock = threading.Lock()
+        self.subscriptions: typing.List[str] = []
+        self.closed = False
+
+    def send(self, data: bytes):
+        with self.send_lock:
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.broker.remove(self)
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+    def read_packet(self) -> typing.Optional[typing.Tuple[int, int, bytes]]:
+        """ (packet type, flags, body), or None when the connection is closed. """
+        header = self.reader.read(1)
+        if not header:
+            return None
+        length = 0
+        multiplier = 1
+        while True:
+            byte = self.reader.read(1)
+            if not byte:
+                return None
+            length += (byte[0] & 0x7f) * multiplier
+            multiplier *= 128
+            if not byte[0] & 0x80:
+                break
+        body = self.reader.read(length)
+        if len(body) < length:
+            return None
+        return header[0] >> 4, header[0] & 0x0f, body
+
+    def serve(self):
+        try:
+            while not self.closed:
+                packet = self.read_packet()
+                if packet is None:
+                    break
+                self.handle(*packet)
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.close()
+
+    def handle(self, packet_type: int, flags: int, body: bytes):
+        if packet_type == CONNECT:
+            self.send(b'\x20\x02\x00\x00')
+        elif packet_type == PUBLISH:
+            qos = (flags >> 1) & 0x03
+            topic_length = struct.unpack_from('!H', body)[0]
+            topic = body[2:2 + topic_length].decode()
+            offset = 2 + topic_length
+            if qos:
+                packet_id = body[offset:offset + 2]
+                offset += 2
+                self.send((b'\x40\x02' if qos == 1 else b'\x50\x02') + packet_id)
+            self.broker.publish_many([(topic, body[offset:])])
+        elif packet_type == PUBREL:
+            self.send(b'\x70\x02' + body[:2])
+        elif packet_type == SUBSCRIBE:
+            packet_id = body[:2]
+            offset = 2
+            granted = bytearray()
+            while offset < len(body):
+                topic_length = struct.unpack_from('!H', body, offset)[0]
+                self.subscriptions.append(body[offset + 2:offset + 2 + topic_length].decode())
+                offset += 3 + topic_length
+                granted.append(0)
+            self.broker.subscriptions_changed()
+            self.send(b'\x90' + encode_remaining_length(2 + len(granted)) + packet_id + bytes(granted))
+        elif packet_type == UNSUBSCRIBE:
+            packet_id = body[:2]
+            offset = 2
+            while offset < len(body):
+                topic_length = struct.unpack_from('!H', body, offset)[0]
+                topic_filter = body[offset + 2:offset + 2 + topic_length].decode()
+                if topic_filter in self.subscriptions:
+                    self.subscriptions.remove(topic_filter)
+                offset += 2 + topic_length
+            self.broker.subscriptions_changed()
+            self.send(b'\xb0\x02' + packet_id)
+        elif packet_type == PINGREQ:
+            self.send(b'\xd0\x00')
+        elif packet_type == DISCONNECT:
+            self.close()
+
+
+class FakeBroker:
+    """ see the top of this module. """
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 0):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(128)
+        self.host = host
+        self.port = self.server.getsockname()[1]
+        self.lock = threading.Lock()
+        self.connections: typing.List[Connection] = []
+        # topic -> the connections subscribed to it; cleared whenever a subscription changes
+        self.routes: typing.Dict[str, typing.List[Connection]] = {}
+        self.received_count = 0
+        self.running = False
+        self.thread = threading.Thread(target=self.accept, name='attic-fakebroker', daemon=True)
+
+    def start(self) -> 'FakeBroker':
+        self.running = True
+        self.thread.start()
+        return self
+
+    def accept(self):
+        while self.running:
+            try:
+                sock, _ = self.server.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            connection = Connection(self, sock)
+            with self.lock:
+                self.connections.append(connection)
+            threading.Thread(target=connection.serve, name='attic-fakebroker-connection', daemon=True).start()
+
+    def remove(self, connection: Connection):
+        with self.lock:
+            if connection in self.connections:
+                self.connections.remove(connection)
+            self.routes = {}
+
+    def subscriptions_changed(self):
+        with self.lock:
+            self.routes = {}
+
+    def subscription_count(self) -> int:
+        with self.lock:
+            return sum(len(connection.subscriptions) for connection in self.connections)
+
+    def subscribers(self, topic: str) -> typing.List[Connection]:
+        routes = self.routes
+        subscribers = routes.get(topic)
+        if subscribers is None:
+            with self.lock:
+                subscribers = [connection for connection in self.connections
+                               if any(topic_matches_sub(topic_filter, topic)
+                                      for topic_filter in connection.subscriptions)]
+                self.routes[topic] = subscribers
+        return subscribers
+
+    def publish_many(self, messages: typing.Iterable[typing.Tuple[str, bytes]]):
+        """ deliver the messages to their subscribers, with one write per subscriber. """
+        outgoing: typing.Dict[Connection, typing.List[bytes]] = {}
+        count = 0
+        for topic, payload in messages:
+            count += 1
+            subscribers = self.subscribers(topic)
+            if subscribers:
+                packet = publish_packet(topic, payload)
+                for connection in subscribers:
+                    outgoing.setdefault(connection, []).append(packet)
+        with self.lock:
+            self.received_count += count
+        for connection, packets in outgoing.items():
+            connection.send(b''.join(packets))
+
+    def stop(self):
+        self.running = False
+        try:
+            self.server.close()
+        except OSError:
+            pass
+        with self.lock:
+            connections = list(self.connections)
+        for connection in connections:
+            connection.close()
@@ -0,0 +1,239 @@
+import bisect
+import http.server
+import threading
+import typing
+
+stdout = print
+
+# Fixed-bucket histograms of the hot path, per stream, cheap enough to stay on in production:
+# recording a value is one bisect over a short tuple and three updates, with no lock and no allocation.
+#
+# * the histograms are cumulative, as Prometheus expects; `/metrics` serves them in the text exposition format,
+#   when `metrics-port` is set in the configuration.
+# * the performance message summarizes, per stream, what was recorded since the previous message:
+#   count, p50, p99 and max_bound, all upper bounds of the buckets the values fall in.
+#   max_bound bounds the largest value of the interval: only the all-time max is kept, not one per interval.
+#
+# Recording is not locked: a reader may see a count that is one ahead of the sum, which does not matter here.
+
+# 1-2-5 series, from 1 microsecond to 10 seconds
+DURATION_BOUNDS = tuple(float(f'{mantissa}e{exponent}') for exponent in range(-6, 1) for mantissa in (1, 2, 5)) + (10.0,)
+# 1-2-5 series, from 1 millisecond to 10 minutes
+DELAY_BOUNDS = tuple(float(f'{mantissa}e{exponent}') for exponent in range(-3, 2) for mantissa in (1, 2, 5)) + (
+    100.0, 200.0, 300.0, 600.0)
+# 1-2-5 series, from 1 to 1 million
+DEPTH_BOUNDS = tuple(float(f'{mantissa}e{exponent}') for exponent in range(0, 6) for mantissa in (1, 2, 5)) + (1e6,)
+
+# name -> (help text, bucket bounds)
+HISTOGRAMS = {
+    'processing_seconds': ('time spent in on_message, for one message in 16', DURATION_BOUNDS),
+    'insert_seconds': ('time spent in the sqlite insert, for one message in 16, or per batch with the writer stage',
+                       DURATION_BOUNDS),
+    'commit_seconds': ('time spent in a commit of the writer stage', DURATION_BOUNDS),
+    'rotation_stall_seconds': ('time the ingest path waited for a rotation', DURATION_BOUNDS),
+    'seal_seconds': ('time spent sealing a rotated file, in the background', DURATION_BOUNDS),
+    'queue_depth': ('rows waiting for the writer stage, sampled per batch', DEPTH_BOUNDS),
+    'write_delay_seconds': ('time from reception to commit, of the oldest row of each commit', DELAY_BOUNDS),
+}
+
+
+class Histogram:
+    """ counts of values per bucket; bucket i counts the values <= bounds[i], the last one the rest. """
+    __slots__ = ('bounds', 'counts', 'sum', 'max')
+
+    def __init__(self, bounds: typing.Sequence[float]):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.max = 0.0
+
+    def record(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def values(self) -> typing.List[float]:
+        """ flat: the counts, the sum and the max; see `load`. """
+        return [*self.counts, self.sum, self.max]
+
+    def load(self, values: typing.Sequence[float]):
+        bucket_count = len(self.counts)
+        self.counts = [int(value) for value in values[:bucket_count]]
+        self.sum = float(values[bucket_count])
+        self.max = float(values[bucket_count + 1])
+
+    def merge(self, other: 'Histogram'):
+        """ add the values recorded by `other`, with the same bounds; e.g. by a previous worker of the stream. """
+        self.counts = [count + other_count for count, other_count in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.max = max(self.max, other.max)
+
+    def summary(self, previous_counts: typing.Optional[typing.Sequence[int]] = None) -> dict:
+        """
+        count, p50, p99 and max_bound of the values recorded since `previous_counts` (default: ever).
+        max_bound is the upper bound of the highest bucket with a value since then, or the all-time max if lower.
+        """
+        counts = list(self.counts)
+        if previous_counts is not None:
+            counts = [count - previous for count, previous in zip(counts, previous_counts)]
+        total = sum(counts)
+        if total <= 0:
+            return dict(count=0, p50=None, p99=None, max_bound=None)
+
+        def bucket_value(index: int) -> float:
+            # the upper bound of the bucket; the max, if that is lower, or if the bucket is the open-ended one
+            if index >= len(self.bounds):
+                return self.max
+            return min(self.bounds[index], self.max)
+
+        def percentile(fraction: float) -> float:
+            rank = fraction * total
+            cumulative = 0
+            for index, count in enumerate(counts):
+                cumulative += count
+                if cumulative >= rank:
+                    return bucket_value(index)
+            return self.max
+
+        top = max(index for index, count in enumerate(counts) if count > 0)
+        return dict(count=total, p50=percentile(0.50), p99=percentile(0.99), max_bound=bucket_value(top))
+
+
+class StreamMetrics:
+    """ the histograms of one stream, one attribute per entry of HISTOGRAMS. """
+
+    def __init__(self):
+        for name, (_, bounds) in HISTOGRAMS.items():
+            setattr(self, name, Histogram(bounds))
+
+    def histograms(self) -> typing.Dict[str, Histogram]:
+        return {name: getattr(self, name) for name in HISTOGRAMS}
+
+    def values(self) -> typing.List[float]:
+        return [value for histogram in self.histograms().values() for value in histogram.values()]
+
+    def load(self, values: typing.Sequence[float]) -> 'StreamMetrics':
+        offset = 0
+        for histogram in self.histograms().values():
+            size = len(histogram.counts) + 2
+            histogram.load(values[offset:offset + size])
+            offset += size
+        return self
+
+    def merge(self, other: 'StreamMetrics') -> 'StreamMetrics':
+        for name, histogram in self.histograms().items():
+            histogram.merge(getattr(other, name))
+        return self
+
+    def counts(self) -> typing.Dict[str, typing.List[int]]:
+        return {name: list(histogram.counts) for name, histogram in self.histograms().items()}
+
+    def summary(self, previous_counts: typing.Optional[typing.Dict[str, typing.List[int]]] = None) -> dict:
+        """ per histogram with new values since `previous_counts`: count, p50, p99 and max_bound. """
+        summary = {}
+        for name, histogram in self.histograms().items():
+            entry = histogram.summary(None if previous_counts is None else previous_counts.get(name))
+            if entry['count']:
+                summary[name] = entry
+        return summary
+
+
+# the number of doubles in StreamMetrics.values(), for shared memory
+METRICS_SIZE = len(StreamMetrics().values())
+
+
+def format_bound(bound: float) -> str:
+    return repr(float(bound))
+
+
+def render(streams: typing.List[typing.Tuple[str, dict]]) -> str:
+    """ the Prometheus text exposition of (stream name, stream snapshot) pairs. """
+    lines = []
+
+    def series(name: str, kind: str, help_text: str, value_of: typing.Callable[[dict], float]):
+        lines.append(f'# HELP attic_{name} {help_text}')
+        lines.append(f'# TYPE attic_{name} {kind}')
+        for stream, snapshot in streams:
+            value = value_of(snapshot)
+            if value is not None:
+                lines.append(f'attic_{name}{{stream="{stream}"}} {float(value)!r}')
+
+    series('messages_total', 'counter', 'messages received', lambda snapshot: snapshot['messageCount'])
+    series('connected', 'gauge', '1 if the mqtt client is connected',
+           lambda snapshot: 1.0 if snapshot['is_connected'] else 0.0)
+    series('rotations_total', 'counter', 'file rotations',
+           lambda snapshot: snapshot['details'].get('rotation_count'))
+    series('spool_fill_ratio', 'gauge', 'used fraction of the spool, for the streams with a spool',
+           lambda snapshot: snapshot['details'].get('spool_fill'))
+    series('spool_dropped_total', 'counter', 'messages dropped by the spool overflow policy',
+           lambda snapshot: snapshot['details'].get('spool_dropped'))
+    series('decoded_total', 'counter', 'messages decoded into the typed tables, for the streams with schemas',
+           lambda snapshot: snapshot['details'].get('decoded_count'))
+    series('undecodable_total', 'counter', 'messages of a schema topic stored raw, as they did not decode',
+           lambda snapshot: snapshot['details'].get('undecodable_count'))
+    series('last_message_timestamp_seconds', 'gauge', 'reception time of the last message',
+           lambda snapshot: None if snapshot['lastRxTimestamp_unix'] is None else snapshot['lastRxTimestamp_unix'] / 1e6)
+
+    for name, (help_text, bounds) in HISTOGRAMS.items():
+        lines.append(f'# HELP attic_{name} {help_text}')
+        lines.append(f'# TYPE attic_{name} histogram')
+        for stream, snapshot in streams:
+            metrics = snapshot.get('metrics')
+            if metrics is None:
+                continue
+            histogram = getattr(metrics, name)
+            cumulative = 0
+            for bound, count in zip(bounds, histogram.counts):
+                cumulative += count
+                lines.append(f'attic_{name}_bucket{{stream="{stream}",le="{format_bound(bound)}"}} {cumulative}')
+            cumulative += histogram.counts[-1]
+            lines.append(f'attic_{name}_bucket{{stream="{stream}",le="+Inf"}} {cumulative}')
+            lines.append(f'attic_{name}_sum{{stream="{stream}"}} {histogram.sum!r}')
+            lines.append(f'attic_{name}_count{{stream="{stream}"}} {cumulative}')
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    """
+    serves GET /metrics on `address:port`, from a background thread.
+    `collect` returns the (stream name, stream snapshot) pairs, and is called on every request.
+    """
+
+    def __init__(self, collect: typing.Callable[[], typing.List[typing.Tuple[str, dict]]],
+                 address: str = '127.0.0.1', port: int = 9464):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                try:
+                    body = render(collect()).encode()
+                except Exception as ex:
+                    self.send_error(500, str(ex))
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # no line per scrape on the console
+
+        self.server = http.server.ThreadingHTTPServer((address, port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, name='attic-metrics', daemon=True)
+
+    def start(self) -> 'MetricsServer':
+        self.thread.start()
+        stdout(f'serving metrics on http://{self.server.server_address[0]}:{self.port}/metrics')
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,45 @@
+import struct
+import typing
+
+# Encoding of the few MQTT 3.1.1 packets that attic writes to a socket itself, without paho:
+# the replay publisher (attic.replay.SocketPublisher), and the test and benchmark broker (attic.fakebroker).
+
+CONNECT, CONNACK, PUBLISH, PUBACK, PUBREC, PUBREL, PUBCOMP = 1, 2, 3, 4, 5, 6, 7
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK, PINGREQ, PINGRESP, DISCONNECT = 8, 9, 10, 11, 12, 13, 14
+
+PINGREQ_PACKET = b'\xc0\x00'
+DISCONNECT_PACKET = b'\xe0\x00'
+
+
+def encode_remaining_length(length: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length:
+            byte |= 0x80
+        encoded.append(byte)
+        if not length:
+            return bytes(encoded)
+
+
+def publish_packet(topic: typing.Union[str, bytes], payload: bytes) -> bytes:
+    """ a QoS 0 PUBLISH packet """
+    if isinstance(topic, str):
+        topic = topic.encode()
+    return b''.join((b'\x30', encode_remaining_length(2 + len(topic) + len(payload)),
+                     struct.pack('!H', len(topic)), topic, payload))
+
+
+def connect_packet(user: str = '', password: str = '', keepalive: int = 60) -> bytes:
+    """ a CONNECT packet, clean session, with an empty client id """
+    flags = 0x02
+    payload = struct.pack('!H', 0)
+    if user != '':
+        flags |= 0x80
+        payload += struct.pack('!H', len(user.encode())) + user.encode()
+        if password != '':
+            flags |= 0x40
+            payload += struct.pack('!H', len(password.encode())) + password.encode()
+    body = b'\x00\x04MQTT\x04' + bytes([flags]) + struct.pack('!H', keepalive) + payload
+    return b'\x10' + encode_remaining_length(len(body)) + body
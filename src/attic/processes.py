@@ -0,0 +1,208 @@
+import datetime
+import multiprocessing
+import signal
+import time
+import typing
+
+from .metrics import METRICS_SIZE, StreamMetrics
+
+stdout = print
+
+# The counters that a worker process copies, per stream, into the shared memory block,
+# for the supervisor's monitoring loop. All are stored as doubles.
+COUNTERS = (
+    'messageCount',
+    'totalIdleTime',
+    'totalProcessingTime',
+    'lastRxTimestamp_unix',
+    'is_connected',
+    'queue_depth',
+    'messages_written',
+    'commit_count',
+    'rotation_count',
+    'rotation_stall_last_seconds',
+    'rotation_stall_max_seconds',
+    'rotation_stall_total_seconds',
+    'spool_fill',
+    'spool_bytes',
+    'spool_dropped',
+    'spool_replayed',
+    'decoded_count',
+    'undecodable_count',
+    'worker_pid',
+)
+COUNTER_INDEX = {name: index for index, name in enumerate(COUNTERS)}
+# the counters that only grow. A restarted worker counts them from zero again;
+# the supervisor carries the totals of the previous workers over, so that they never go backwards.
+CUMULATIVE_COUNTERS = (
+    'messageCount',
+    'totalIdleTime',
+    'totalProcessingTime',
+    'messages_written',
+    'commit_count',
+    'rotation_count',
+    'rotation_stall_total_seconds',
+    'spool_dropped',
+    'spool_replayed',
+    'decoded_count',
+    'undecodable_count',
+)
+
+# how often the worker processes copy their counters into shared memory, and check their connections
+WORKER_REPORT_PERIOD = 0.5
+# how long a worker process waits for its streams to acknowledge the stop request
+WORKER_STOP_TIMEOUT = 10.0
+
+
+def process_groups(config: dict) -> typing.List[typing.List[int]]:
+    """
+    the stream numbers run by each worker process.
+    Streams with the same `process-group` share a process, every other stream gets one of its own.
+    """
+    groups = {}
+    for stream_idx, stream_config in enumerate(config['streams']):
+        group = stream_config.get('process-group', f'stream-{stream_idx}')
+        groups.setdefault(group, []).append(stream_idx)
+    return list(groups.values())
+
+
+def worker_main(config: dict, data_path: str, stream_indices: typing.List[int], counters, metrics, stop_event):
+    """ the entry point of a worker process: runs the streams, as in the threads engine, until told to stop. """
+    # ctrl-c goes to the whole process group; the supervisor decides when the workers stop.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import attic
+    from .catalog import Catalog
+
+    attic.shared_state = {'totalMessageCount': 0, 'streams': []}
+    attic.prepare_shared_state(config)
+    catalog = Catalog(data_path) if config.get('catalog', True) else None
+    attic.start_streams(stream_indices, config, data_path, catalog)
+
+    stride = len(COUNTERS)
+    pid = multiprocessing.current_process().pid
+    while not stop_event.wait(WORKER_REPORT_PERIOD):
+        # a shared connection is reconnected once per pass, see attic.reconnect_stream
+        reconnected = set()
+        for stream_idx in stream_indices:
+            snapshot = attic.thread_stream_snapshot(stream_idx)
+            base = stream_idx * stride
+            for index, name in enumerate(COUNTERS):
+                value = snapshot[name] if name in snapshot else snapshot['details'].get(name)
+                counters[base + index] = float(value or 0)
+            counters[base + COUNTER_INDEX['worker_pid']] = float(pid)
+            metrics_base = stream_idx * METRICS_SIZE
+            metrics[metrics_base:metrics_base + METRICS_SIZE] = snapshot['metrics'].values()
+            if not snapshot['is_connected'] and snapshot['messageCount'] > 0:
+                attic.reconnect_stream(stream_idx, config, reconnected)
+
+    attic.stop_streams(stream_indices, timeout=WORKER_STOP_TIMEOUT)
+
+
+class ProcessSupervisor:
+    """
+    The `processes` engine: runs each stream, or group of streams, in its own worker process, to escape the GIL.
+
+    * the workers report their per-stream counters, and histograms, through shared memory blocks of doubles,
+      not through pickled messages; the supervisor reads them for the monitoring loop and the performance topic.
+    * the workers reconnect their own mqtt clients; the supervisor restarts the workers that die.
+    * on stop, the workers flush and close their files.
+    """
+
+    def __init__(self, config: dict, data_path: str):
+        self.config = config
+        self.data_path = data_path
+        self.stream_count = len(config['streams'])
+        # spawn, rather than fork: the supervisor already runs threads.
+        self.context = multiprocessing.get_context('spawn')
+        self.counters = self.context.RawArray('d', self.stream_count * len(COUNTERS))
+        self.metrics = self.context.RawArray('d', self.stream_count * METRICS_SIZE)
+        self.stop_event = self.context.Event()
+        self.groups = process_groups(config)
+        self.workers = [None] * len(self.groups)
+        self.restart_count = 0
+        # per stream: the cumulative counters and histograms of its previous worker processes,
+        # added to those of the current one
+        self.counter_bases = [dict.fromkeys(CUMULATIVE_COUNTERS, 0.0) for _ in range(self.stream_count)]
+        self.metrics_bases = [StreamMetrics() for _ in range(self.stream_count)]
+
+    def start_worker(self, group_idx: int):
+        stream_indices = self.groups[group_idx]
+        worker = self.context.Process(
+            target=worker_main,
+            args=(self.config, self.data_path, stream_indices, self.counters, self.metrics, self.stop_event),
+            name=f'attic-worker-{"-".join(str(stream_idx) for stream_idx in stream_indices)}',
+            daemon=False,
+        )
+        worker.start()
+        stdout(f'started worker process {worker.name} (pid {worker.pid}) for streams {stream_indices}')
+        self.workers[group_idx] = worker
+
+    def start(self):
+        for group_idx in range(len(self.groups)):
+            self.start_worker(group_idx)
+
+    def check_workers(self):
+        if self.stop_event.is_set():
+            return
+        for group_idx, worker in enumerate(self.workers):
+            if worker is not None and not worker.is_alive():
+                stdout(f'worker process {worker.name} exited with code {worker.exitcode}, restarting ...')
+                self.restart_count += 1
+                self.carry_over_counters(group_idx)
+                self.start_worker(group_idx)
+
+    def carry_over_counters(self, group_idx: int):
+        """
+        before a worker is restarted: add the last counters and histograms it reported to the bases of its streams,
+        and clear them, so that the totals do not count its last report twice until the new worker reports.
+        The histograms then never go backwards either, for the per-interval summaries and for /metrics.
+        """
+        stride = len(COUNTERS)
+        for stream_idx in self.groups[group_idx]:
+            base = stream_idx * stride
+            for name in CUMULATIVE_COUNTERS:
+                self.counter_bases[stream_idx][name] += self.counters[base + COUNTER_INDEX[name]]
+                self.counters[base + COUNTER_INDEX[name]] = 0.0
+            metrics_base = stream_idx * METRICS_SIZE
+            self.metrics_bases[stream_idx].merge(
+                StreamMetrics().load(self.metrics[metrics_base:metrics_base + METRICS_SIZE]))
+            self.metrics[metrics_base:metrics_base + METRICS_SIZE] = [0.0] * METRICS_SIZE
+
+    def stream_snapshot(self, stream_idx: int) -> dict:
+        """ the counters of a stream, as last reported by its worker process. """
+        base = stream_idx * len(COUNTERS)
+        values = {name: self.counters[base + index] for index, name in enumerate(COUNTERS)}
+        for name, value in self.counter_bases[stream_idx].items():
+            values[name] += value
+        last_rx_timestamp_unix = int(values['lastRxTimestamp_unix']) or None
+        last_rx_timestamp_iso_string = None
+        if last_rx_timestamp_unix is not None:
+            last_rx_timestamp_iso_string = datetime.datetime.fromtimestamp(
+                last_rx_timestamp_unix / 1e6, tz=datetime.timezone.utc).isoformat(timespec='microseconds')
+        details = {name: values[name] for name in COUNTERS[5:]}
+        details['storage_profile'] = self.config['streams'][stream_idx].get('storage-profile', 'default')
+        for name in ('queue_depth', 'messages_written', 'commit_count', 'rotation_count', 'spool_bytes',
+                     'spool_dropped', 'spool_replayed', 'decoded_count', 'undecodable_count', 'worker_pid'):
+            details[name] = int(details[name])
+        return dict(
+            messageCount=int(values['messageCount']),
+            totalIdleTime=values['totalIdleTime'],
+            totalProcessingTime=values['totalProcessingTime'],
+            lastRxTimestamp_unix=last_rx_timestamp_unix,
+            lastRxTimestamp_iso_string=last_rx_timestamp_iso_string,
+            is_connected=bool(values['is_connected']),
+            details=details,
+            metrics=StreamMetrics().load(self.metrics[stream_idx * METRICS_SIZE:(stream_idx + 1) * METRICS_SIZE])
+            .merge(self.metrics_bases[stream_idx]),
+        )
+
+    def stop(self, timeout: float = WORKER_STOP_TIMEOUT + 5.0):
+        self.stop_event.set()
+        deadline = time.time() + timeout
+        for worker in self.workers:
+            if worker is None:
+                continue
+            worker.join(max(deadline - time.time(), 0.1))
+            if worker.is_alive():
+                stdout(f'worker process {worker.name} did not stop in time, terminating it.')
+                worker.terminate()
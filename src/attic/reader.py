@@ -0,0 +1,360 @@
+import datetime
+import heapq
+import pathlib
+import sqlite3
+import typing
+import warnings
+
+from paho.mqtt.client import topic_matches_sub
+
+from .compression import PayloadDecoder, is_compressed
+from .dedup import payload_source
+from .safetimestring import safestring_to_datetime
+from .shards import SHARD_FOLDER_PREFIX
+
+# Read side: query the rotated log files of a stream by time range and topic, in constant memory.
+#
+#   from attic import reader
+#   for reception_timestamp, topic, payload in reader.read_rows('/var/attic/data/everything', start, end, ['sensors/#']):
+#       ...
+#
+# * files are pruned by their folder and file names, without opening them:
+#   a file holds no data older than its name, and none newer than the name of the file two places after it.
+#   If the data folder has a catalog, the sealed files are pruned further by their exact time span and topics.
+# * the time range and topics are pushed down into each file's SQL.
+# * rows come out in reception_timestamp order within each file, and files are read in order.
+# * a sharded stream (`shards: N`) has a sequence of files per shard folder; the shards are read side by side,
+#   and their rows merged by reception_timestamp.
+#
+# Time bounds are either timezone-aware datetimes, or microseconds since epoch, like `reception_timestamp`.
+# `start` is inclusive, `end` is exclusive. Topics are MQTT topic filters, `+` and `#` wildcards are supported.
+
+TimeBound = typing.Union[datetime.datetime, int, None]
+
+BATCH_FORMATS = ('numpy', 'arrow')
+
+
+def to_microseconds(value: TimeBound) -> typing.Optional[int]:
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return int(round(value.timestamp() * 1e6))
+    return int(value)
+
+
+def file_start_microseconds(path: pathlib.Path) -> typing.Optional[int]:
+    """ the creation time of a log file, from its name, or None if this is not a log file name. """
+    try:
+        return to_microseconds(safestring_to_datetime(path.stem))
+    except ValueError:
+        return None
+
+
+def shard_folders(stream_path: typing.Union[str, pathlib.Path]) -> typing.List[pathlib.Path]:
+    """
+    the folders of a stream that each hold one sequence of rotated files:
+    the stream folder itself, and the shard folders in it, if the stream is (or was) sharded.
+    """
+    stream_path = pathlib.Path(stream_path)
+    shards = []
+    for path in stream_path.glob(f'{SHARD_FOLDER_PREFIX}*'):
+        suffix = path.name[len(SHARD_FOLDER_PREFIX):]
+        if path.is_dir() and suffix.isdigit():
+            shards.append((int(suffix), path))
+    folders = [path for _, path in sorted(shards)]
+    if day_folders(stream_path) or not folders:
+        folders.insert(0, stream_path)
+    return folders
+
+
+def list_folder_files(folder: typing.Union[str, pathlib.Path]) -> typing.List[typing.Tuple[int, pathlib.Path]]:
+    """ the log files of one sequence: a stream folder, or one shard folder of it, as in `list_stream_files`. """
+    files = []
+    for path in pathlib.Path(folder).glob('[0-9]*/[0-9]*/[0-9]*/*.sqlite'):
+        start = file_start_microseconds(path)
+        if start is not None:
+            files.append((start, path))
+    files.sort()
+    return files
+
+
+def list_stream_files(stream_path: typing.Union[str, pathlib.Path]) -> typing.List[typing.Tuple[int, pathlib.Path]]:
+    """ all log files of a stream, of all its shards, as (start microseconds, path), oldest first. """
+    files = []
+    for folder in shard_folders(stream_path):
+        files.extend(list_folder_files(folder))
+    files.sort()
+    return files
+
+
+def day_folders(stream_path: pathlib.Path) -> typing.List[typing.Tuple[datetime.date, pathlib.Path]]:
+    """ the YYYY/MM/DD folders of a stream, as made by `timefolders()`, oldest first. """
+    days = []
+    for path in stream_path.glob('[0-9]*/[0-9]*/[0-9]*'):
+        try:
+            day = datetime.date(int(path.parent.parent.name), int(path.parent.name), int(path.name))
+        except ValueError:
+            continue
+        days.append((day, path))
+    days.sort()
+    return days
+
+
+def files_in_folder(folder: pathlib.Path) -> typing.List[typing.Tuple[int, pathlib.Path]]:
+    files = []
+    for path in folder.glob('*.sqlite'):
+        start = file_start_microseconds(path)
+        if start is not None:
+            files.append((start, path))
+    files.sort()
+    return files
+
+
+def select_files(
+        stream_path: typing.Union[str, pathlib.Path],
+        start: TimeBound = None,
+        end: TimeBound = None) -> typing.List[pathlib.Path]:
+    """
+    the log files of a stream that may hold data in [start, end), oldest first.
+    Only folder and file names are looked at.
+    For a sharded stream, `stream_path` is one of its `shard_folders`.
+    """
+    stream_path = pathlib.Path(stream_path)
+    start_us = to_microseconds(start)
+    end_us = to_microseconds(end)
+    start_day = None if start_us is None else datetime.datetime.fromtimestamp(
+        start_us / 1e6, tz=datetime.timezone.utc).date()
+    end_day = None if end_us is None else datetime.datetime.fromtimestamp(
+        end_us / 1e6, tz=datetime.timezone.utc).date()
+
+    days = [(day, folder) for day, folder in day_folders(stream_path) if end_day is None or day <= end_day]
+    # the folders from the start day on, and, going back from there,
+    # as many earlier folders as needed to find the two last files created before the start.
+    # (a quiet stream can keep writing to a file created days before)
+    candidates = []
+    earlier = []
+    for day, folder in reversed(days):
+        if start_day is None or day >= start_day:
+            candidates[:0] = files_in_folder(folder)
+        else:
+            earlier[:0] = files_in_folder(folder)
+            if len(earlier) >= 2:
+                break
+    candidates[:0] = earlier
+
+    selected = []
+    for index, (file_start, path) in enumerate(candidates):
+        if end_us is not None and file_start >= end_us:
+            break
+        if start_us is not None and index + 2 < len(candidates) and candidates[index + 2][0] <= start_us:
+            continue
+        selected.append(path)
+    return selected
+
+
+def prune_with_catalog(
+        stream_path: pathlib.Path,
+        paths: typing.List[pathlib.Path],
+        start_us: typing.Optional[int],
+        end_us: typing.Optional[int],
+        topics: typing.Optional[typing.Sequence[str]]) -> typing.List[pathlib.Path]:
+    """ drop the cataloged files whose time span or topics do not match. Files not in the catalog are kept. """
+    from .catalog import catalog_path, cataloged_spans
+    data_folder = stream_path.parent
+    if not paths or not catalog_path(data_folder).exists():
+        return paths
+    spans = cataloged_spans(data_folder, stream_path.name)
+    kept = []
+    for path in paths:
+        span = spans.get(path.relative_to(data_folder).as_posix())
+        if span is not None:
+            min_timestamp, max_timestamp, file_topics = span
+            if min_timestamp is None:
+                continue  # empty file
+            if start_us is not None and max_timestamp < start_us:
+                continue
+            if end_us is not None and min_timestamp >= end_us:
+                continue
+            if topics is not None and not any(topic_matches_sub(topic_filter, topic)
+                                              for topic in file_topics for topic_filter in topics):
+                continue
+        kept.append(path)
+    return kept
+
+
+def has_wildcard(topic_filter: str) -> bool:
+    return '+' in topic_filter or '#' in topic_filter
+
+
+def file_query(
+        connection: sqlite3.Connection,
+        start_us: typing.Optional[int],
+        end_us: typing.Optional[int],
+        topics: typing.Optional[typing.Sequence[str]]) -> typing.Optional[typing.Tuple[str, list]]:
+    """
+    the SQL, and its parameters, that selects (reception_timestamp, topic, payload, dictionary_id) from one file.
+    None if the file has none of the topics.
+    """
+    if isinstance(topics, str):
+        topics = [topics]
+    schema_version = max(connection.execute('PRAGMA user_version').fetchone()[0], 1)
+    if schema_version == 1:
+        columns = 'reception_timestamp, topic, payload, NULL'
+        source = 'data'
+        timestamp_column = 'reception_timestamp'
+        topic_column = 'topic'
+        topic_values = None
+        if topics is not None and any(has_wildcard(topic_filter) for topic_filter in topics):
+            # resolve the wildcards against the topics present in the file; the index makes this cheap.
+            topic_values = [topic for (topic,) in connection.execute('SELECT DISTINCT topic FROM data')
+                            if any(topic_matches_sub(topic_filter, topic) for topic_filter in topics)]
+        elif topics is not None:
+            topic_values = list(topics)
+    else:
+        dictionary_column = 'records.dictionary_id' if is_compressed(connection) else 'NULL'
+        payload_column, blobs_join = payload_source(connection)
+        columns = f'records.reception_timestamp, topics.name, {payload_column}, {dictionary_column}'
+        source = f'records JOIN topics ON topics.id = records.topic_id{blobs_join}'
+        timestamp_column = 'records.reception_timestamp'
+        topic_column = 'records.topic_id'
+        topic_values = None
+        if topics is not None:
+            topic_values = [topic_id for topic_id, name in connection.execute('SELECT id, name FROM topics')
+                            if any(topic_matches_sub(topic_filter, name) for topic_filter in topics)]
+
+    conditions = []
+    parameters = []
+    if start_us is not None:
+        conditions.append(f'{timestamp_column} >= ?')
+        parameters.append(start_us)
+    if end_us is not None:
+        conditions.append(f'{timestamp_column} < ?')
+        parameters.append(end_us)
+    if topic_values is not None:
+        if not topic_values:
+            return None
+        conditions.append(f'{topic_column} IN ({", ".join("?" * len(topic_values))})')
+        parameters.extend(topic_values)
+    where = f' WHERE {" AND ".join(conditions)}' if conditions else ''
+    table = 'data' if schema_version == 1 else 'records'
+    time_indexed = connection.execute(
+        "SELECT count(*) FROM sqlite_master WHERE type = 'index' AND name = ?",
+        (f'{table}_reception_timestamp',)).fetchone()[0]
+    if time_indexed:
+        # a compacted file: sorted by topic, with an index on the time.
+        order = f'{table}.reception_timestamp'
+    else:
+        # rows are appended in reception order, hence the rowid order is the time order.
+        order = f'{table}.rowid'
+    return f'SELECT {columns} FROM {source}{where} ORDER BY {order}', parameters
+
+
+def read_file(
+        path: typing.Union[str, pathlib.Path],
+        start: TimeBound = None,
+        end: TimeBound = None,
+        topics: typing.Optional[typing.Sequence[str]] = None,
+        fetch_size: int = 4096) -> typing.Iterator[typing.Tuple[int, str, bytes]]:
+    """ the rows of one log file, as (reception_timestamp, topic, payload), with the original payloads. """
+    connection = sqlite3.connect(f'file:{pathlib.Path(path).as_posix()}?mode=ro', uri=True)
+    try:
+        from .schemas import decoded_only_tables
+        decoded_only = decoded_only_tables(connection, [topics] if isinstance(topics, str) else topics)
+        if decoded_only:
+            warnings.warn(f'some of the rows are stored in a typed table only (keep-raw: false), and not returned: '
+                          f'{", ".join(decoded_only)}. Read them with attic.schemas.read_table.', stacklevel=2)
+        query = file_query(connection, to_microseconds(start), to_microseconds(end), topics)
+        if query is None:
+            return
+        decoder = PayloadDecoder(connection)
+        cursor = connection.execute(*query)
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                return
+            for reception_timestamp, topic, payload, dictionary_id in rows:
+                yield reception_timestamp, topic, decoder.decode(payload, dictionary_id)
+    finally:
+        connection.close()
+
+
+def read_rows(
+        stream_path: typing.Union[str, pathlib.Path],
+        start: TimeBound = None,
+        end: TimeBound = None,
+        topics: typing.Optional[typing.Sequence[str]] = None) -> typing.Iterator[typing.Tuple[int, str, bytes]]:
+    """ the rows of a stream in [start, end), as (reception_timestamp, topic, payload), oldest first. """
+    if isinstance(topics, str):
+        topics = [topics]
+    folders = shard_folders(stream_path)
+    if len(folders) == 1:
+        yield from read_folder_rows(pathlib.Path(stream_path), folders[0], start, end, topics)
+    else:
+        # the shards side by side; within each, the order of the messages of a topic is the order they came in.
+        yield from heapq.merge(*(read_folder_rows(pathlib.Path(stream_path), folder, start, end, topics)
+                                 for folder in folders), key=lambda row: row[0])
+
+
+def read_folder_rows(
+        stream_path: pathlib.Path,
+        folder: pathlib.Path,
+        start: TimeBound,
+        end: TimeBound,
+        topics: typing.Optional[typing.Sequence[str]]) -> typing.Iterator[typing.Tuple[int, str, bytes]]:
+    """ the rows of one sequence of files of a stream, see `shard_folders`. """
+    paths = select_files(folder, start, end)
+    paths = prune_with_catalog(stream_path, paths, to_microseconds(start), to_microseconds(end), topics)
+    for path in paths:
+        yield from read_file(path, start, end, topics)
+
+
+def read_batches(
+        stream_path: typing.Union[str, pathlib.Path],
+        start: TimeBound = None,
+        end: TimeBound = None,
+        topics: typing.Optional[typing.Sequence[str]] = None,
+        batch_size: int = 65536,
+        batch_format: str = 'numpy') -> typing.Iterator[typing.Any]:
+    """
+    the rows of a stream in [start, end), in batches of `batch_size` rows (the last one may be shorter).
+
+    * batch_format="numpy": a dict of NumPy arrays, `reception_timestamp` (int64), `topic` and `payload` (object).
+    * batch_format="arrow": a pyarrow.RecordBatch with columns `reception_timestamp` (int64), `topic` (string)
+      and `payload` (binary).
+    """
+    if batch_format not in BATCH_FORMATS:
+        raise ValueError(f'batch_format must be one of {BATCH_FORMATS}')
+    make_batch = numpy_batch if batch_format == 'numpy' else arrow_batch
+    rows = []
+    for row in read_rows(stream_path, start, end, topics):
+        rows.append(row)
+        if len(rows) >= batch_size:
+            yield make_batch(rows)
+            rows = []
+    if rows:
+        yield make_batch(rows)
+
+
+def numpy_batch(rows: list) -> dict:
+    import numpy as np
+    timestamps, topics, payloads = zip(*rows)
+    topic_array = np.empty(len(rows), dtype=object)
+    topic_array[:] = topics
+    payload_array = np.empty(len(rows), dtype=object)
+    payload_array[:] = payloads
+    return dict(
+        reception_timestamp=np.fromiter(timestamps, dtype=np.int64, count=len(rows)),
+        topic=topic_array,
+        payload=payload_array,
+    )
+
+
+def arrow_batch(rows: list):
+    import pyarrow as pa
+    timestamps, topics, payloads = zip(*rows)
+    return pa.RecordBatch.from_arrays(
+        [pa.array(timestamps, type=pa.int64()), pa.array(topics, type=pa.string()),
+         pa.array(payloads, type=pa.binary())],
+        names=['reception_timestamp', 'topic', 'payload'])
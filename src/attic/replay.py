@@ -0,0 +1,352 @@
+import argparse
+import datetime
+import heapq
+import os
+import pathlib
+import queue
+import socket
+import sqlite3
+import threading
+import time
+import typing
+
+import paho.mqtt.client as mqtt
+import yaml
+
+from .mqttpacket import DISCONNECT_PACKET, PINGREQ_PACKET, connect_packet, publish_packet
+from .metrics import DURATION_BOUNDS, Histogram
+from .reader import read_rows, select_files, shard_folders, to_microseconds
+from .schemas import decoded_only_tables
+
+stdout = print
+
+# Replay: publish recorded streams to a broker again, to reproduce an incident or to load-test the consumers.
+#
+#   attic replay --stream everything --start 2024-03-01T12:00:00+00:00 --end 2024-03-01T13:00:00+00:00 \
+#                --speed 10 --broker-address localhost --broker-port 1883 [--topic-prefix replay/]
+#
+# * the rows of all the given streams, and of all their files and shards, are merged by reception_timestamp.
+# * --speed 1 keeps the original time between the messages, --speed N plays N times faster,
+#   --speed 0 publishes as fast as possible. --max-gap-seconds shortens the long silences of a recording.
+# * a reader thread reads the files READ_BATCH rows at a time, up to --read-ahead batches ahead of the publisher,
+#   so that a slow file or a file switch does not show as jitter.
+# * with QoS 0, the publisher encodes the messages itself, and writes all those due to the socket in one call,
+#   at least every SCHEDULE_SLACK seconds; see SocketPublisher. With QoS 1 and 2, it hands them to paho's
+#   network thread, and waits for them to be sent one flush later; see PahoPublisher.
+# * the time a message is published after it was due is reported as the lateness, see `replay`.
+#
+# Messages are published with the QoS of --qos, and never retained. To not record the replayed messages again,
+# replay to another broker, or with a --topic-prefix that no recording stream subscribes to.
+
+READ_BATCH = 1000
+READ_AHEAD_BATCHES = 16
+# a message due within this many seconds is published right away, rather than after a sleep
+SCHEDULE_SLACK = 0.0005
+# the longest sleep between two flushes, during a silence of the recording
+IDLE_FLUSH_SECONDS = 5.0
+KEEPALIVE_SECONDS = 60
+# how long to wait for the connection, and for the last messages to be written
+CONNECT_TIMEOUT = 10.0
+FLUSH_TIMEOUT = 60.0
+
+
+def rows_by_time(
+        stream_paths: typing.Sequence[typing.Union[str, pathlib.Path]],
+        start=None,
+        end=None,
+        topics: typing.Optional[typing.Sequence[str]] = None) -> typing.Iterator[typing.Tuple[int, str, bytes]]:
+    """ the rows of several streams, merged into one sequence by reception_timestamp """
+    if len(stream_paths) == 1:
+        return read_rows(stream_paths[0], start, end, topics)
+    return heapq.merge(*(read_rows(stream_path, start, end, topics) for stream_path in stream_paths),
+                       key=lambda row: row[0])
+
+
+def check_replayable(
+        stream_paths: typing.Sequence[typing.Union[str, pathlib.Path]],
+        start=None,
+        end=None,
+        topics: typing.Optional[typing.Sequence[str]] = None):
+    """
+    raise ValueError if some of the messages to replay are stored in a typed table only (`keep-raw: false`):
+    their payloads are gone, they can not be published again.
+    """
+    decoded_only = set()
+    for stream_path in stream_paths:
+        for folder in shard_folders(stream_path):
+            for path in select_files(folder, start, end):
+                connection = sqlite3.connect(f'file:{pathlib.Path(path).as_posix()}?mode=ro', uri=True)
+                try:
+                    decoded_only.update(decoded_only_tables(connection, topics))
+                finally:
+                    connection.close()
+    if decoded_only:
+        raise ValueError(f'the messages of {", ".join(sorted(decoded_only))} are stored decoded only '
+                         f'(keep-raw: false), and can not be replayed; leave their topics out with --topic')
+
+
+class ReadAhead:
+    """ reads the rows in a background thread, in batches of `batch_size`, up to `depth` batches ahead. """
+
+    def __init__(self, rows: typing.Iterator[typing.Tuple[int, str, bytes]], batch_size: int = READ_BATCH,
+                 depth: int = READ_AHEAD_BATCHES):
+        self.rows = rows
+        self.batch_size = batch_size
+        self.batches_queue = queue.Queue(maxsize=max(depth, 1))
+        self.stopped = False
+        self.thread = threading.Thread(target=self.work, name='attic-replay-reader', daemon=True)
+        self.thread.start()
+
+    def work(self):
+        try:
+            batch = []
+            for row in self.rows:
+                batch.append(row)
+                if len(batch) >= self.batch_size:
+                    self.batches_queue.put(batch)
+                    batch = []
+                    if self.stopped:
+                        return
+            if batch:
+                self.batches_queue.put(batch)
+            self.batches_queue.put(None)
+        except Exception as ex:
+            # handed over to the publisher, which raises it
+            self.batches_queue.put(ex)
+
+    def batches(self) -> typing.Iterator[list]:
+        while True:
+            batch = self.batches_queue.get()
+            if batch is None:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+
+    def close(self):
+        """ stop reading, e.g. when the publisher gave up early """
+        self.stopped = True
+        while self.thread.is_alive():
+            try:
+                self.batches_queue.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+
+def replay(
+        publisher,
+        batches: typing.Iterable[typing.Sequence[typing.Tuple[int, str, bytes]]],
+        speed: float = 1.0,
+        topic_prefix: str = '',
+        max_gap_seconds: typing.Optional[float] = None,
+        report_seconds: float = 10.0) -> dict:
+    """
+    publish the rows of `batches` with `publisher`, a SocketPublisher or a PahoPublisher,
+    at `speed` times the original pace, or as fast as possible for speed 0.
+
+    Returns the count of messages published, the time it took, and the lateness of the messages:
+    how long after its due time each one was handed to the publisher, in seconds.
+    """
+    lateness = Histogram(DURATION_BOUNDS)
+    clock = time.perf_counter
+    start_time = clock()
+    next_report_time = start_time + report_seconds
+    # the due time of a row is wall_start + (reception_timestamp - first_timestamp) / speed
+    first_timestamp = None
+    previous_timestamp = None
+    wall_start = start_time
+    time_scale = 1e-6 / speed if speed > 0 else 0.0
+    flush_time = start_time
+    publish = publisher.publish
+    message_count = 0
+    for batch in batches:
+        for reception_timestamp, topic, payload in batch:
+            if time_scale:
+                if first_timestamp is None:
+                    first_timestamp = previous_timestamp = reception_timestamp
+                    wall_start = clock()
+                if max_gap_seconds is not None:
+                    gap = (reception_timestamp - previous_timestamp) * time_scale
+                    if gap > max_gap_seconds:
+                        # as if the silence had been max_gap_seconds long
+                        wall_start -= gap - max_gap_seconds
+                    previous_timestamp = reception_timestamp
+                due = wall_start + (reception_timestamp - first_timestamp) * time_scale
+                now = clock()
+                if due - now > SCHEDULE_SLACK:
+                    # send what is due before waiting; in slices, so that the connection is kept alive
+                    while due - now > SCHEDULE_SLACK:
+                        publisher.flush()
+                        time.sleep(min(due - now, IDLE_FLUSH_SECONDS))
+                        now = clock()
+                    flush_time = now
+                elif now - flush_time > SCHEDULE_SLACK:
+                    # a steady flow: send every SCHEDULE_SLACK seconds
+                    publisher.flush()
+                    flush_time = now
+                lateness.record(now - due if now > due else 0.0)
+            publish(topic_prefix + topic, payload)
+        message_count += len(batch)
+        publisher.flush()
+        if report_seconds and clock() > next_report_time:
+            next_report_time += report_seconds
+            stdout(f'replay | {message_count} messages, {message_count / (clock() - start_time):.0f} msg/s')
+    publisher.close()
+    elapsed = clock() - start_time
+    return dict(
+        messages=message_count,
+        seconds=elapsed,
+        messages_per_second=message_count / elapsed if elapsed > 0 else 0.0,
+        lateness_seconds=lateness.summary(),
+    )
+
+
+class SocketPublisher:
+    """
+    Publishes with QoS 0 over a plain MQTT 3.1.1 connection of its own, without paho:
+    the messages are encoded into a buffer, and `flush` writes the buffer to the socket in one call.
+    This is several times cheaper per message than paho's publish, which matters at tens of thousands of msg/s.
+    """
+
+    def __init__(self, address: str, port: int, user: str = '', password: str = ''):
+        self.sock = socket.create_connection((address, port), timeout=CONNECT_TIMEOUT)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.sendall(connect_packet(user, password, KEEPALIVE_SECONDS))
+        connack = b''
+        while len(connack) < 4:
+            received = self.sock.recv(4 - len(connack))
+            if not received:
+                break
+            connack += received
+        if len(connack) < 4 or connack[0] != 0x20 or connack[3] != 0:
+            self.sock.close()
+            raise RuntimeError(f'replay | connection to {address}:{port} refused: {connack!r}')
+        self.sock.settimeout(None)
+        self.buffer: typing.List[bytes] = []
+        self.last_send_time = time.monotonic()
+
+    def publish(self, topic: str, payload: bytes):
+        self.buffer.append(publish_packet(topic, payload))
+
+    def flush(self):
+        if self.buffer:
+            self.sock.sendall(b''.join(self.buffer))
+            self.buffer = []
+            self.last_send_time = time.monotonic()
+        elif time.monotonic() - self.last_send_time > KEEPALIVE_SECONDS / 2:
+            self.sock.sendall(PINGREQ_PACKET)
+            self.last_send_time = time.monotonic()
+            try:
+                # the PINGRESPs, so that they do not pile up in the socket
+                self.sock.recv(4096, socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                pass
+
+    def close(self):
+        self.flush()
+        try:
+            self.sock.sendall(DISCONNECT_PACKET)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class PahoPublisher:
+    """
+    Publishes with paho, for QoS 1 and 2. `publish` hands the message to the paho network thread;
+    `flush` waits for the messages of the previous flush to be sent, so that at most two flushes are queued.
+    """
+
+    def __init__(self, address: str, port: int, user: str = '', password: str = '', qos: int = 1):
+        self.qos = qos
+        self.client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        if user != '':
+            self.client.username_pw_set(user, password)
+        # the default of 20 messages in flight would throttle the replay to the round trip time
+        self.client.max_inflight_messages_set(READ_BATCH)
+        connected = threading.Event()
+        self.client.on_connect = lambda *args: connected.set()
+        self.client.connect(address, port, KEEPALIVE_SECONDS)
+        self.client.loop_start()
+        if not connected.wait(CONNECT_TIMEOUT):
+            self.client.loop_stop()
+            raise RuntimeError(f'replay | could not connect to {address}:{port}')
+        self.message_info = None
+        self.flushed_info = None
+
+    def publish(self, topic: str, payload: bytes):
+        self.message_info = self.client.publish(topic, payload, self.qos)
+
+    def flush(self):
+        if self.flushed_info is not None:
+            self.flushed_info.wait_for_publish(FLUSH_TIMEOUT)
+        self.flushed_info = self.message_info
+
+    def close(self):
+        if self.message_info is not None:
+            self.message_info.wait_for_publish(FLUSH_TIMEOUT)
+        self.client.disconnect()
+        self.client.loop_stop()
+
+
+def main(argv: typing.Optional[typing.List[str]] = None):
+    parser = argparse.ArgumentParser(prog='attic replay',
+                                     description='publish recorded streams to a broker again, in reception order')
+    parser.add_argument('--config', type=str, default='config/config.yaml',
+                        help='fully qualified path to the configuration file, yaml format')
+    parser.add_argument('--data-folder', type=str, default=None, help='data folder, instead of the one in --config')
+    parser.add_argument('--stream', type=str, action='append', default=None,
+                        help='stream folder name, can be repeated; default: all streams in the data folder')
+    parser.add_argument('--start', type=str, default=None, help='ISO time of the first message, inclusive')
+    parser.add_argument('--end', type=str, default=None, help='ISO time of the last message, exclusive')
+    parser.add_argument('--topic', type=str, action='append', default=None,
+                        help='topic filter, can be repeated; default: all topics')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='1: original pace, N: N times faster, 0: as fast as possible')
+    parser.add_argument('--max-gap-seconds', type=float, default=None,
+                        help='shorten longer silences of the recording to this, after the speed is applied')
+    parser.add_argument('--topic-prefix', type=str, default='', help='prepended to the topic of every message')
+    parser.add_argument('--qos', type=int, default=0, choices=(0, 1, 2))
+    parser.add_argument('--read-ahead', type=int, default=READ_AHEAD_BATCHES,
+                        help=f'batches of {READ_BATCH} rows read ahead of the publisher')
+    parser.add_argument('--broker-address', type=str, default=None,
+                        help='default: the broker of the first stream in --config, or localhost')
+    parser.add_argument('--broker-port', type=int, default=None)
+    parser.add_argument('--user', type=str, default=None)
+    parser.add_argument('--password', type=str, default=None)
+    args = parser.parse_args(argv)
+
+    config = {}
+    if os.path.exists(args.config):
+        with open(args.config, 'r') as stream:
+            config = yaml.safe_load(stream)
+    first_stream = (config.get('streams') or [{}])[0]
+    data_folder = pathlib.Path(os.path.abspath(args.data_folder or config['data-folder']))
+    streams = args.stream or sorted(path.name for path in data_folder.iterdir()
+                                    if path.is_dir() and not path.name.startswith('.'))
+    start = None if args.start is None else to_microseconds(datetime.datetime.fromisoformat(args.start))
+    end = None if args.end is None else to_microseconds(datetime.datetime.fromisoformat(args.end))
+
+    broker = (args.broker_address or first_stream.get('mqtt-broker-address', 'localhost'),
+              args.broker_port or first_stream.get('mqtt-broker-port', 1883),
+              args.user if args.user is not None else first_stream.get('user', ''),
+              args.password if args.password is not None else first_stream.get('password', ''))
+    stream_paths = [data_folder.joinpath(stream) for stream in streams]
+    check_replayable(stream_paths, start, end, args.topic)
+    publisher = SocketPublisher(*broker) if args.qos == 0 else PahoPublisher(*broker, qos=args.qos)
+    read_ahead = ReadAhead(rows_by_time(stream_paths, start, end, args.topic),
+                           depth=args.read_ahead)
+    try:
+        report = replay(publisher, read_ahead.batches(), speed=args.speed, topic_prefix=args.topic_prefix,
+                        max_gap_seconds=args.max_gap_seconds)
+    finally:
+        read_ahead.close()
+    lateness = report['lateness_seconds']
+    stdout(f'replay | {report["messages"]} messages from {len(streams)} streams in {report["seconds"]:.3f} s, '
+           f'{report["messages_per_second"]:.0f} msg/s; lateness p50 {lateness["p50"]} p99 {lateness["p99"]} '
+           f'max_bound {lateness["max_bound"]} s')
+    return report
+
+
+if __name__ == '__main__':
+    main()
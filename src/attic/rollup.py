@@ -0,0 +1,226 @@
+import json
+import pathlib
+import sqlite3
+import typing
+
+from paho.mqtt.client import topic_matches_sub
+
+from .compression import PayloadDecoder
+from .reader import TimeBound, file_query, select_files, shard_folders, to_microseconds
+
+stdout = print
+
+# Rollups: per-topic aggregates of numeric fields, in fixed time buckets, computed when a file is sealed.
+#
+#   rollups:
+#     interval-seconds: 60
+#     target: "file"             # or "stream"
+#     fields:
+#       - topic: "sensors/+/temperature"
+#         path: "value"           # a dotted JSON path, e.g. "readings.0.celsius"; none for a plain number payload
+#       - topic: "power/#"
+#
+# * the payloads of the matching topics are decoded once, in the background thread that seals the file,
+#   and aggregated per (topic, field, bucket) in one vectorized pass over each topic.
+# * target "file": the rows go to a `rollup` table in the sealed file itself.
+#   target "stream": to ROLLUP_FILE_NAME in the stream folder, shared by the files and shards of the stream.
+# * a row holds count, min, max and sum, rather than the mean, so that the rows of the same bucket can be merged:
+#   a bucket that spans a rotation has a row in two files; in the stream database, they are merged on write.
+#   `read_rollups` merges what is left, and returns the mean.
+# * payloads that are not JSON, or where the path is missing or not a number, are skipped.
+# * compaction merges the rollup tables of the files it replaces into the compacted file.
+
+ROLLUP_FILE_NAME = 'rollup.sqlite'
+ROLLUP_TARGETS = ('file', 'stream')
+# longer buckets are better computed from the rollups; `read_rollups` relies on this bound
+ROLLUP_MAX_INTERVAL_SECONDS = 3600
+
+ROLLUP_TABLE = (
+    'CREATE TABLE IF NOT EXISTS rollup (topic TEXT NOT NULL, field TEXT NOT NULL, bucket_start INTEGER NOT NULL, '
+    'count INTEGER, min REAL, max REAL, sum REAL, PRIMARY KEY (topic, field, bucket_start))')
+ROLLUP_UPSERT = (
+    'INSERT INTO rollup VALUES (?, ?, ?, ?, ?, ?, ?) ON CONFLICT (topic, field, bucket_start) DO UPDATE SET '
+    'count = count + excluded.count, min = min(min, excluded.min), max = max(max, excluded.max), '
+    'sum = sum + excluded.sum')
+
+
+def resolve_rollups(rollup_config: typing.Optional[dict], stream_path: str) -> typing.Optional[dict]:
+    """ the `rollups` section of a stream's configuration, checked, with the database path resolved; or None. """
+    if not rollup_config or not rollup_config.get('fields'):
+        return None
+    target = rollup_config.get('target', 'file')
+    if target not in ROLLUP_TARGETS:
+        raise ValueError(f'rollups: target must be one of {ROLLUP_TARGETS}')
+    interval_seconds = float(rollup_config.get('interval-seconds', 60))
+    if not 0 < interval_seconds <= ROLLUP_MAX_INTERVAL_SECONDS:
+        raise ValueError(f'rollups: interval-seconds must be positive, and at most {ROLLUP_MAX_INTERVAL_SECONDS}')
+    fields = []
+    for field in rollup_config['fields']:
+        if 'topic' not in field:
+            raise ValueError(f'rollups: a field needs a topic: {field}')
+        path = field.get('path') or ''
+        fields.append(dict(
+            topic=field['topic'],
+            field=path or 'value',
+            path=[int(key) if key.isdigit() else key for key in path.split('.')] if path else None,
+        ))
+    return dict(
+        interval_us=int(interval_seconds * 1e6),
+        target=target,
+        database=str(pathlib.Path(stream_path).joinpath(ROLLUP_FILE_NAME)) if target == 'stream' else None,
+        fields=fields,
+    )
+
+
+def extract(document, path: typing.Optional[list]) -> typing.Optional[float]:
+    """ the number at `path` in a decoded JSON payload, or the payload itself if it is a number and there is no path """
+    value = document
+    try:
+        for key in path or ():
+            value = value[key]
+    except (KeyError, IndexError, TypeError):
+        return None
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    return None
+
+
+def aggregate(timestamps: list, values: list, interval_us: int) -> typing.List[tuple]:
+    """
+    (bucket_start, count, min, max, sum) per bucket of `interval_us`, of values in time order.
+    Vectorized: the buckets are contiguous, so one reduceat per statistic.
+    """
+    import numpy as np
+    buckets = np.asarray(timestamps, dtype=np.int64) // interval_us * interval_us
+    values = np.asarray(values, dtype=np.float64)
+    if len(buckets) > 1 and np.any(buckets[1:] < buckets[:-1]):
+        # e.g. a compacted file without a time index; not expected for a file that is being sealed
+        order = np.argsort(buckets, kind='stable')
+        buckets = buckets[order]
+        values = values[order]
+    starts = np.flatnonzero(np.concatenate(([True], buckets[1:] != buckets[:-1])))
+    counts = np.diff(np.append(starts, len(values)))
+    return list(zip(buckets[starts].tolist(), counts.tolist(), np.minimum.reduceat(values, starts).tolist(),
+                    np.maximum.reduceat(values, starts).tolist(), np.add.reduceat(values, starts).tolist()))
+
+
+def compute_rollups(connection: sqlite3.Connection, rollups: dict) -> typing.List[tuple]:
+    """ the rollup rows of one log file: (topic, field, bucket_start, count, min, max, sum) """
+    rows = []
+    query = file_query(connection, None, None, sorted({field['topic'] for field in rollups['fields']}))
+    if query is None:
+        return rows
+    decoder = PayloadDecoder(connection)
+    # topic -> [(field name, path)], for the topics of this file
+    fields_of: typing.Dict[str, list] = {}
+    # (topic, field name) -> ([timestamps], [values])
+    series: typing.Dict[typing.Tuple[str, str], typing.Tuple[list, list]] = {}
+    for reception_timestamp, topic, payload, dictionary_id in connection.execute(*query):
+        fields = fields_of.get(topic)
+        if fields is None:
+            # by field name: a field matched by two filters is counted once
+            fields = fields_of[topic] = list({field['field']: field['path'] for field in rollups['fields']
+                                              if topic_matches_sub(field['topic'], topic)}.items())
+        try:
+            document = json.loads(decoder.decode(payload, dictionary_id))
+        except ValueError:
+            continue
+        for field_name, path in fields:
+            value = extract(document, path)
+            if value is not None:
+                timestamps, values = series.setdefault((topic, field_name), ([], []))
+                timestamps.append(reception_timestamp)
+                values.append(value)
+    for (topic, field_name), (timestamps, values) in sorted(series.items()):
+        rows.extend((topic, field_name, *bucket) for bucket in aggregate(timestamps, values, rollups['interval_us']))
+    return rows
+
+
+def write_rollups(connection: sqlite3.Connection, rollups: dict) -> int:
+    """
+    compute the rollups of a log file, and write them to its `rollup` table, or to the stream's rollup database.
+    Call with the file's own connection, after its last insert, before it is closed. Returns the number of rows.
+    """
+    rows = compute_rollups(connection, rollups)
+    if rollups['target'] == 'file':
+        target = connection
+    else:
+        # shared by the rotation threads of the shards of the stream
+        target = sqlite3.connect(rollups['database'], timeout=30)
+    try:
+        target.execute(ROLLUP_TABLE)
+        target.executemany(ROLLUP_UPSERT, rows)
+        target.commit()
+    finally:
+        if target is not connection:
+            target.close()
+    return len(rows)
+
+
+def merge_rollup_tables(sources: typing.Iterable[sqlite3.Connection], target: sqlite3.Connection):
+    """ for compaction: the rollup rows of the source files, merged into the target file """
+    for source in sources:
+        if source.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'rollup'").fetchone()[0]:
+            target.execute(ROLLUP_TABLE)
+            target.executemany(ROLLUP_UPSERT, source.execute('SELECT * FROM rollup'))
+
+
+def read_rollups(
+        stream_path: typing.Union[str, pathlib.Path],
+        start: TimeBound = None,
+        end: TimeBound = None,
+        topics: typing.Optional[typing.Sequence[str]] = None,
+        field: typing.Optional[str] = None) -> typing.List[typing.Tuple[int, str, str, int, float, float, float]]:
+    """
+    the rollups of a stream with bucket_start in [start, end), from the stream's rollup database and from the
+    `rollup` tables of its files, merged per bucket, as (bucket_start, topic, field, count, min, max, mean),
+    ordered by bucket_start, topic and field.
+    """
+    if isinstance(topics, str):
+        topics = [topics]
+    stream_path = pathlib.Path(stream_path)
+    start_us = to_microseconds(start)
+    end_us = to_microseconds(end)
+    conditions = []
+    parameters = []
+    if start_us is not None:
+        conditions.append('bucket_start >= ?')
+        parameters.append(start_us)
+    if end_us is not None:
+        conditions.append('bucket_start < ?')
+        parameters.append(end_us)
+    if field is not None:
+        conditions.append('field = ?')
+        parameters.append(field)
+    query = 'SELECT * FROM rollup' + (f' WHERE {" AND ".join(conditions)}' if conditions else '')
+
+    paths = [stream_path.joinpath(ROLLUP_FILE_NAME)] if stream_path.joinpath(ROLLUP_FILE_NAME).exists() else []
+    for folder in shard_folders(stream_path):
+        # the rows of a bucket that starts before `end` can come after it, by up to one interval
+        paths.extend(select_files(folder, start_us, None if end_us is None
+                                  else end_us + ROLLUP_MAX_INTERVAL_SECONDS * 1_000_000))
+    # (topic, field, bucket_start) -> [count, min, max, sum]
+    merged: typing.Dict[typing.Tuple[str, str, int], list] = {}
+    for path in paths:
+        connection = sqlite3.connect(f'file:{pathlib.Path(path).as_posix()}?mode=ro', uri=True)
+        try:
+            if not connection.execute(
+                    "SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'rollup'").fetchone()[0]:
+                continue
+            for topic, field_name, bucket_start, count, minimum, maximum, total in connection.execute(
+                    query, parameters):
+                if topics is not None and not any(topic_matches_sub(topic_filter, topic) for topic_filter in topics):
+                    continue
+                entry = merged.get((topic, field_name, bucket_start))
+                if entry is None:
+                    merged[(topic, field_name, bucket_start)] = [count, minimum, maximum, total]
+                else:
+                    entry[0] += count
+                    entry[1] = min(entry[1], minimum)
+                    entry[2] = max(entry[2], maximum)
+                    entry[3] += total
+        finally:
+            connection.close()
+    return [(bucket_start, topic, field_name, count, minimum, maximum, total / count)
+            for (topic, field_name, bucket_start), (count, minimum, maximum, total)
+            in sorted(merged.items(), key=lambda item: (item[0][2], item[0][0], item[0][1]))]
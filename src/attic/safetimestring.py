@@ -4,7 +4,7 @@ import re
 import pathlib
 
 def datetime_to_safestring(timestamp: datetime.datetime) -> str:
-    unsafestring = datetime.datetime.now(tz=pytz.UTC).isoformat(timespec='microseconds')
+    unsafestring = timestamp.isoformat(timespec='microseconds')
     safestring = re.sub(r'[/:*?"<>|.]', '_', unsafestring)
     return safestring
 
@@ -0,0 +1,373 @@
+import io
+import json
+import pathlib
+import re
+import sqlite3
+import struct
+import typing
+
+from paho.mqtt.client import topic_matches_sub
+
+from .connections import filters_overlap
+from .reader import TimeBound, select_files, shard_folders, to_microseconds
+
+# optional dependency: only needed for the schemas of format "avro".
+try:
+    import fastavro
+except ImportError:
+    fastavro = None
+
+stdout = print
+
+# Schemas: per-topic declarations of the payload layout, with `schemas` in the configuration of a stream.
+# The payloads of the matching topics are decoded as they are written, and stored in a typed table per schema,
+# `decoded_<table> (reception_timestamp INTEGER, topic TEXT, <columns>)`, in the same log file.
+#
+#   schemas:
+#     - topic: "sensors/+/climate"
+#       table: "climate"
+#       format: "json"                     # the columns are dotted JSON paths, with numbers for list items
+#       columns:
+#         - {name: "temperature", path: "readings.0.celsius", type: "REAL"}
+#         - {name: "status", type: "TEXT"}  # the path defaults to the name
+#     - topic: "power/+"
+#       table: "power"
+#       format: "struct"                   # a binary layout, in the notation of python's struct module
+#       layout: "<Ifh"
+#       columns: ["sequence", "watts", "flags"]
+#       keep-raw: false                    # not in the raw table as well
+#     - topic: "events"
+#       table: "events"
+#       format: "avro"                     # an Avro datum without header, needs `pip install fastavro`
+#       schema: {type: "record", name: "Event", fields: [{name: "code", type: "int"}, ...]}
+#       columns: ["code"]                  # default: all the fields of a primitive type
+#
+# * a topic goes to the first schema that matches it.
+# * the rows are decoded a batch at a time with the writer stage, one at a time without.
+# * a payload that does not decode, or does not fit the column types, is stored in the raw table, as without a
+#   schema, and counted as undecodable. A decoded one goes to the typed table, and, unless `keep-raw: false`,
+#   to the raw table too. A missing JSON field is stored as NULL.
+# * the counts are in the performance report of the stream, as `decoded_count` and `undecodable_count`.
+# * `read_table` reads columns of a typed table into NumPy arrays, across the files and shards of a stream.
+# * compaction copies the typed tables of the files it replaces into the compacted file.
+# * the rows of a `keep-raw: false` schema are in its typed table only. The catalog counts them, from the
+#   `schema_tables` table of each file; `read_rows` does not return them, as they have no payload, and says so
+#   with a warning. A stream can not have both rollups and such a schema, and `attic replay` refuses to replay them.
+
+SCHEMA_FORMATS = ('json', 'struct', 'avro')
+# the typed tables of a file, with their topic filter, and whether their rows are in the raw table too
+SCHEMA_TABLES = 'CREATE TABLE IF NOT EXISTS schema_tables (name TEXT PRIMARY KEY, topic TEXT, keep_raw INTEGER)'
+COLUMN_TYPES = ('INTEGER', 'REAL', 'TEXT', 'BLOB')
+TABLE_PREFIX = 'decoded_'
+IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+# the topic -> schema cache is cleared when it grows past this, in case the topics never repeat
+ROUTE_CACHE_SIZE = 65536
+
+# struct format characters -> column type
+STRUCT_TYPES = {**{code: 'INTEGER' for code in 'bBhHiIlLqQnNP?'}, **{code: 'REAL' for code in 'efd'},
+                **{code: 'BLOB' for code in 'csp'}}
+# avro primitive types -> column type
+AVRO_TYPES = {'boolean': 'INTEGER', 'int': 'INTEGER', 'long': 'INTEGER', 'float': 'REAL', 'double': 'REAL',
+              'string': 'TEXT', 'bytes': 'BLOB'}
+
+
+def require_fastavro():
+    if fastavro is None:
+        raise RuntimeError('schemas of format "avro" need the fastavro package: pip install fastavro')
+
+
+def convert(value, column_type: str):
+    """ the value as stored in a column of `column_type`; raises ValueError if it does not fit """
+    if value is None:
+        return None
+    if column_type == 'INTEGER':
+        if isinstance(value, float) and value.is_integer():
+            return int(value)
+        if isinstance(value, int):
+            return int(value)
+    elif column_type == 'REAL':
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return float(value)
+    elif column_type == 'TEXT':
+        if isinstance(value, str):
+            return value
+        return json.dumps(value)
+    else:
+        if isinstance(value, (bytes, bytearray)):
+            return bytes(value)
+    raise ValueError(f'{value!r} is not {column_type}')
+
+
+class Schema:
+    """ one entry of `schemas`: how to decode the payloads of its topic, and its typed table. """
+
+    def __init__(self, schema_config: dict):
+        for key in ('topic', 'table', 'format'):
+            if key not in schema_config:
+                raise ValueError(f'schemas: a schema needs a {key}: {schema_config}')
+        self.topic = schema_config['topic']
+        if not IDENTIFIER.match(str(schema_config['table'])):
+            raise ValueError(f'schemas: table must be a plain identifier, not {schema_config["table"]!r}')
+        self.table = TABLE_PREFIX + schema_config['table']
+        self.format = schema_config['format']
+        if self.format not in SCHEMA_FORMATS:
+            raise ValueError(f'schemas: format must be one of {SCHEMA_FORMATS}')
+        self.keep_raw = bool(schema_config.get('keep-raw', True))
+        columns = [column if isinstance(column, dict) else {'name': column}
+                   for column in schema_config.get('columns') or []]
+        if self.format == 'json':
+            self.columns = [(column['name'], str(column.get('type', 'REAL')).upper()) for column in columns]
+            self.paths = [[int(key) if key.isdigit() else key for key in str(column.get('path', column['name'])).split('.')]
+                          for column in columns]
+            self.decode = self.decode_json
+        elif self.format == 'struct':
+            self.layout = struct.Struct(schema_config['layout'])
+            codes = []
+            for count, code in re.findall(r'(\d*)([xcbB?hHiIlLqQnNefdspP])', schema_config['layout']):
+                if code in 'sp':
+                    # "16s" is one field of 16 bytes
+                    codes.append(code)
+                elif code != 'x':
+                    codes.extend(code * int(count or 1))
+            if len(codes) != len(columns):
+                raise ValueError(f'schemas: layout {schema_config["layout"]!r} has {len(codes)} fields, '
+                                 f'but {len(columns)} columns are given')
+            self.columns = [(column['name'], str(column.get('type', STRUCT_TYPES[code])).upper())
+                            for column, code in zip(columns, codes)]
+            self.decode = self.decode_struct
+        else:
+            require_fastavro()
+            self.avro_schema = fastavro.parse_schema(schema_config['schema'])
+            fields = {}
+            for field in schema_config['schema']['fields']:
+                field_type = field['type']
+                if isinstance(field_type, list):
+                    # a nullable field, ["null", T]
+                    field_type = next((member for member in field_type if member != 'null'), 'null')
+                if isinstance(field_type, str) and field_type in AVRO_TYPES:
+                    fields[field['name']] = AVRO_TYPES[field_type]
+            names = [column['name'] for column in columns] or list(fields)
+            self.columns = [(name, str(column.get('type', fields.get(name, 'TEXT'))).upper())
+                            for name, column in zip(names, columns or [{}] * len(names))]
+            self.decode = self.decode_avro
+        if not self.columns:
+            raise ValueError(f'schemas: the schema of {self.topic} has no columns')
+        for name, column_type in self.columns:
+            if not IDENTIFIER.match(name) or name in ('reception_timestamp', 'topic'):
+                raise ValueError(f'schemas: {name!r} can not be a column name')
+            if column_type not in COLUMN_TYPES:
+                raise ValueError(f'schemas: column type must be one of {COLUMN_TYPES}')
+        self.column_types = [column_type for _, column_type in self.columns]
+        column_list = ', '.join(f'{name} {column_type}' for name, column_type in self.columns)
+        self.create_sql = (f'CREATE TABLE IF NOT EXISTS {self.table} '
+                           f'(reception_timestamp INTEGER, topic TEXT, {column_list})')
+        self.insert_sql = f'INSERT INTO {self.table} VALUES ({", ".join("?" * (len(self.columns) + 2))})'
+
+    def decode_json(self, payload: bytes) -> typing.Optional[list]:
+        try:
+            document = json.loads(payload)
+            values = []
+            for path, column_type in zip(self.paths, self.column_types):
+                value = document
+                for key in path:
+                    try:
+                        value = value[key]
+                    except (KeyError, IndexError):
+                        value = None
+                        break
+                values.append(convert(value, column_type))
+            return values
+        except (ValueError, TypeError):
+            return None
+
+    def decode_struct(self, payload: bytes) -> typing.Optional[list]:
+        try:
+            return [convert(value, column_type)
+                    for value, column_type in zip(self.layout.unpack(payload), self.column_types)]
+        except (struct.error, ValueError):
+            return None
+
+    def decode_avro(self, payload: bytes) -> typing.Optional[list]:
+        try:
+            record = fastavro.schemaless_reader(io.BytesIO(payload), self.avro_schema)
+            return [convert(record.get(name), column_type) for name, column_type in self.columns]
+        except Exception:
+            # whatever a truncated or foreign payload makes the avro reader raise
+            return None
+
+
+class SchemaDecoder:
+    """
+    The schemas of one stream. Shared by the log files of the stream, one after the other, and keeps the counts.
+    `split` writes the decodable rows of a batch to their typed tables, and returns the rows for the raw table.
+    """
+
+    def __init__(self, schema_configs: typing.Sequence[dict]):
+        self.schemas = [Schema(schema_config) for schema_config in schema_configs]
+        tables = [schema.table for schema in self.schemas]
+        if len(set(tables)) != len(tables):
+            raise ValueError(f'schemas: each schema needs a table of its own: {tables}')
+        # topic -> schema, or None
+        self.routes: typing.Dict[str, typing.Optional[Schema]] = {}
+        self.decoded_count = 0
+        self.undecodable_count = 0
+
+    def create_tables(self, connection: sqlite3.Connection):
+        connection.execute(SCHEMA_TABLES)
+        for schema in self.schemas:
+            connection.execute(schema.create_sql)
+            connection.execute('INSERT OR REPLACE INTO schema_tables VALUES (?, ?, ?)',
+                               (schema.table, schema.topic, int(schema.keep_raw)))
+
+    def keeps_raw(self) -> bool:
+        """ whether every decoded row is in the raw table too """
+        return all(schema.keep_raw for schema in self.schemas)
+
+    def schema_of(self, topic: str) -> typing.Optional[Schema]:
+        if len(self.routes) >= ROUTE_CACHE_SIZE:
+            self.routes = {}
+        schema = self.routes[topic] = next(
+            (schema for schema in self.schemas if topic_matches_sub(schema.topic, topic)), None)
+        return schema
+
+    def split(self, connection: sqlite3.Connection,
+              rows: typing.Sequence[typing.Tuple[int, str, bytes]]) -> typing.List[typing.Tuple[int, str, bytes]]:
+        raw = []
+        decoded: typing.Dict[Schema, list] = {}
+        routes = self.routes
+        for row in rows:
+            timestamp_unix, topic, payload = row
+            schema = routes[topic] if topic in routes else self.schema_of(topic)
+            if schema is None:
+                raw.append(row)
+                continue
+            values = schema.decode(payload)
+            if values is None:
+                self.undecodable_count += 1
+                raw.append(row)
+                continue
+            self.decoded_count += 1
+            decoded.setdefault(schema, []).append((timestamp_unix, topic, *values))
+            if schema.keep_raw:
+                raw.append(row)
+        for schema, decoded_rows in decoded.items():
+            connection.executemany(schema.insert_sql, decoded_rows)
+        return raw
+
+    def performance_report(self) -> dict:
+        return dict(decoded_count=self.decoded_count, undecodable_count=self.undecodable_count)
+
+
+def typed_tables(connection: sqlite3.Connection) -> typing.List[typing.Tuple[str, str]]:
+    """ (name, CREATE statement) of the typed tables of a log file """
+    return [(name, sql) for name, sql in connection.execute("SELECT name, sql FROM sqlite_master WHERE type = 'table'")
+            if name.startswith(TABLE_PREFIX)]
+
+
+def decoded_only_tables(connection: sqlite3.Connection,
+                        topics: typing.Optional[typing.Sequence[str]] = None) -> typing.List[str]:
+    """
+    the typed tables of a log file whose rows are not in its raw table, those of `keep-raw: false` schemas;
+    with `topics`, only those whose topic filter overlaps one of them.
+    """
+    if not connection.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'schema_tables'"
+                              ).fetchone()[0]:
+        return []
+    return [name for name, table_topic in connection.execute(
+                'SELECT name, topic FROM schema_tables WHERE keep_raw = 0 ORDER BY name')
+            if topics is None or any(filters_overlap(table_topic, topic_filter) for topic_filter in topics)]
+
+
+def decoded_only_topics(connection: sqlite3.Connection) -> typing.List[typing.Tuple[str, int, int, int]]:
+    """ per topic of the decoded_only_tables of a log file: (topic, row count, min and max reception_timestamp) """
+    rows = []
+    for name in decoded_only_tables(connection):
+        rows.extend(connection.execute(
+            f'SELECT topic, count(*), min(reception_timestamp), max(reception_timestamp) FROM {name} GROUP BY topic'))
+    return rows
+
+
+def merge_typed_tables(sources: typing.Iterable[sqlite3.Connection], target: sqlite3.Connection):
+    """ for compaction: the rows of the typed tables of the source files, oldest file first, into the target file """
+    for source in sources:
+        if source.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table' AND name = 'schema_tables'"
+                          ).fetchone()[0]:
+            target.execute(SCHEMA_TABLES)
+            target.executemany('INSERT OR REPLACE INTO schema_tables VALUES (?, ?, ?)',
+                               source.execute('SELECT * FROM schema_tables'))
+        for name, create_sql in typed_tables(source):
+            # sqlite keeps the statement without its IF NOT EXISTS
+            target.execute(create_sql.replace('CREATE TABLE', 'CREATE TABLE IF NOT EXISTS', 1))
+            column_count = len(source.execute(f'SELECT * FROM {name} LIMIT 0').description)
+            target.executemany(f'INSERT INTO {name} VALUES ({", ".join("?" * column_count)})',
+                               source.execute(f'SELECT * FROM {name} ORDER BY rowid'))
+
+
+def read_table(
+        stream_path: typing.Union[str, pathlib.Path],
+        table: str,
+        columns: typing.Optional[typing.Sequence[str]] = None,
+        start: TimeBound = None,
+        end: TimeBound = None,
+        topics: typing.Optional[typing.Sequence[str]] = None) -> dict:
+    """
+    the rows of the typed table `table` (as named in the schema) of a stream in [start, end), oldest first,
+    as a dict of NumPy arrays: `reception_timestamp` (int64), `topic` (object), and the columns.
+    INTEGER and REAL columns are int64 and float64 arrays; float64 with NaN for the NULLs of an INTEGER column.
+    """
+    import numpy as np
+    if isinstance(topics, str):
+        topics = [topics]
+    name = TABLE_PREFIX + table
+    start_us = to_microseconds(start)
+    end_us = to_microseconds(end)
+    conditions = []
+    parameters = []
+    if start_us is not None:
+        conditions.append('reception_timestamp >= ?')
+        parameters.append(start_us)
+    if end_us is not None:
+        conditions.append('reception_timestamp < ?')
+        parameters.append(end_us)
+    where = f' WHERE {" AND ".join(conditions)}' if conditions else ''
+
+    rows = []
+    column_types = None
+    for folder in shard_folders(stream_path):
+        for path in select_files(folder, start, end):
+            connection = sqlite3.connect(f'file:{pathlib.Path(path).as_posix()}?mode=ro', uri=True)
+            try:
+                table_info = connection.execute(f'PRAGMA table_info({name})').fetchall()
+                if not table_info:
+                    continue
+                types = {column_name: column_type for _, column_name, column_type, *_ in table_info}
+                selected = list(columns) if columns is not None else [column_name for _, column_name, *_ in table_info
+                                                                      if column_name not in ('reception_timestamp', 'topic')]
+                if column_types is None:
+                    column_types = [types[column_name] for column_name in selected]
+                query = f'SELECT reception_timestamp, topic, {", ".join(selected)} FROM {name}{where} ORDER BY rowid'
+                for row in connection.execute(query, parameters):
+                    if topics is None or any(topic_matches_sub(topic_filter, row[1]) for topic_filter in topics):
+                        rows.append(row)
+            finally:
+                connection.close()
+    if column_types is None:
+        selected = list(columns or [])
+        column_types = ['BLOB'] * len(selected)
+    # the shards side by side: in time order, stable for the rows of one file
+    rows.sort(key=lambda row: row[0])
+    result = dict(
+        reception_timestamp=np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows)),
+        topic=np.array([row[1] for row in rows], dtype=object),
+    )
+    for index, (column_name, column_type) in enumerate(zip(selected, column_types)):
+        values = [row[index + 2] for row in rows]
+        if column_type == 'REAL' or (column_type == 'INTEGER' and None in values):
+            result[column_name] = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+        elif column_type == 'INTEGER':
+            result[column_name] = np.array(values, dtype=np.int64)
+        else:
+            array = np.empty(len(values), dtype=object)
+            array[:] = values
+            result[column_name] = array
+    return result
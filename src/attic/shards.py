@@ -0,0 +1,137 @@
+import typing
+import zlib
+
+stdout = print
+
+# Sharding of one stream, with `shards: N` in its configuration.
+#
+# The messages of the stream are routed by a stable hash of their topic to N shards. Each shard has its own writer
+# stage and its own rotation engine, which writes its files under `shard-<k>` in the stream folder:
+#
+#   everything/shard-0/2024/03/01/2024-03-01T12_00_00_000000+00_00.sqlite
+#   everything/shard-1/2024/03/01/2024-03-01T12_00_00_000123+00_00.sqlite
+#
+# * a topic always goes to the same shard, across restarts too, and each shard writes in arrival order:
+#   the order of the messages of a topic is preserved.
+# * the shards commit in parallel, each on its own sqlite connection; sqlite releases the GIL while it works.
+# * the reader merges the shards back into one stream, by reception_timestamp; see `reader.shard_folders`.
+# * the catalog registers the files of all shards under the name of the stream.
+
+SHARD_FOLDER_PREFIX = 'shard-'
+# the topic -> shard cache is cleared when it grows past this, in case the topics never repeat
+ROUTE_CACHE_SIZE = 65536
+
+
+def shard_folder_name(shard_idx: int) -> str:
+    return f'{SHARD_FOLDER_PREFIX}{shard_idx}'
+
+
+def shard_of(topic: str, shard_count: int) -> int:
+    """ stable across processes and restarts, unlike hash() """
+    return zlib.crc32(topic.encode()) % shard_count
+
+
+class ShardState:
+    """
+    What the writer of one shard sees of its stream: the stop request and the metrics of the stream,
+    and an acknowledgement of its own. The stream acknowledges the stop request once all of its shards have.
+    """
+
+    def __init__(self, stream_state, group: typing.List['ShardState']):
+        self.stream_state = stream_state
+        self.metrics = stream_state.metrics
+        self.group = group
+        self.acknowledged = False
+
+    @classmethod
+    def group_of(cls, stream_state, shard_count: int) -> typing.List['ShardState']:
+        group = []
+        group.extend(cls(stream_state, group) for _ in range(shard_count))
+        return group
+
+    def now(self) -> float:
+        return self.stream_state.now()
+
+    @property
+    def stop_request(self) -> bool:
+        return self.stream_state.stop_request
+
+    @property
+    def stop_request_ack(self) -> bool:
+        return self.acknowledged
+
+    @stop_request_ack.setter
+    def stop_request_ack(self, value: bool):
+        self.acknowledged = value
+        if all(shard_state.acknowledged for shard_state in self.group):
+            self.stream_state.stop_request_ack = True
+
+
+class ShardedRotation:
+    """ the rotation engines of the shards of a stream, with the reporting and closing interface of one. """
+
+    def __init__(self, rotations: list):
+        self.rotations = rotations
+
+    def close(self):
+        for rotation in self.rotations:
+            rotation.close()
+
+    def performance_report(self) -> dict:
+        """ the sums over the shards; the profile of the first, and the longest of the last and max stalls. """
+        reports = [rotation.performance_report() for rotation in self.rotations]
+        report = dict(storage_profile=reports[0]['storage_profile'])
+        for name in reports[0]:
+            if name in ('rotation_stall_last_seconds', 'rotation_stall_max_seconds'):
+                report[name] = max(shard_report[name] for shard_report in reports)
+            elif name != 'storage_profile':
+                report[name] = sum(shard_report[name] for shard_report in reports)
+        report['shards'] = len(reports)
+        return report
+
+
+class ShardedWriter:
+    """ the writer stages of the shards of a stream, behind the interface of one; `put` routes by topic. """
+
+    def __init__(self, writers: list):
+        self.writers = writers
+        # topic -> writer
+        self.routes: typing.Dict[str, typing.Any] = {}
+
+    def start(self):
+        for writer in self.writers:
+            writer.start()
+
+    def join(self, timeout: typing.Optional[float] = None):
+        for writer in self.writers:
+            writer.join(timeout)
+
+    def put(self, timestamp_unix: int, topic: str, payload: bytes):
+        writer = self.routes.get(topic)
+        if writer is None:
+            if len(self.routes) >= ROUTE_CACHE_SIZE:
+                self.routes = {}
+            writer = self.routes[topic] = self.writers[shard_of(topic, len(self.writers))]
+        writer.put(timestamp_unix, topic, payload)
+
+    def queue_depth(self) -> int:
+        return sum(writer.queue_depth() for writer in self.writers)
+
+    @property
+    def written_count(self) -> int:
+        return sum(writer.written_count for writer in self.writers)
+
+    @property
+    def commit_count(self) -> int:
+        return sum(writer.commit_count for writer in self.writers)
+
+    def performance_report(self) -> dict:
+        """ the sums over the shards; for the spool, the fill level of the fullest shard. """
+        report = {}
+        for writer in self.writers:
+            for name, value in writer.performance_report().items():
+                if name == 'spool_fill':
+                    report[name] = max(report.get(name, 0.0), value)
+                else:
+                    report[name] = report.get(name, 0) + value
+        return report
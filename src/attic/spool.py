@@ -0,0 +1,362 @@
+import mmap
+import os
+import pathlib
+import struct
+import threading
+import time
+import typing
+import zlib
+
+from .state import StreamState
+from .storage import RotationEngine, open_log_file, utc_datetime
+from .writer import BatchWriter
+
+stdout = print
+
+# The optional spool of a stream: an append-only, memory-mapped ring buffer file, `spool.bin` in the stream folder.
+#
+# With the spool, the mqtt thread only appends the message to the spool; the drainer, a writer stage, moves it
+# into the sqlite files, and marks it drained once committed there.
+#
+# * crash safety: the spool lives in the page cache, so that a message appended to it survives a crash of the
+#   process (kill -9, out of memory, a bug), though not a crash of the machine. On the next start, whatever was not
+#   drained yet is replayed into a file of its own, named after its oldest message, and sealed. A message that was
+#   committed to sqlite just before the crash, but not yet marked drained, is replayed again: at-least-once.
+# * bounded shutdown: on a stop request, the drainer keeps draining for at most `spool-stop-seconds`, then commits,
+#   and leaves the rest in the spool, for the next start. The exit does not wait for a message to come in.
+# * backpressure: a burst that the drainer can not keep up with fills the spool, up to `spool-size-mib`.
+#   When it is full, `spool-overflow` decides:
+#   "block" waits for the drainer, which pushes back to the broker connection, as the writer queue does;
+#   "drop-newest" drops the incoming message; "drop-oldest" drops the oldest messages not read by the drainer yet,
+#   and, if the drainer holds messages that it has not committed yet, waits for that commit to free their space.
+#   The fill level is in the performance report, as `spool_fill`, and in the metrics.
+#   A message larger than half the spool is always dropped.
+#
+# Layout: a header of HEADER_SIZE bytes, then the ring of `capacity` bytes, of records:
+#   size (u32, the whole record), crc32 of topic and payload (u32), sequence (u64), reception timestamp (i64),
+#   topic length (u16), topic, payload.
+# A record never wraps: when it does not fit before the end of the ring, the rest is skipped, marked by a size of 0
+# when there is room for that. The sequence numbers grow by one per record, across restarts;
+# the header holds the position and the sequence number of the oldest record not drained yet.
+# Recovery reads from there for as long as the records are complete and in sequence.
+
+SPOOL_FILE_NAME = 'spool.bin'
+MAGIC = b'ATTICSPL'
+VERSION = 1
+HEADER = struct.Struct('<8sIIQQQ')  # magic, version, reserved, capacity, drained offset, drained sequence
+HEADER_SIZE = 64
+RECORD = struct.Struct('<IIQqH')  # size, crc32, sequence, timestamp, topic length
+WRAP = struct.Struct('<I')
+OVERFLOW_POLICIES = ('block', 'drop-newest', 'drop-oldest')
+# how often the drainer looks at an empty spool, and a blocked append at a full one
+SPOOL_POLL_SECONDS = 0.02
+BLOCK_POLL_SECONDS = 0.001
+
+
+class Spool:
+    """ see the top of this module. `append` from one thread, `read` and `mark_drained` from another one. """
+
+    def __init__(self, path: typing.Union[str, pathlib.Path], capacity: int, overflow: str = 'block'):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError(f'unknown spool overflow policy {overflow!r}, expected one of {OVERFLOW_POLICIES}')
+        self.path = pathlib.Path(path)
+        self.capacity = int(capacity)
+        self.overflow = overflow
+        self.lock = threading.Lock()
+        self.closed = False
+        # positions in bytes since the start, not wrapped; the offset in the ring is position % capacity
+        self.written = 0
+        self.read_position = 0
+        self.drained = 0
+        self.next_sequence = 0
+        self.read_sequence = 0
+        self.drained_sequence = 0
+        # counters, for the performance report
+        self.appended_count = 0
+        self.read_count = 0
+        self.dropped_count = 0
+        self.file = None
+        self.buffer: typing.Optional[mmap.mmap] = None
+        self.open()
+
+    # file handling
+    ###############################################################################################
+
+    def open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if self.path.exists() and self.path.stat().st_size >= HEADER_SIZE:
+            self.file = open(self.path, 'r+b')
+            self.buffer = mmap.mmap(self.file.fileno(), 0)
+            magic, version, _, capacity, offset, sequence = HEADER.unpack_from(self.buffer, 0)
+            if magic == MAGIC and version == VERSION and len(self.buffer) == HEADER_SIZE + capacity:
+                # the undrained records are read by `undrained`, before `reset`
+                self.recovered = (capacity, offset, sequence)
+                self.next_sequence = sequence
+                return
+            stdout(f'{self.path} is not a spool file of this version, starting a new one.')
+            self.close_file()
+        self.recovered = None
+        self.create()
+
+    def create(self):
+        self.file = open(self.path, 'w+b')
+        self.file.truncate(HEADER_SIZE + self.capacity)
+        if hasattr(os, 'posix_fallocate'):
+            # allocate the blocks now: a write to a memory-mapped hole on a full disk kills the process.
+            os.posix_fallocate(self.file.fileno(), 0, HEADER_SIZE + self.capacity)
+        self.buffer = mmap.mmap(self.file.fileno(), 0)
+        self.write_header()
+
+    def close_file(self):
+        self.buffer.close()
+        self.file.close()
+        self.buffer = None
+        self.file = None
+
+    def write_header(self):
+        HEADER.pack_into(self.buffer, 0, MAGIC, VERSION, 0, self.capacity,
+                         self.drained % self.capacity, self.drained_sequence)
+
+    def undrained(self) -> typing.Iterator[typing.Tuple[int, str, bytes]]:
+        """ the records left undrained by the previous run, oldest first; call once, before `reset`. """
+        if self.recovered is None:
+            return
+        capacity, offset, sequence = self.recovered
+        scanned = 0
+        while scanned < capacity:
+            remaining = capacity - offset
+            if remaining < RECORD.size:
+                scanned += remaining
+                offset = 0
+                continue
+            size, crc, record_sequence, timestamp, topic_length = RECORD.unpack_from(self.buffer, HEADER_SIZE + offset)
+            if size == 0:
+                scanned += remaining
+                offset = 0
+                continue
+            if record_sequence != sequence or size < RECORD.size + topic_length or size > remaining:
+                return
+            start = HEADER_SIZE + offset + RECORD.size
+            topic = self.buffer[start:start + topic_length]
+            payload = self.buffer[start + topic_length:HEADER_SIZE + offset + size]
+            if zlib.crc32(payload, zlib.crc32(topic)) != crc:
+                return
+            yield timestamp, topic.decode(), payload
+            sequence += 1
+            self.next_sequence = sequence
+            offset += size
+            scanned += size
+
+    def reset(self):
+        """ forget the records of the previous run, once replayed; re-create the file if its size changed. """
+        if self.recovered is not None and self.recovered[0] != self.capacity:
+            self.close_file()
+            self.create()
+        self.recovered = None
+        self.read_sequence = self.drained_sequence = self.next_sequence
+        self.write_header()
+
+    def close(self):
+        """ after the last `mark_drained`: blocked appends give up, and the header is written to the file. """
+        self.closed = True
+        with self.lock:
+            self.buffer.flush()
+
+    # the mqtt thread
+    ###############################################################################################
+
+    def append(self, timestamp_unix: int, topic: str, payload: bytes) -> bool:
+        """ False if the message was dropped. """
+        if self.closed:
+            return False
+        topic_bytes = topic.encode()
+        size = RECORD.size + len(topic_bytes) + len(payload)
+        offset = self.written % self.capacity
+        remaining = self.capacity - offset
+        padding = remaining if remaining < size else 0
+        # a record of more than half the ring might not fit even into an empty one, after the skipped end.
+        if size > self.capacity // 2 or (self.written + padding + size - self.drained > self.capacity
+                                    and not self.make_room(padding + size)):
+            self.dropped_count += 1
+            return False
+        buffer = self.buffer
+        if padding:
+            if padding >= RECORD.size:
+                WRAP.pack_into(buffer, HEADER_SIZE + offset, 0)
+            offset = 0
+        start = HEADER_SIZE + offset + RECORD.size
+        topic_end = start + len(topic_bytes)
+        buffer[start:topic_end] = topic_bytes
+        buffer[topic_end:topic_end + len(payload)] = payload
+        # the record header last: a record with its sequence number in place is complete.
+        RECORD.pack_into(buffer, HEADER_SIZE + offset, size, zlib.crc32(payload, zlib.crc32(topic_bytes)),
+                         self.next_sequence, timestamp_unix, len(topic_bytes))
+        self.next_sequence += 1
+        self.appended_count += 1
+        self.written += padding + size
+        return True
+
+    def make_room(self, needed: int) -> bool:
+        """ apply the overflow policy; True if there is room for `needed` bytes now. """
+        if self.overflow == 'block':
+            while self.written + needed - self.drained > self.capacity:
+                if self.closed:
+                    return False
+                time.sleep(BLOCK_POLL_SECONDS)
+            return True
+        if self.overflow == 'drop-oldest':
+            with self.lock:
+                # the oldest records not read yet. Those read already are the drainer's: their space is freed when
+                # it has committed them, never before, or a crash until then would lose them.
+                in_flight = self.read_position > self.drained
+                while self.written + needed - self.read_position > self.capacity and self.read_position < self.written:
+                    position, sequence, record = self.next_record(self.read_position, self.read_sequence)
+                    self.read_position, self.read_sequence = position, sequence
+                    if record is not None:
+                        self.dropped_count += 1
+                        self.read_count += 1
+                if not in_flight:
+                    self.drained, self.drained_sequence = self.read_position, self.read_sequence
+                    self.write_header()
+            # the dropped records are marked drained with the next commit of the records read before them.
+            while self.written + needed - self.drained > self.capacity:
+                if self.closed:
+                    return False
+                time.sleep(BLOCK_POLL_SECONDS)
+            return True
+        return False  # drop-newest
+
+    # the drainer
+    ###############################################################################################
+
+    def next_record(self, position: int, sequence: int) -> typing.Tuple[int, int, typing.Optional[tuple]]:
+        """ the record at `position`, or None for the skipped end of the ring, and the position after it. """
+        offset = position % self.capacity
+        remaining = self.capacity - offset
+        if remaining < RECORD.size:
+            return position + remaining, sequence, None
+        size, _, record_sequence, timestamp, topic_length = RECORD.unpack_from(self.buffer, HEADER_SIZE + offset)
+        if size == 0:
+            return position + remaining, sequence, None
+        start = HEADER_SIZE + offset + RECORD.size
+        record = (timestamp, self.buffer[start:start + topic_length].decode(),
+                  self.buffer[start + topic_length:HEADER_SIZE + offset + size])
+        return position + size, record_sequence + 1, record
+
+    def read(self, max_count: int) -> typing.List[typing.Tuple[int, str, bytes]]:
+        """ up to `max_count` of the records not read yet, oldest first. """
+        rows = []
+        with self.lock:
+            written = self.written
+            position, sequence = self.read_position, self.read_sequence
+            while position < written and len(rows) < max_count:
+                position, sequence, record = self.next_record(position, sequence)
+                if record is not None:
+                    rows.append(record)
+            self.read_position, self.read_sequence = position, sequence
+            self.read_count += len(rows)
+        return rows
+
+    def mark_drained(self):
+        """ everything read so far is committed to sqlite. """
+        with self.lock:
+            if self.read_position > self.drained:
+                self.drained, self.drained_sequence = self.read_position, self.read_sequence
+                self.write_header()
+
+    def depth(self) -> int:
+        """ records appended but not read yet """
+        return self.appended_count - self.read_count
+
+    def performance_report(self) -> dict:
+        used = self.written - self.drained
+        return dict(
+            spool_bytes=used,
+            spool_fill=used / self.capacity,
+            spool_dropped=self.dropped_count,
+        )
+
+
+class SpoolWriter(BatchWriter):
+    """
+    The writer stage of a stream with a spool: `put` appends to the spool, and this thread drains it
+    into the sqlite files, with the batching and commits of `BatchWriter`. See the top of this module.
+
+    The spool left by the previous run is replayed when the writer is created, before any new message comes in.
+    """
+
+    def __init__(
+            self,
+            stream_state: StreamState,
+            rotation: RotationEngine,
+            spool_path: typing.Union[str, pathlib.Path] = SPOOL_FILE_NAME,
+            spool_size_bytes: int = 64 << 20,
+            overflow: str = 'block',
+            stop_seconds: float = 2.0,
+            queue_size: int = 100000,
+            batch_size: int = 1000,
+            batch_seconds: float = 1.0,
+            name: str = 'attic-writer'):
+        # the queue of BatchWriter stays empty: the spool takes its place.
+        super().__init__(stream_state, rotation, queue_size=queue_size, batch_size=batch_size,
+                         batch_seconds=batch_seconds, name=name)
+        self.spool = Spool(spool_path, spool_size_bytes, overflow)
+        self.stop_seconds = stop_seconds
+        self.stop_deadline: typing.Optional[float] = None
+        self.replayed_count = self.replay()
+
+    def replay(self) -> int:
+        """ write the records left in the spool by the previous run into a file of their own, and seal it. """
+        log_file = None
+        count = 0
+        batch = []
+        for row in self.spool.undrained():
+            if log_file is None:
+                # named after the oldest record, as every log file is named after the oldest data it may hold.
+                log_file = open_log_file(self.rotation.q_stream_path, self.rotation.profile,
+                                         utc_datetime(row[0] / 1e6), schemas=self.rotation.schemas)
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                log_file.insert_many(batch)
+                count += len(batch)
+                batch = []
+        if log_file is not None:
+            if batch:
+                log_file.insert_many(batch)
+                count += len(batch)
+            # with its rollups, and registered in the catalog, as the rotation engine seals every file
+            self.rotation.seal_file(log_file)
+            stdout(f'{self.name} | replayed {count} messages from the spool into {log_file.path}')
+        self.spool.reset()
+        return count
+
+    def put(self, timestamp_unix: int, topic: str, payload: bytes):
+        self.spool.append(timestamp_unix, topic, payload)
+
+    def queue_depth(self) -> int:
+        return self.spool.depth()
+
+    def collect_batch(self, timeout: float) -> list:
+        batch = self.spool.read(self.batch_size)
+        if not batch and timeout > 0:
+            time.sleep(min(timeout, SPOOL_POLL_SECONDS))
+            batch = self.spool.read(self.batch_size)
+        return batch
+
+    def committed(self):
+        self.spool.mark_drained()
+
+    def stop_ready(self, batch: list) -> bool:
+        # drain for at most stop_seconds; what is left stays in the spool, for the next start.
+        if self.stop_deadline is None:
+            self.stop_deadline = time.time() + self.stop_seconds
+        return not batch or time.time() >= self.stop_deadline
+
+    def finish(self):
+        self.spool.close()
+
+    def performance_report(self) -> dict:
+        report = super().performance_report()
+        report.update(self.spool.performance_report())
+        report.update(spool_replayed=self.replayed_count)
+        return report
@@ -0,0 +1,83 @@
+import datetime
+import time
+import typing
+
+import pytz
+
+# The runtime state of one stream, held directly by its on_message closure.
+#
+# The hot path reads the clock once per message, `time.monotonic()`, and derives everything from that read:
+# * the reception timestamp, as `monotonic + clock_offset`; the offset (wall clock - monotonic clock) is
+#   re-read at the end of every sampled message (see below), and by the monitor at every snapshot, for a quiet
+#   stream, so that a wall clock step shows up within PROCESSING_SAMPLE_PERIOD messages.
+# * the idle time, and the rotation check. The rotation, and the file names, follow the reception timestamps,
+#   with or without a writer stage: one clock for everything a stream writes, see storage.RotationEngine.
+# The processing time needs a second read, at the end of the message: that is done for one message in
+# PROCESSING_SAMPLE_PERIOD only, and the totals are scaled back up. The ISO timestamp is not formatted per
+# message anymore: `snapshot()` derives it from the last reception timestamp.
+#
+# Thread safety: only the thread that runs the closure writes the counters, and it brackets every update with
+# two increments of `sequence`. `snapshot()`, from any thread, retries until it reads the same even `sequence`
+# before and after the copy, so that the counters it returns belong to the same message.
+
+# one message in PROCESSING_SAMPLE_PERIOD has its processing time measured; a power of 2.
+PROCESSING_SAMPLE_PERIOD = 16
+PROCESSING_SAMPLE_MASK = PROCESSING_SAMPLE_PERIOD - 1
+
+
+def clock_offset() -> float:
+    """ seconds to add to time.monotonic() to get the unix time """
+    return time.time() - time.monotonic()
+
+
+class StreamState:
+    """ see the top of this module. """
+    __slots__ = ('stream_idx', 'intended_topic', 'rotation', 'writer', 'metrics',
+                 'stop_request', 'stop_request_ack',
+                 'sequence', 'message_count', 'last_rx_timestamp_unix', 'clock_offset',
+                 'sampled_end_time', 'sampled_idle_time', 'sampled_processing_time')
+
+    def __init__(self, stream_idx: int = 0, intended_topic: str = '', rotation=None, metrics=None):
+        self.stream_idx = stream_idx
+        self.intended_topic = intended_topic
+        self.rotation = rotation
+        self.writer = None
+        self.metrics = metrics
+        self.stop_request = False
+        self.stop_request_ack = False
+        self.sequence = 0  # odd while the closure is updating the counters
+        self.message_count = 0
+        self.last_rx_timestamp_unix: typing.Optional[int] = None  # microseconds since epoch
+        self.clock_offset = clock_offset()
+        # end of the last sampled message, until the next message measures its idle time from it
+        self.sampled_end_time: typing.Optional[float] = None
+        self.sampled_idle_time = 0.0
+        self.sampled_processing_time = 0.0
+
+    def now(self) -> float:
+        """ the unix time, from the same clock as the reception timestamps """
+        return time.monotonic() + self.clock_offset
+
+    def counters(self) -> typing.Tuple[int, typing.Optional[int], float, float]:
+        """ message count, last reception timestamp, sampled idle time and sampled processing time, consistently """
+        while True:
+            sequence = self.sequence
+            counters = (self.message_count, self.last_rx_timestamp_unix,
+                        self.sampled_idle_time, self.sampled_processing_time)
+            if not sequence & 1 and sequence == self.sequence:
+                return counters
+            time.sleep(0)  # let the writer finish
+
+    def snapshot(self) -> dict:
+        """ the counters, in the format of the performance message; also re-reads the clock offset. """
+        self.clock_offset = clock_offset()
+        message_count, last_rx_timestamp_unix, sampled_idle_time, sampled_processing_time = self.counters()
+        return dict(
+            messageCount=message_count,
+            totalIdleTime=sampled_idle_time * PROCESSING_SAMPLE_PERIOD,
+            totalProcessingTime=sampled_processing_time * PROCESSING_SAMPLE_PERIOD,
+            lastRxTimestamp_unix=last_rx_timestamp_unix,
+            lastRxTimestamp_iso_string=None if last_rx_timestamp_unix is None else datetime.datetime.fromtimestamp(
+                last_rx_timestamp_unix / 1e6, tz=pytz.UTC).isoformat(timespec='microseconds'),
+            metrics=self.metrics,
+        )
@@ -0,0 +1,690 @@
+import bisect
+import datetime  # for storage addressing
+import pathlib
+import queue  # for handing work over to the rotation thread
+import sqlite3  # for saving the data
+import threading
+import time
+import typing
+
+import pytz
+
+from .compression import COMPRESSION_MODES, DICTIONARY_MODES, PayloadCompressor, require_zstandard
+from .dedup import PayloadDeduplicator
+from .rollup import write_rollups
+from .schemas import SchemaDecoder
+from .safetimestring import datetime_to_safestring, timefolders
+
+stdout = print
+
+# Storage profiles: how each log file is opened and sealed.
+# A stream selects one by name with `storage-profile`;
+# more can be defined, or these overridden, in the `storage-profiles` section of the config file.
+#
+# * journal-mode: sqlite journal mode while the file is being written. None leaves the sqlite default.
+#   A file written in WAL mode is switched back to a rollback journal when it is sealed,
+#   so that the sealed file is a single, self-contained file again.
+# * synchronous: sqlite `synchronous` setting, OFF, NORMAL, FULL or EXTRA. None leaves the sqlite default.
+# * page-size: in bytes, a power of two between 512 and 65536. None leaves the sqlite default.
+# * cache-size-kib: page cache size of the connection. None leaves the sqlite default.
+# * deferred-index: if true, the topic index is not maintained on insert,
+#   but built once, when the file is sealed.
+# * schema-version: layout of the data in the file, see SCHEMA_VERSIONS below.
+# * compression: None, or "zstd" to compress each payload with a zstd dictionary stored in the same file.
+#   Needs schema version 2. See compression.PayloadCompressor.
+# * compression-level: zstd compression level.
+# * compression-dictionary: "topic" for a dictionary per topic, "stream" for one dictionary per file.
+# * compression-train-messages: number of payloads, from the start of each file, to train a dictionary on.
+# * compression-dictionary-bytes: maximum size of a dictionary.
+# * dedup: if true, each distinct payload of at least `dedup-min-bytes` is stored once per file.
+#   Needs schema version 2, and no compression. See dedup.PayloadDeduplicator.
+# * dedup-min-bytes: smaller payloads are stored in the row, as without dedup.
+# * dedup-cache-entries: number of recent payload hashes kept in memory, per file.
+STORAGE_PROFILES = {
+    'default': {
+        'journal-mode': None,
+        'synchronous': None,
+        'page-size': None,
+        'cache-size-kib': None,
+        'deferred-index': False,
+        'schema-version': 1,
+        'compression': None,
+        'compression-level': 3,
+        'compression-dictionary': 'topic',
+        'compression-train-messages': 1000,
+        'compression-dictionary-bytes': 16384,
+        'dedup': False,
+        'dedup-min-bytes': 32,
+        'dedup-cache-entries': 4096,
+    },
+    'max-throughput': {
+        'journal-mode': 'WAL',
+        'synchronous': 'OFF',
+        'page-size': 65536,
+        'cache-size-kib': 65536,
+        'deferred-index': True,
+        'schema-version': 2,
+        'compression': None,
+        'compression-level': 3,
+        'compression-dictionary': 'topic',
+        'compression-train-messages': 1000,
+        'compression-dictionary-bytes': 16384,
+        'dedup': False,
+        'dedup-min-bytes': 32,
+        'dedup-cache-entries': 4096,
+    },
+    'durable': {
+        'journal-mode': 'WAL',
+        'synchronous': 'FULL',
+        'page-size': None,
+        'cache-size-kib': None,
+        'deferred-index': False,
+        'schema-version': 1,
+        'compression': None,
+        'compression-level': 3,
+        'compression-dictionary': 'topic',
+        'compression-train-messages': 1000,
+        'compression-dictionary-bytes': 16384,
+        'dedup': False,
+        'dedup-min-bytes': 32,
+        'dedup-cache-entries': 4096,
+    },
+}
+
+# Layout of the data in a log file. The version is stored in the file, as `PRAGMA user_version`.
+#
+# * 1: one table, `data (reception_timestamp INTEGER, topic TEXT, payload BLOB)`, with the index `topics` on topic.
+#   user_version is 0 in such files.
+# * 2: dictionary-encoded topics. The table `topics (id, name)` holds each topic of the file once,
+#   and `records (reception_timestamp INTEGER, topic_id INTEGER, payload BLOB)` refers to it by id,
+#   with the index `records_topic_id` on topic_id.
+#   The view `data (reception_timestamp, topic, payload)` presents the same columns as version 1,
+#   so that tools reading version 1 files keep working.
+#   With compression, `records` has a fourth column, `dictionary_id`, and the file has a `dictionaries` table;
+#   there is no `data` view then, as it would return the payloads compressed: read such files with attic.reader,
+#   or compression.read_data.
+#   With dedup, `records` has a fourth column, `blob_id`, and the file has a `blobs` table;
+#   the `data` view returns the full payloads. See dedup.payload_source to query `records` directly.
+SCHEMA_VERSIONS = (1, 2)
+
+JOURNAL_MODES = ('DELETE', 'TRUNCATE', 'PERSIST', 'MEMORY', 'WAL', 'OFF')
+SYNCHRONOUS_MODES = ('OFF', 'NORMAL', 'FULL', 'EXTRA')
+
+
+def resolve_storage_profile(name: str, custom_profiles: typing.Optional[dict] = None) -> dict:
+    """
+    look up a storage profile by name, in the config file's `storage-profiles` first, then in the built-in ones.
+    Keys missing from a custom profile take the value of the `default` profile.
+    """
+    custom_profiles = custom_profiles or {}
+    if name in custom_profiles:
+        unknown_keys = set(custom_profiles[name]) - set(STORAGE_PROFILES['default'])
+        if unknown_keys:
+            raise ValueError(f'storage profile {name}: unknown settings {sorted(unknown_keys)}')
+        profile = {**STORAGE_PROFILES['default'], **custom_profiles[name]}
+    elif name in STORAGE_PROFILES:
+        profile = dict(STORAGE_PROFILES[name])
+    else:
+        raise ValueError(f'unknown storage profile {name!r}, '
+                         f'known profiles: {sorted(set(STORAGE_PROFILES) | set(custom_profiles))}')
+    if profile['journal-mode'] is not None:
+        profile['journal-mode'] = str(profile['journal-mode']).upper()
+        if profile['journal-mode'] not in JOURNAL_MODES:
+            raise ValueError(f'storage profile {name}: journal-mode must be one of {JOURNAL_MODES}')
+    if profile['synchronous'] is not None:
+        profile['synchronous'] = str(profile['synchronous']).upper()
+        if profile['synchronous'] not in SYNCHRONOUS_MODES:
+            raise ValueError(f'storage profile {name}: synchronous must be one of {SYNCHRONOUS_MODES}')
+    if profile['page-size'] is not None:
+        page_size = int(profile['page-size'])
+        if page_size < 512 or page_size > 65536 or page_size & (page_size - 1):
+            raise ValueError(f'storage profile {name}: page-size must be a power of two between 512 and 65536')
+        profile['page-size'] = page_size
+    if profile['cache-size-kib'] is not None:
+        profile['cache-size-kib'] = int(profile['cache-size-kib'])
+    profile['schema-version'] = int(profile['schema-version'])
+    if profile['schema-version'] not in SCHEMA_VERSIONS:
+        raise ValueError(f'storage profile {name}: schema-version must be one of {SCHEMA_VERSIONS}')
+    if profile['compression'] not in COMPRESSION_MODES:
+        raise ValueError(f'storage profile {name}: compression must be one of {COMPRESSION_MODES}')
+    if profile['compression'] is not None:
+        if profile['schema-version'] < 2:
+            raise ValueError(f'storage profile {name}: compression needs schema-version 2')
+        if profile['compression-dictionary'] not in DICTIONARY_MODES:
+            raise ValueError(f'storage profile {name}: compression-dictionary must be one of {DICTIONARY_MODES}')
+        require_zstandard()
+    profile['dedup'] = bool(profile['dedup'])
+    if profile['dedup']:
+        if profile['schema-version'] < 2:
+            raise ValueError(f'storage profile {name}: dedup needs schema-version 2')
+        if profile['compression'] is not None:
+            raise ValueError(f'storage profile {name}: dedup cannot be combined with compression')
+        profile['dedup-min-bytes'] = int(profile['dedup-min-bytes'])
+        profile['dedup-cache-entries'] = int(profile['dedup-cache-entries'])
+        if profile['dedup-cache-entries'] < 1:
+            raise ValueError(f'storage profile {name}: dedup-cache-entries must be at least 1')
+    profile['name'] = name
+    return profile
+
+
+class LogFile:
+    """
+    One sqlite log file of a stream.
+
+    The connection is opened with `check_same_thread=False`, because the file is created by the rotation thread,
+    written to by the ingest thread, and sealed by the rotation thread again.
+    At any point in time, only one of these threads uses it.
+
+    With a SchemaDecoder (see schemas.py), the payloads of its topics are decoded into typed tables on insert.
+    """
+
+    def __init__(self, sqlite_db_path: pathlib.Path, profile: typing.Optional[dict] = None,
+                 schemas: typing.Optional[SchemaDecoder] = None):
+        self.path = sqlite_db_path
+        self.profile = profile if profile is not None else resolve_storage_profile('default')
+        self.connection = sqlite3.connect(sqlite_db_path, check_same_thread=False)
+        # the page size must be set before the first table is created, and before switching to WAL.
+        if self.profile['page-size'] is not None:
+            self.connection.execute(f'PRAGMA page_size = {self.profile["page-size"]}')
+        if self.profile['journal-mode'] is not None:
+            self.connection.execute(f'PRAGMA journal_mode = {self.profile["journal-mode"]}')
+        if self.profile['synchronous'] is not None:
+            self.connection.execute(f'PRAGMA synchronous = {self.profile["synchronous"]}')
+        if self.profile['cache-size-kib'] is not None:
+            # negative: the size is in KiB rather than in pages.
+            self.connection.execute(f'PRAGMA cache_size = {-self.profile["cache-size-kib"]}')
+        self.schema_version = self.profile['schema-version']
+        self.deduplicator = None
+        if self.schema_version == 1:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS data (reception_timestamp INTEGER, topic TEXT, payload BLOB)')
+        else:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS topics (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE)')
+            if self.profile['dedup']:
+                self.connection.execute(
+                    'CREATE TABLE IF NOT EXISTS records '
+                    '(reception_timestamp INTEGER, topic_id INTEGER, payload BLOB, blob_id INTEGER)')
+                # creates the blobs table
+                self.deduplicator = PayloadDeduplicator(self.connection, self.profile)
+                self.connection.execute(
+                    'CREATE VIEW IF NOT EXISTS data AS '
+                    'SELECT records.reception_timestamp AS reception_timestamp, topics.name AS topic, '
+                    'ifnull(records.payload, blobs.payload) AS payload '
+                    'FROM records JOIN topics ON topics.id = records.topic_id '
+                    'LEFT JOIN blobs ON blobs.id = records.blob_id')
+            elif self.profile['compression'] is None:
+                self.connection.execute(
+                    'CREATE TABLE IF NOT EXISTS records '
+                    '(reception_timestamp INTEGER, topic_id INTEGER, payload BLOB)')
+                self.connection.execute(
+                    'CREATE VIEW IF NOT EXISTS data AS '
+                    'SELECT records.reception_timestamp AS reception_timestamp, topics.name AS topic, '
+                    'records.payload AS payload '
+                    'FROM records JOIN topics ON topics.id = records.topic_id')
+            else:
+                # no `data` view: it would return the compressed payloads to tools that expect the original ones.
+                self.connection.execute(
+                    'CREATE TABLE IF NOT EXISTS records '
+                    '(reception_timestamp INTEGER, topic_id INTEGER, payload BLOB, dictionary_id INTEGER)')
+            self.connection.execute(f'PRAGMA user_version = {self.schema_version}')
+        self.schemas = schemas
+        if self.schemas is not None:
+            self.schemas.create_tables(self.connection)
+        if not self.profile['deferred-index']:
+            self.create_index()
+        self.connection.commit()
+        self.row_count = 0
+        self.page_size = None
+        # schema 2: topic -> id, for the topics of this file.
+        self.topic_ids = {}
+        self.compressor = None
+        if self.profile['compression'] is not None:
+            self.compressor = PayloadCompressor(self.connection, self.profile)
+            self.connection.commit()
+
+    def create_index(self):
+        # this is so that at read time, the data can be quickly filtered by topic.
+        if self.schema_version == 1:
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS topics ON data (topic)')
+        else:
+            self.connection.execute(
+                'CREATE INDEX IF NOT EXISTS records_topic_id ON records (topic_id)')
+
+    def topic_id(self, topic: str) -> int:
+        topic_id = self.topic_ids.get(topic)
+        if topic_id is None:
+            topic_id = self.connection.execute("INSERT INTO topics (name) VALUES (?)", (topic,)).lastrowid
+            self.topic_ids[topic] = topic_id
+        return topic_id
+
+    def insert(self, timestamp_unix: int, topic: str, payload: bytes):
+        if self.schemas is not None and not self.schemas.split(self.connection, ((timestamp_unix, topic, payload),)):
+            # decoded, into its typed table only
+            self.row_count += 1
+            return
+        if self.schema_version == 1:
+            self.connection.execute("INSERT INTO data VALUES (?, ?, ?)", (timestamp_unix, topic, payload))
+        elif self.deduplicator is not None:
+            topic_id = self.topic_ids.get(topic) or self.topic_id(topic)
+            self.connection.execute("INSERT INTO records VALUES (?, ?, ?, ?)",
+                                    (timestamp_unix, topic_id, *self.deduplicator.encode(payload)))
+        elif self.compressor is None:
+            topic_id = self.topic_ids.get(topic) or self.topic_id(topic)
+            self.connection.execute("INSERT INTO records VALUES (?, ?, ?)", (timestamp_unix, topic_id, payload))
+        else:
+            topic_id = self.topic_ids.get(topic) or self.topic_id(topic)
+            self.connection.execute("INSERT INTO records VALUES (?, ?, ?, ?)",
+                                    (timestamp_unix, topic_id, *self.compressor.encode(topic_id, payload)))
+        self.row_count += 1
+
+    def insert_many(self, rows: typing.Sequence[typing.Tuple[int, str, bytes]]):
+        # the row count is of all the rows, also those that went to the typed tables only
+        row_count = len(rows)
+        if self.schemas is not None:
+            rows = self.schemas.split(self.connection, rows)
+        if self.schema_version == 1:
+            self.connection.executemany("INSERT INTO data VALUES (?, ?, ?)", rows)
+        elif self.deduplicator is not None:
+            topic_ids = self.topic_ids
+            encode = self.deduplicator.encode
+            self.connection.executemany(
+                "INSERT INTO records VALUES (?, ?, ?, ?)",
+                [(timestamp_unix, topic_ids.get(topic) or self.topic_id(topic), *encode(payload))
+                 for timestamp_unix, topic, payload in rows])
+        elif self.compressor is None:
+            topic_ids = self.topic_ids
+            self.connection.executemany(
+                "INSERT INTO records VALUES (?, ?, ?)",
+                [(timestamp_unix, topic_ids.get(topic) or self.topic_id(topic), payload)
+                 for timestamp_unix, topic, payload in rows])
+        else:
+            topic_ids = self.topic_ids
+            encode = self.compressor.encode
+            for timestamp_unix, topic, payload in rows:
+                topic_id = topic_ids.get(topic) or self.topic_id(topic)
+                self.connection.execute("INSERT INTO records VALUES (?, ?, ?, ?)",
+                                        (timestamp_unix, topic_id, *encode(topic_id, payload)))
+        self.row_count += row_count
+
+    def commit(self):
+        self.connection.commit()
+
+    def size_bytes(self) -> int:
+        """ the size of the database, with the rows not committed yet, and those still in the WAL """
+        if self.page_size is None:
+            self.page_size = self.connection.execute('PRAGMA page_size').fetchone()[0]
+        return self.connection.execute('PRAGMA page_count').fetchone()[0] * self.page_size
+
+    def seal(self):
+        # final commit; after this, the file is complete and can be read, copied or moved.
+        self.connection.commit()
+        if self.profile['deferred-index']:
+            self.create_index()
+            self.connection.commit()
+        if self.profile['journal-mode'] == 'WAL':
+            # fold the write-ahead log back into the file, so that no -wal and -shm files are left next to it.
+            self.connection.execute('PRAGMA journal_mode = DELETE')
+        self.connection.close()
+
+    def discard(self):
+        # for a prepared file that never received any data.
+        self.connection.close()
+        self.path.unlink(missing_ok=True)
+
+
+def open_log_file(q_stream_path: str, profile: typing.Optional[dict] = None,
+                  now: typing.Optional[datetime.datetime] = None,
+                  schemas: typing.Optional[SchemaDecoder] = None) -> LogFile:
+    """
+    create a new, empty log file for the stream, named by its creation time stamp,
+    in the per-day folder of that stream.
+    `now` overrides the time stamp: the rotation engine names a file after the time its data starts at,
+    and the spool a file of older data after its oldest message.
+    A name that is taken already is moved on by a microsecond, rather than writing into another file.
+    """
+    pathlib.Path(q_stream_path).mkdir(parents=True, exist_ok=True)
+    if now is None:
+        now = datetime.datetime.now(tz=pytz.UTC)
+    while True:
+        file_name = f'{datetime_to_safestring(now)}.sqlite'
+        # folder per day should be sufficient for this application
+        full_folder_name = timefolders(q_stream_path, now)
+        if not full_folder_name.joinpath(file_name).exists():
+            break
+        now += datetime.timedelta(microseconds=1)
+    full_folder_name.mkdir(parents=True, exist_ok=True)
+    return LogFile(full_folder_name.joinpath(file_name), profile, schemas)
+
+
+def utc_datetime(timestamp: float) -> datetime.datetime:
+    """ the unix time `timestamp`, truncated to the microsecond, as the reception timestamps are """
+    return datetime.datetime.fromtimestamp(0, tz=pytz.UTC) + datetime.timedelta(microseconds=int(timestamp * 1e6))
+
+
+# Rotation policies: a file is rotated on whichever comes first of
+#
+# * time: `file-rotation-time-seconds` after it became current, or, with `file-rotation-align`,
+#   at the next multiple of that period in UTC: at :00, :05, :10 ... for 300 seconds.
+# * rows: `file-rotation-max-rows` rows in the file.
+# * bytes: `file-rotation-max-mib` of database in the file.
+#
+# The limits are checked before each write, and the size only every LIMIT_CHECK_ROWS rows,
+# hence a file can overshoot them by that many rows, or by one batch of the writer stage.
+ROTATION_TRIGGERS = ('time', 'rows', 'bytes')
+LIMIT_CHECK_ROWS = 1000
+# the next file is prepared when the current one reaches this fraction of a limit
+LIMIT_PREPARE_FRACTION = 0.9
+
+
+def next_aligned_time(now: float, period: float) -> float:
+    """ the first multiple of `period` seconds since the epoch, in UTC, after `now` """
+    return (now // period + 1) * period
+
+
+class RotationEngine:
+    """
+    Keeps the log file of one stream, and rotates it without blocking the ingest path.
+
+    * the next file is created (mkdir, connect, CREATE TABLE, CREATE INDEX) by a background thread,
+      `prepare-lead-seconds` before it is due.
+    * the times are those of the rows, as given to `log_file_for`, not of the clock: a writer stage that catches up
+      on a backlog rotates, and names the files, as the rows were received.
+    * on the ingest path, rotation is a swap of the current file for the prepared one.
+    * the final commit and close of the old file happen in the background thread.
+
+    A file is named after the time it is due: its rotation time, or, for a file due to a row or size limit,
+    the time of the row that asked for it. Every file is prepared only after the previous one became current,
+    hence, a file never holds data older than its own name,
+    nor newer than the name of the file two places after it.
+
+    The time that the ingest path spends in `rotate()` is recorded as the rotation stall.
+
+    A file is rotated on time, or earlier when it reaches `max_rows` rows or `max_bytes` bytes; see ROTATION_TRIGGERS.
+
+    If a catalog is given, each sealed file is registered in it, from the background thread.
+    If rollups are given (see rollup.resolve_rollups), they are computed and written before a file is sealed.
+    With an `executor` (a concurrent.futures thread pool, shared by the streams of the asyncio engine), the background
+    jobs run in that pool instead of a thread of their own, still one at a time and in order for each engine.
+    The pool must not be the one that writes the rows: a write that waits for its prepared file would hold a thread
+    that the prepare needs.
+
+    If schemas are given (the `schemas` list of the stream's configuration), the files decode them into typed tables,
+    with one SchemaDecoder per engine, as the shards of a stream write from threads of their own.
+    """
+
+    def __init__(self, q_stream_path: str, log_rotation_time: float = 600, prepare_lead_seconds: float = 5.0,
+                 profile: typing.Optional[dict] = None, catalog=None, name: str = 'attic-rotation',
+                 metrics=None, stream_name: typing.Optional[str] = None, max_rows: typing.Optional[int] = None,
+                 max_bytes: typing.Optional[int] = None, align: bool = False, rollups: typing.Optional[dict] = None,
+                 schemas: typing.Optional[typing.Sequence[dict]] = None, executor=None):
+        self.q_stream_path = q_stream_path
+        # the name the files are cataloged under: the stream folder, also for a shard in a subfolder of it
+        self.stream_name = stream_name or pathlib.Path(q_stream_path).name
+        # the stream's StreamMetrics, for the rotation stall and seal histograms; optional
+        self.metrics = metrics
+        self.catalog = catalog
+        self.rollups = rollups
+        self.schemas = SchemaDecoder(schemas) if schemas else None
+        if rollups is not None and self.schemas is not None and not self.schemas.keeps_raw():
+            # the rollups are computed from the raw table, which would miss the rows of those schemas
+            raise ValueError(f'{q_stream_path}: a stream with rollups can not have schemas with keep-raw: false')
+        self.profile = profile if profile is not None else resolve_storage_profile('default')
+        self.log_rotation_time = log_rotation_time
+        self.prepare_lead_seconds = prepare_lead_seconds
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.align = align
+        self.name = name
+        self.current: typing.Optional[LogFile] = None
+        self.next_rotation_time = float('-inf')  # the first row rotates to the first file
+        self.prepare_time = 0.0
+        self.prepare_requested = False
+        # the row count of the current file at which to look at its limits again; never, without limits
+        self.next_limit_check = float('inf')
+        self.prepared: typing.Optional[LogFile] = None
+        # the time the prepared file is named after; set before the prepare job is queued
+        self.prepared_time = 0.0
+        self.prepared_ready = threading.Event()
+        self.closed = False
+        # statistics, for the performance report
+        self.rotation_count = 0
+        self.rotation_trigger_counts = {trigger: 0 for trigger in ROTATION_TRIGGERS}
+        self.last_rotation_stall = 0.0
+        self.max_rotation_stall = 0.0
+        self.total_rotation_stall = 0.0
+        self.jobs = queue.Queue()
+        self.executor = executor
+        if executor is None:
+            self.thread = threading.Thread(target=self.work, name=name, daemon=True)
+            self.thread.start()
+        else:
+            self.thread = None
+            # whether a `drain` of the jobs is submitted to the executor, or running; under jobs_lock
+            self.draining = False
+            self.jobs_lock = threading.Lock()
+            self.drained = threading.Event()
+            self.drained.set()
+
+    # background side
+    ###############################################################################################
+
+    def work(self):
+        while True:
+            job, log_file = self.jobs.get()
+            if job == 'stop':
+                return
+            self.run_job(job, log_file)
+
+    def drain(self):
+        # with an executor: the jobs queued so far, and those queued meanwhile, then give the pool thread back.
+        while True:
+            with self.jobs_lock:
+                try:
+                    job, log_file = self.jobs.get_nowait()
+                except queue.Empty:
+                    self.draining = False
+                    self.drained.set()
+                    return
+            self.run_job(job, log_file)
+
+    def submit(self, job: str, log_file: typing.Optional[LogFile] = None):
+        if self.executor is None:
+            self.jobs.put((job, log_file))
+            return
+        with self.jobs_lock:
+            self.jobs.put((job, log_file))
+            if not self.draining:
+                self.draining = True
+                self.drained.clear()
+                self.executor.submit(self.drain)
+
+    def run_job(self, job: str, log_file: typing.Optional[LogFile]):
+        try:
+            if job == 'prepare':
+                prepared = open_log_file(self.q_stream_path, self.profile, utc_datetime(self.prepared_time),
+                                         schemas=self.schemas)
+                stdout(f'{self.name} | prepared new file {prepared.path}')
+                self.prepared = prepared
+                self.prepared_ready.set()
+            elif job == 'seal':
+                self.seal_file(log_file)
+            elif job == 'discard':
+                log_file.discard()
+        except Exception as ex:
+            stdout(f'{self.name} | error {ex} in {job}, not retrying.')
+            import traceback
+            stdout(traceback.format_exc())
+            if job == 'prepare':
+                # do not leave the ingest path waiting forever; it will try again on the next rotation.
+                self.prepared_ready.set()
+
+    def seal_file(self, log_file: LogFile):
+        """
+        everything that happens to a file of this stream once it is complete: its rollups, the final commit and close,
+        and its registration in the catalog. Also for a file that was written outside of the rotation, e.g. from a spool.
+        """
+        seal_start_time = time.perf_counter()
+        if self.rollups is not None:
+            self.write_rollups(log_file)
+        log_file.seal()
+        if self.metrics is not None:
+            self.metrics.seal_seconds.record(time.perf_counter() - seal_start_time)
+        if self.catalog is not None:
+            self.catalog.register(self.stream_name, log_file.path)
+
+    def write_rollups(self, log_file: LogFile):
+        try:
+            log_file.commit()
+            write_rollups(log_file.connection, self.rollups)
+        except Exception as ex:
+            # the file is sealed without its rollups, rather than not at all
+            stdout(f'{self.name} | error {ex} in the rollups of {log_file.path}, skipped.')
+
+    # ingest side
+    ###############################################################################################
+
+    def request_prepare(self, file_time: float):
+        """ prepare the next file, named after `file_time`: no row older than that may go into it. """
+        self.prepare_requested = True
+        self.prepared_time = file_time
+        self.submit('prepare')
+
+    def log_file_for(self, now: float) -> LogFile:
+        """
+        returns the file to write a row received at time `now` to, rotating if needed.
+        Call from the ingest thread only, with the rows in the order they were received.
+        """
+        if now > self.next_rotation_time:
+            self.rotate(now)
+        elif self.current.row_count >= self.next_limit_check:
+            self.check_limits(now)
+        elif not self.prepare_requested and now > self.prepare_time:
+            self.request_prepare(self.next_rotation_time)
+        return self.current
+
+    def rows_for_current(self, rows: typing.Sequence[typing.Tuple[int, str, bytes]]) -> int:
+        """
+        how many of `rows`, in the order they were received, go into the file returned by `log_file_for` for the
+        first of them: those up to its rotation time. The row and size limits are looked at once per batch.
+        """
+        rotation_time_us = self.next_rotation_time * 1e6
+        if rows[-1][0] <= rotation_time_us:
+            return len(rows)
+        return bisect.bisect_right([row[0] for row in rows], rotation_time_us)
+
+    def limit_reached(self, log_file: LogFile) -> typing.Optional[str]:
+        """ 'rows' or 'bytes' if `log_file` is full, None otherwise """
+        if self.max_rows is not None and log_file.row_count >= self.max_rows:
+            return 'rows'
+        if self.max_bytes is not None and log_file.size_bytes() >= self.max_bytes:
+            return 'bytes'
+        return None
+
+    def rotation_due(self, now: float) -> bool:
+        """ whether `log_file_for(now)` would rotate; for the writer stage to commit its rows first. """
+        if now > self.next_rotation_time:
+            return True
+        current = self.current
+        return current is not None and current.row_count >= self.next_limit_check \
+            and self.limit_reached(current) is not None
+
+    def check_limits(self, now: float):
+        current = self.current
+        trigger = self.limit_reached(current)
+        if trigger is not None:
+            self.rotate(now, trigger)
+            return
+        if not self.prepare_requested and (
+                (self.max_rows is not None and current.row_count >= LIMIT_PREPARE_FRACTION * self.max_rows)
+                or (self.max_bytes is not None and current.size_bytes() >= LIMIT_PREPARE_FRACTION * self.max_bytes)):
+            self.request_prepare(now)
+        self.schedule_limit_check()
+
+    def schedule_limit_check(self):
+        if self.max_rows is None and self.max_bytes is None:
+            return
+        next_check = self.current.row_count + LIMIT_CHECK_ROWS
+        if self.max_rows is not None:
+            # exactly at the limit, and where the next file is to be prepared
+            for boundary in (int(LIMIT_PREPARE_FRACTION * self.max_rows), self.max_rows):
+                if boundary > self.current.row_count:
+                    next_check = min(next_check, boundary)
+        self.next_limit_check = next_check
+
+    def rotate(self, now: float, trigger: str = 'time'):
+        stall_start = time.perf_counter()
+        if not self.prepare_requested:
+            # first file, or the previous prepare did not happen in time.
+            file_time = now
+            if self.align and trigger == 'time' and self.current is not None:
+                # named after the start of its period, as a file prepared in time is
+                file_time = next_aligned_time(now, self.log_rotation_time) - self.log_rotation_time
+            self.request_prepare(file_time)
+        prepared = self.take_prepared()
+        if prepared is not None and self.prepared_time > now:
+            # prepared for the rotation time, but a limit came first: the file would hold rows older than its name.
+            self.submit('discard', prepared)
+            self.request_prepare(now)
+            prepared = self.take_prepared()
+        if prepared is None:
+            raise RuntimeError(f'{self.name} | could not prepare the next log file')
+        old, self.current = self.current, prepared
+        if old is not None:
+            self.submit('seal', old)
+        if self.align:
+            self.next_rotation_time = next_aligned_time(now, self.log_rotation_time)
+        else:
+            self.next_rotation_time = now + self.log_rotation_time
+        self.prepare_time = self.next_rotation_time - self.prepare_lead_seconds
+        self.schedule_limit_check()
+        stall = time.perf_counter() - stall_start
+        self.rotation_count += 1
+        self.rotation_trigger_counts[trigger] += 1
+        self.last_rotation_stall = stall
+        self.max_rotation_stall = max(self.max_rotation_stall, stall)
+        self.total_rotation_stall += stall
+        if self.metrics is not None:
+            self.metrics.rotation_stall_seconds.record(stall)
+
+    def take_prepared(self) -> typing.Optional[LogFile]:
+        self.prepared_ready.wait()
+        self.prepared_ready.clear()
+        self.prepare_requested = False
+        prepared, self.prepared = self.prepared, None
+        return prepared
+
+    def close(self):
+        """ seal the current file, drop the prepared one, and wait for the background jobs to finish. """
+        if self.closed:
+            return
+        self.closed = True
+        if self.current is not None:
+            self.submit('seal', self.current)
+            self.current = None
+        if self.prepare_requested:
+            self.prepared_ready.wait()
+            if self.prepared is not None:
+                self.submit('discard', self.prepared)
+                self.prepared = None
+        if self.thread is not None:
+            self.jobs.put(('stop', None))
+            self.thread.join()
+        else:
+            self.drained.wait()
+
+    def performance_report(self) -> dict:
+        report = dict(
+            storage_profile=self.profile['name'],
+            rotation_count=self.rotation_count,
+            rotation_time_count=self.rotation_trigger_counts['time'],
+            rotation_rows_count=self.rotation_trigger_counts['rows'],
+            rotation_bytes_count=self.rotation_trigger_counts['bytes'],
+            rotation_stall_last_seconds=self.last_rotation_stall,
+            rotation_stall_max_seconds=self.max_rotation_stall,
+            rotation_stall_total_seconds=self.total_rotation_stall,
+        )
+        if self.schemas is not None:
+            report.update(self.schemas.performance_report())
+        return report
@@ -0,0 +1,149 @@
+import queue  # for the bounded hand-over between the mqtt thread and the writer thread
+import threading
+import time
+
+from .state import StreamState
+from .storage import RotationEngine
+
+stdout = print
+
+
+class BatchWriter(threading.Thread):
+    """
+    The optional writer stage of a stream.
+
+    The mqtt network thread only time-stamps the message and puts it on a bounded queue.
+    This thread drains the queue, writes the rows with `executemany`,
+    and commits whenever `batch_size` rows are pending or `batch_seconds` have passed, whichever comes first.
+    The rows go into the file of their reception timestamp, also when they are written late, after a backlog.
+
+    The files are created and sealed by the rotation engine of the stream, in the background.
+    """
+
+    def __init__(
+            self,
+            stream_state: StreamState,
+            rotation: RotationEngine,
+            queue_size: int = 100000,
+            batch_size: int = 1000,
+            batch_seconds: float = 1.0,
+            name: str = 'attic-writer'):
+        super().__init__(name=name, daemon=True)
+        self.stream_state = stream_state
+        self.rotation = rotation
+        self.batch_size = batch_size
+        self.batch_seconds = batch_seconds
+        # bounded: when the disk can not keep up, `put` blocks, which pushes back to the broker.
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.written_count = 0
+        self.commit_count = 0
+        # the stream's StreamMetrics, if any
+        self.metrics = stream_state.metrics
+
+    def put(self, timestamp_unix: int, topic: str, payload: bytes):
+        self.queue.put((timestamp_unix, topic, payload))
+
+    def queue_depth(self) -> int:
+        return self.queue.qsize()
+
+    def collect_batch(self, timeout: float) -> list:
+        # block for the first row only, then take whatever else is already waiting, up to the batch size.
+        batch = []
+        try:
+            batch.append(self.queue.get(timeout=max(timeout, 0.001)))
+            while len(batch) < self.batch_size:
+                batch.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        return batch
+
+    def commit(self, log_file, oldest_pending_timestamp: int):
+        commit_start_time = time.perf_counter()
+        log_file.commit()
+        if self.metrics is not None:
+            self.metrics.commit_seconds.record(time.perf_counter() - commit_start_time)
+            self.metrics.write_delay_seconds.record(self.stream_state.now() - oldest_pending_timestamp / 1e6)
+        self.commit_count += 1
+        self.committed()
+
+    # extension points, for the spool writer (attic.spool)
+    ###############################################################################################
+
+    def committed(self):
+        """ called after each commit: every row collected so far is committed, or was lost. """
+
+    def stop_ready(self, batch: list) -> bool:
+        """ called after a stop request, with the last batch collected; True to close the files and stop. """
+        # the stop request is honoured only once everything that was queued before it has been written.
+        return not batch and self.queue.empty()
+
+    def finish(self):
+        """ called after the files are closed, before the stop request is acknowledged. """
+
+    def performance_report(self) -> dict:
+        return dict(
+            queue_depth=self.queue_depth(),
+            messages_written=self.written_count,
+            commit_count=self.commit_count,
+        )
+
+    def run(self):
+        log_file = None
+        pending_rows = 0
+        # reception time of the oldest row not committed yet, in microseconds
+        oldest_pending_timestamp = None
+        metrics = self.metrics
+        next_commit_time = time.time() + self.batch_seconds
+        while True:
+            stop_request = self.stream_state.stop_request
+            # wake up at least every 0.2 seconds, so that a stop request is noticed even on a quiet topic.
+            batch = self.collect_batch(timeout=0.0 if stop_request else min(next_commit_time - time.time(), 0.2))
+            try:
+                if batch:
+                    if metrics is not None:
+                        metrics.queue_depth.record(len(batch) + self.queue_depth())
+                    # rotate on the reception timestamps of the rows, not on the time they are written at:
+                    # after a backlog, a batch can span a rotation, and its rows still go into the file of their time.
+                    rows = batch
+                    while rows:
+                        now = rows[0][0] / 1e6
+                        if pending_rows > 0 and self.rotation.rotation_due(now):
+                            # about to rotate: commit the rows pending in the old file here, rather than in its seal,
+                            # so that a commit covers every row written before it.
+                            self.commit(log_file, oldest_pending_timestamp)
+                            pending_rows = 0
+                        current_file = self.rotation.log_file_for(now)
+                        if current_file is not log_file:
+                            log_file = current_file
+                            pending_rows = 0
+                        count = self.rotation.rows_for_current(rows)
+                        if pending_rows == 0:
+                            oldest_pending_timestamp = rows[0][0]
+                        insert_start_time = time.perf_counter()
+                        log_file.insert_many(rows if count == len(rows) else rows[:count])
+                        if metrics is not None:
+                            metrics.insert_seconds.record(time.perf_counter() - insert_start_time)
+                        pending_rows += count
+                        self.written_count += count
+                        rows = rows[count:]
+
+                if pending_rows > 0 and (pending_rows >= self.batch_size or time.time() >= next_commit_time
+                                         or stop_request):
+                    self.commit(log_file, oldest_pending_timestamp)
+                    pending_rows = 0
+                if time.time() >= next_commit_time:
+                    next_commit_time = time.time() + self.batch_seconds
+            except Exception as ex:
+                stdout(f'{self.name} | error in writer: {ex}')
+                import traceback
+                stdout(traceback.format_exc())
+                stdout(f'{self.name} | {len(batch)} messages lost, not retrying.')
+
+            if stop_request and self.stop_ready(batch):
+                try:
+                    self.rotation.close()
+                except Exception as ex:
+                    stdout(f'{self.name} | error {ex} when closing the database, not retrying.')
+                self.finish()
+                self.stream_state.stop_request_ack = True
+                return
@@ -0,0 +1,67 @@
+import concurrent.futures
+import sqlite3
+import time
+
+
+def test_executor_writer_writes_batches_and_flushes_on_stop(tmp_path):
+    from attic.asyncio_engine import ExecutorWriter, LoopDriver
+    from attic.state import StreamState
+    from attic.storage import RotationEngine
+    driver = LoopDriver(0)
+    driver.thread.start()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    stream_state = StreamState()
+    writer = ExecutorWriter(stream_state, RotationEngine(str(tmp_path)), driver=driver, executor=executor,
+                            batch_size=10, batch_seconds=0.05)
+    writer.start()
+    for i in range(25):
+        # as the on_message closure does, on the event loop
+        driver.call(writer.put, i, f'sensor/{i % 3}', b'x' * i)
+    time.sleep(0.5)
+    # the full batches, and then the rest on time, are committed before the stop request
+    files = list(tmp_path.rglob('*.sqlite'))
+    with sqlite3.connect(files[0]) as connection:
+        assert connection.execute('SELECT count(*) FROM data').fetchone()[0] == 25
+    assert writer.commit_count >= 2
+
+    driver.call(writer.put, 25, 'sensor/0', b'last')
+    stream_state.stop_request = True
+    deadline = time.time() + 5
+    while not stream_state.stop_request_ack and time.time() < deadline:
+        time.sleep(0.05)
+    assert stream_state.stop_request_ack
+    assert writer.written_count == 26
+    assert writer.queue_depth() == 0
+    driver.stop(timeout=1)
+    executor.shutdown()
+
+    with sqlite3.connect(files[0]) as connection:
+        rows = connection.execute('SELECT reception_timestamp, topic, payload FROM data').fetchall()
+    assert rows == [(i, f'sensor/{i % 3}', b'x' * i) for i in range(25)] + [(25, 'sensor/0', b'last')]
+
+
+def test_rotation_engines_share_a_thread_pool(tmp_path):
+    import threading
+    from attic.storage import RotationEngine
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
+    threads_before = threading.active_count()
+    rotations = [RotationEngine(str(tmp_path / f'stream-{i}'), log_rotation_time=10, executor=executor)
+                 for i in range(50)]
+    for second in range(25):
+        for i, rotation in enumerate(rotations):
+            rotation.log_file_for(100.0 + second).insert(second, 'a', b'%d' % i)
+    # no thread per engine: at most the two of the pool
+    assert threading.active_count() <= threads_before + 2
+    for rotation in rotations:
+        rotation.close()
+    executor.shutdown()
+    for i in range(50):
+        files = sorted((tmp_path / f'stream-{i}').rglob('*.sqlite'))
+        # rotated at 100, 111 and 122; every file sealed, the last prepared one discarded
+        assert len(files) == 3
+        assert not list((tmp_path / f'stream-{i}').rglob('*-wal'))
+        rows = []
+        for path in files:
+            with sqlite3.connect(path) as connection:
+                rows += connection.execute('SELECT reception_timestamp FROM data').fetchall()
+        assert sorted(rows) == [(second,) for second in range(25)]
@@ -0,0 +1,51 @@
+import json
+
+RUN = dict(source='synthetic', engine='threads', rate=500.0, payload_size=64, topics=3, streams=2,
+           rotation_seconds=0.5, duration=1.5, storage_profile='default', writer_thread=False, catalog=True)
+
+
+def test_synthetic_run_measures_the_stored_messages(tmp_path):
+    from attic.bench import run_once
+    result = run_once(RUN, str(tmp_path))
+    assert result['messages_sent'] == result['messages_stored'] > 600
+    assert result['messages_lost'] == 0
+    assert result['rotation_count'] >= 4
+    assert result['bytes_on_disk'] > 64 * result['messages_stored']
+    assert 0 <= result['latency_us']['p50'] <= result['latency_us']['p99'] <= result['latency_us']['max']
+    assert result['cpu_us_per_message'] > 0
+
+
+def test_broker_run_through_the_embedded_broker(tmp_path):
+    from attic.bench import run_once
+    run = dict(RUN, source='broker', writer_thread=True)
+    result = run_once(run, str(tmp_path))
+    assert result['messages_sent'] == result['messages_received'] == result['messages_stored'] > 600
+
+
+def test_sweep_and_compare():
+    from attic.bench import compare, sweep
+    runs = sweep(dict(RUN, rate=[100.0, 200.0], streams=[1, 2]))
+    assert len(runs) == 4
+    assert {(run['rate'], run['streams']) for run in runs} == {(100.0, 1), (100.0, 2), (200.0, 1), (200.0, 2)}
+
+    baseline = dict(runs=[dict(run=runs[0], result=dict(messages_per_second=100.0, latency_us=dict(p99=10.0),
+                                                        cpu_us_per_message=20.0))])
+    current = json.loads(json.dumps(baseline))
+    current['runs'][0]['result']['messages_per_second'] = 150.0
+    lines = compare(baseline, current)
+    assert len(lines) == 1 and 'msg/s +50.0%' in lines[0] and 'p99 +0.0%' in lines[0]
+
+
+def test_spool_file_is_not_counted_as_stored_bytes(tmp_path):
+    from attic.bench import STAMP, measure_files
+    from attic.spool import Spool
+    from attic.storage import open_log_file
+    stream_path = tmp_path / 'bench-0'
+    log_file = open_log_file(str(stream_path))
+    log_file.insert_many([(1_700_000_000_000_000 + i, 'bench/0/a', STAMP.pack(1_700_000_000_000_000)) for i in range(10)])
+    log_file.seal()
+    Spool(stream_path / 'spool.bin', 1 << 16).close()
+    result = measure_files(str(tmp_path), 1)
+    assert result['messages_stored'] == 10
+    assert result['bytes_on_disk'] == log_file.path.stat().st_size
+    assert result['spool_bytes_on_disk'] == (stream_path / 'spool.bin').stat().st_size > 1 << 16
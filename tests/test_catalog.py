@@ -0,0 +1,45 @@
+import datetime
+
+from test_reader import make_file, us
+
+
+def test_rebuild_and_find(tmp_path):
+    from attic.catalog import find_files, rebuild
+    t0 = datetime.datetime(2024, 3, 1, 12, 0, tzinfo=datetime.timezone.utc)
+    for hour in range(3):
+        created = t0 + datetime.timedelta(hours=hour)
+        make_file(tmp_path / 'everything', created, [(us(created) + minute * 60_000_000, f'hour/{hour}', b'x')
+                                                     for minute in range(60)])
+    assert rebuild(tmp_path) == 3
+    assert len(find_files(tmp_path, 'everything')) == 3
+    found = find_files(tmp_path, 'everything', t0 + datetime.timedelta(minutes=90), t0 + datetime.timedelta(minutes=95))
+    assert [path.name for path in found] == ['2024-03-01T13_00_00_000000+00_00.sqlite']
+    assert len(find_files(tmp_path, topics=['hour/2'])) == 1
+    assert find_files(tmp_path, topics=['hour/2'], end=t0 + datetime.timedelta(hours=2)) == []
+
+
+def test_rotation_registers_sealed_files(tmp_path):
+    from attic.catalog import Catalog, find_files
+    from attic.storage import RotationEngine
+    rotation = RotationEngine(str(tmp_path / 'everything'), log_rotation_time=10, catalog=Catalog(tmp_path))
+    rotation.log_file_for(100.0).insert_many([(1, 'a', b'1'), (2, 'b', b'2')])
+    rotation.log_file_for(111.0).insert(3, 'a', b'3')
+    rotation.close()
+    assert len(find_files(tmp_path, 'everything', topics=['a'])) == 2
+    assert len(find_files(tmp_path, 'everything', topics=['b'])) == 1
+
+
+def test_reader_skips_cataloged_files_without_the_topic(tmp_path, monkeypatch):
+    import attic.reader
+    from attic.catalog import rebuild
+    t0 = datetime.datetime(2024, 3, 1, 12, 0, tzinfo=datetime.timezone.utc)
+    for hour in range(3):
+        created = t0 + datetime.timedelta(hours=hour)
+        make_file(tmp_path / 'everything', created, [(us(created), f'hour/{hour}', b'x')])
+    rebuild(tmp_path)
+    opened = []
+    read_file = attic.reader.read_file
+    monkeypatch.setattr(attic.reader, 'read_file', lambda path, *args: opened.append(path) or read_file(path, *args))
+    rows = list(attic.reader.read_rows(tmp_path / 'everything', topics=['hour/1']))
+    assert [row[1] for row in rows] == ['hour/1']
+    assert len(opened) == 1
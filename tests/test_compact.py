@@ -0,0 +1,48 @@
+import datetime
+import sqlite3
+
+import pytest
+
+from test_reader import make_file, us
+
+
+def make_stream(stream_path, t0, file_count=6):
+    rows = []
+    for index in range(file_count):
+        created = t0 + datetime.timedelta(minutes=10 * index)
+        file_rows = [(us(created) + second * 1_000_000, f'sensor/{second % 4}', b'%d' % second)
+                     for second in range(0, 600, 7)]
+        make_file(stream_path, created, file_rows, 'max-throughput' if index % 2 else 'default')
+        rows.extend(file_rows)
+    return rows
+
+
+@pytest.mark.parametrize('parquet', [False, True])
+def test_compact_merges_and_replaces(tmp_path, parquet):
+    if parquet:
+        pytest.importorskip('pyarrow')
+    from attic import reader
+    from attic.catalog import find_files, rebuild
+    from attic.compact import compact_stream
+    from attic.storage import resolve_storage_profile
+    t0 = datetime.datetime(2024, 3, 1, 12, 0, tzinfo=datetime.timezone.utc)
+    rows = make_stream(tmp_path / 'everything', t0)
+    rebuild(tmp_path)
+
+    target = compact_stream(tmp_path, 'everything', t0.date(), None, resolve_storage_profile('max-throughput'),
+                            parquet=parquet)
+    # the two newest files are left alone
+    files = sorted((tmp_path / 'everything').rglob('*.sqlite'))
+    assert len(files) == 3
+    assert files[0] == target
+    with sqlite3.connect(target) as connection:
+        topics = [row[0] for row in connection.execute('SELECT topic FROM data')]
+        assert topics == sorted(topics)
+    # the reader still returns everything in time order
+    assert list(reader.read_rows(tmp_path / 'everything')) == rows
+    assert len(find_files(tmp_path, 'everything')) == 3
+    if parquet:
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(target.with_suffix('.parquet'))
+        assert parquet_file.metadata.num_rows == len(rows) * 4 // 6
+        assert parquet_file.metadata.num_row_groups == 4
@@ -0,0 +1,47 @@
+import json
+import sqlite3
+
+import pytest
+
+
+@pytest.mark.parametrize('dictionary_mode', ['topic', 'stream'])
+def test_compressed_payloads_read_back_unchanged(tmp_path, dictionary_mode):
+    pytest.importorskip('zstandard')
+    from attic.compression import read_data
+    from attic.storage import open_log_file, resolve_storage_profile
+    profile = resolve_storage_profile('compressed', {'compressed': {
+        'schema-version': 2,
+        'compression': 'zstd',
+        'compression-dictionary': dictionary_mode,
+        'compression-train-messages': 200,
+        'compression-dictionary-bytes': 4096,
+    }})
+    rows = [(i, f'sensor/{i % 4}', json.dumps(dict(sensor=i % 4, sequence=i, temperature=20.0 + (i % 17) / 10,
+                                                   status='ok', unit='degC')).encode())
+            for i in range(4000)]
+    log_file = open_log_file(str(tmp_path), profile)
+    log_file.insert_many(rows[:2000])
+    for row in rows[2000:]:
+        log_file.insert(*row)
+    log_file.seal()
+
+    with sqlite3.connect(log_file.path) as connection:
+        stored = connection.execute('SELECT sum(length(payload)) FROM records').fetchone()[0]
+        assert connection.execute('SELECT count(*) FROM dictionaries').fetchone()[0] == \
+               (4 if dictionary_mode == 'topic' else 1)
+        assert connection.execute('SELECT count(*) FROM records WHERE dictionary_id IS NOT NULL').fetchone()[0] > 0
+        assert sorted(read_data(connection)) == rows
+        # no data view returning the compressed payloads
+        with pytest.raises(sqlite3.OperationalError):
+            connection.execute('SELECT payload FROM data')
+    assert stored < 0.6 * sum(len(row[2]) for row in rows)
+    from attic.catalog import describe_file
+    from attic.reader import read_file
+    assert list(read_file(log_file.path, topics=['sensor/1'])) == [row for row in rows if row[1] == 'sensor/1']
+    assert describe_file(log_file.path)[0] == ('sensor/0', 1000, 0, 3996)
+
+
+def test_compression_needs_schema_version_2():
+    from attic.storage import resolve_storage_profile
+    with pytest.raises(ValueError):
+        resolve_storage_profile('compressed', {'compressed': {'compression': 'zstd'}})
@@ -0,0 +1,97 @@
+import time
+
+
+def test_topic_trie_and_covering_filters():
+    from attic.connections import TopicTrie, covering_filters, filter_covers, filters_overlap
+    trie = TopicTrie()
+    for topic_filter in ('#', 'sensors/#', 'sensors/+/temperature', 'sensors/1/temperature', 'power'):
+        trie.add(topic_filter, topic_filter)
+    assert trie.match('sensors/1/temperature') == ['#', 'sensors/#', 'sensors/+/temperature', 'sensors/1/temperature']
+    assert trie.match('sensors') == ['#', 'sensors/#']
+    assert trie.match('power/1') == ['#']
+    assert trie.match('$SYS/broker/uptime') == []
+
+    assert filter_covers('sensors/#', 'sensors/+/temperature')
+    assert filter_covers('+/+/temperature', 'sensors/1/temperature')
+    assert not filter_covers('sensors/+', 'sensors/#')
+    assert not filter_covers('#', '$SYS/#')
+    assert covering_filters(['sensors/+/temperature', 'power', 'sensors/#', 'power']) == ['power', 'sensors/#']
+
+    assert filters_overlap('sensors/+/temperature', '+/1/#')
+    assert filters_overlap('sensors/#', 'sensors')
+    assert not filters_overlap('sensors/+', 'sensors/1/temperature')
+    assert not filters_overlap('power/+', 'other')
+
+
+def test_streams_of_one_broker_share_a_connection(tmp_path):
+    import attic
+    from attic.fakebroker import FakeBroker
+    broker = FakeBroker().start()
+    stream = dict(user='', password='', **{'mqtt-broker-address': broker.host, 'mqtt-broker-port': broker.port,
+                                             'suffix': '', 'file-rotation-time-seconds': 600, 'writer-thread': True})
+    config = dict(streams=[dict(stream, topic='#', prefix='everything'),
+                           dict(stream, topic='sensors/#', prefix='sensors'),
+                           dict(stream, topic='sensors/+/temperature', prefix='temperatures'),
+                           # without a writer stage: a connection of its own, by default
+                           dict(stream, topic='power', prefix='power', **{'writer-thread': False})])
+    attic.shared_state = {'streams': []}
+    attic.prepare_shared_state(config)
+    try:
+        attic.start_streams(range(4), config, str(tmp_path), None)
+        assert len(attic.shared_state['connections']) == 1
+        clients = attic.shared_state['clients']
+        assert clients[0] is clients[1] is clients[2] and clients[3] is not clients[0]
+        deadline = time.time() + 5
+        while broker.subscription_count() < 1 and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        # one subscription covers the three streams: the broker sends each message once; and the one of 'power'
+        assert broker.subscription_count() == 2
+        broker.publish_many([('sensors/1/temperature', b'21.5'), ('sensors/1/humidity', b'40'), ('power', b'3')])
+        deadline = time.time() + 5
+        while attic.shared_state['streams'][0].message_count < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        assert [state.message_count for state in attic.shared_state['streams']][:3] == [3, 2, 1]
+    finally:
+        attic.stop_streams(range(4), timeout=1)
+        broker.stop()
+
+
+def test_a_shared_connection_is_reconnected_once_per_pass():
+    import attic
+    from attic.connections import broker_key
+
+    class DisconnectedClient:
+        connect_count = 0
+
+        def is_connected(self):
+            return False
+
+        def connect(self, **kwargs):
+            self.connect_count += 1
+
+        def loop_stop(self):
+            pass
+
+        def loop_start(self):
+            pass
+
+        def disconnect(self):
+            pass
+
+    stream = dict(user='', password='', **{'mqtt-broker-address': 'localhost', 'mqtt-broker-port': 1883})
+    config = dict(streams=[dict(stream, topic='a'), dict(stream, topic='b'), dict(stream, topic='c')])
+    shared, own = DisconnectedClient(), DisconnectedClient()
+    key = broker_key(config['streams'][0])
+
+    class Connection:
+        pass
+
+    connection = Connection()
+    connection.key, connection.client = key, shared
+    attic.shared_state = {'clients': [shared, shared, own], 'connections': {key: connection}}
+    reconnected = set()
+    for stream_idx in range(3):
+        attic.reconnect_stream(stream_idx, config, reconnected)
+    assert shared.connect_count == 1
+    assert own.connect_count == 1
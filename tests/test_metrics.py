@@ -0,0 +1,64 @@
+import timeit
+import urllib.request
+
+
+def test_histogram_summary_since_previous_counts():
+    from attic.metrics import DURATION_BOUNDS, Histogram
+    histogram = Histogram(DURATION_BOUNDS)
+    for _ in range(98):
+        histogram.record(3e-5)
+    histogram.record(0.003)
+    histogram.record(0.004)
+    summary = histogram.summary()
+    # percentiles are bucket upper bounds, never above the max
+    assert summary == dict(count=100, p50=5e-5, p99=0.004, max_bound=0.004)
+
+    previous = list(histogram.counts)
+    histogram.record(1e-6)
+    assert histogram.summary(previous) == dict(count=1, p50=1e-6, p99=1e-6, max_bound=1e-6)
+    # the largest value of the interval is bounded by its bucket, not by the all-time max
+    previous = list(histogram.counts)
+    histogram.record(1.5e-5)
+    assert histogram.summary(previous)['max_bound'] == 2e-5
+    assert histogram.summary(list(histogram.counts))['count'] == 0
+
+
+def test_stream_metrics_round_trip_through_values():
+    from attic.metrics import METRICS_SIZE, StreamMetrics
+    metrics = StreamMetrics()
+    metrics.processing_seconds.record(2e-5)
+    metrics.queue_depth.record(1500)
+    values = metrics.values()
+    assert len(values) == METRICS_SIZE
+    copy = StreamMetrics().load(values)
+    assert copy.counts() == metrics.counts()
+    assert copy.queue_depth.max == 1500
+    assert set(copy.summary()) == {'processing_seconds', 'queue_depth'}
+
+
+def test_record_is_cheap():
+    from attic.metrics import StreamMetrics
+    metrics = StreamMetrics()
+    seconds = min(timeit.repeat(lambda: metrics.processing_seconds.record(3e-5), number=100000, repeat=3))
+    # well under a microsecond per record; generous, for slow test machines
+    assert seconds / 100000 < 2e-6
+
+
+def test_metrics_endpoint():
+    from attic.metrics import MetricsServer, StreamMetrics
+    metrics = StreamMetrics()
+    metrics.processing_seconds.record(3e-5)
+    metrics.processing_seconds.record(0.5)
+    snapshot = dict(messageCount=2, is_connected=True, lastRxTimestamp_unix=1_700_000_000_000_000,
+                    details=dict(rotation_count=1), metrics=metrics)
+    server = MetricsServer(lambda: [('everything', snapshot)], port=0).start()
+    try:
+        body = urllib.request.urlopen(f'http://127.0.0.1:{server.port}/metrics', timeout=5).read().decode()
+    finally:
+        server.stop()
+    assert 'attic_messages_total{stream="everything"} 2.0' in body
+    assert 'attic_processing_seconds_bucket{stream="everything",le="5e-05"} 1' in body
+    assert 'attic_processing_seconds_bucket{stream="everything",le="0.5"} 2' in body
+    assert 'attic_processing_seconds_bucket{stream="everything",le="+Inf"} 2' in body
+    assert 'attic_processing_seconds_count{stream="everything"} 2' in body
+    assert 'attic_queue_depth_count{stream="everything"} 0' in body
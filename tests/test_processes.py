@@ -0,0 +1,64 @@
+def test_process_groups():
+    from attic.processes import process_groups
+    config = dict(streams=[dict(prefix='a'), dict(prefix='b', **{'process-group': 'slow'}),
+                           dict(prefix='c'), dict(prefix='d', **{'process-group': 'slow'})])
+    assert process_groups(config) == [[0], [1, 3], [2]]
+
+
+def test_stream_snapshot_reads_shared_counters(tmp_path):
+    from attic.processes import COUNTER_INDEX, COUNTERS, ProcessSupervisor
+    config = dict(streams=[dict(prefix='a'), dict(prefix='b', **{'storage-profile': 'durable'})])
+    supervisor = ProcessSupervisor(config, str(tmp_path))
+    # as written by the worker of stream 1
+    base = len(COUNTERS)
+    supervisor.counters[base + COUNTER_INDEX['messageCount']] = 42
+    supervisor.counters[base + COUNTER_INDEX['lastRxTimestamp_unix']] = 1_700_000_000_000_000
+    supervisor.counters[base + COUNTER_INDEX['is_connected']] = 1
+    supervisor.counters[base + COUNTER_INDEX['worker_pid']] = 1234
+
+    snapshot = supervisor.stream_snapshot(1)
+    assert snapshot['messageCount'] == 42
+    assert snapshot['is_connected'] is True
+    assert snapshot['lastRxTimestamp_iso_string'] == '2023-11-14T22:13:20.000000+00:00'
+    assert snapshot['details']['worker_pid'] == 1234
+    assert snapshot['details']['storage_profile'] == 'durable'
+
+    # stream 0 has not reported yet
+    snapshot = supervisor.stream_snapshot(0)
+    assert snapshot['messageCount'] == 0
+    assert snapshot['lastRxTimestamp_unix'] is None
+
+
+def test_counters_stay_monotonic_across_worker_restarts(tmp_path):
+    from attic.metrics import METRICS_SIZE, StreamMetrics
+    from attic.processes import COUNTER_INDEX, COUNTERS, ProcessSupervisor
+    config = dict(streams=[dict(prefix='a'), dict(prefix='b', **{'process-group': 'a'})])
+    supervisor = ProcessSupervisor(config, str(tmp_path))
+    base = len(COUNTERS)
+    supervisor.counters[base + COUNTER_INDEX['messageCount']] = 42
+    supervisor.counters[base + COUNTER_INDEX['totalProcessingTime']] = 1.5
+    supervisor.counters[base + COUNTER_INDEX['queue_depth']] = 7
+    metrics = StreamMetrics()
+    for _ in range(10):
+        metrics.processing_seconds.record(3e-5)
+    supervisor.metrics[METRICS_SIZE:2 * METRICS_SIZE] = metrics.values()
+    previous_counts = supervisor.stream_snapshot(1)['metrics'].counts()
+    # the worker of group 1 (stream 1) died, and is restarted
+    supervisor.carry_over_counters(1)
+    snapshot = supervisor.stream_snapshot(1)
+    assert snapshot['messageCount'] == 42
+    assert snapshot['totalProcessingTime'] == 1.5
+    # the new worker counts from zero
+    supervisor.counters[base + COUNTER_INDEX['messageCount']] = 3
+    supervisor.counters[base + COUNTER_INDEX['queue_depth']] = 1
+    metrics = StreamMetrics()
+    metrics.processing_seconds.record(0.003)
+    supervisor.metrics[METRICS_SIZE:2 * METRICS_SIZE] = metrics.values()
+    snapshot = supervisor.stream_snapshot(1)
+    assert snapshot['messageCount'] == 45
+    # the histograms too: the interval since the previous summary holds the one new value only
+    assert snapshot['metrics'].processing_seconds.count() == 11
+    assert snapshot['metrics'].summary(previous_counts)['processing_seconds']['count'] == 1
+    # a gauge is not carried over
+    assert snapshot['details']['queue_depth'] == 1
+    assert supervisor.stream_snapshot(0)['messageCount'] == 0
@@ -0,0 +1,67 @@
+import datetime
+
+import pytest
+
+from attic.safetimestring import timefolders
+
+
+def make_file(stream_path, created, rows, profile_name='default'):
+    from attic.storage import LogFile, resolve_storage_profile
+    folder = timefolders(stream_path, created)
+    folder.mkdir(parents=True, exist_ok=True)
+    name = created.isoformat(timespec='microseconds').replace(':', '_').replace('.', '_')
+    log_file = LogFile(folder.joinpath(f'{name}.sqlite'), resolve_storage_profile(profile_name))
+    log_file.insert_many(rows)
+    log_file.seal()
+    return log_file.path
+
+
+def us(value: datetime.datetime) -> int:
+    return int(value.timestamp() * 1e6)
+
+
+@pytest.fixture
+def stream(tmp_path):
+    # one file per hour, created on the hour, holding one row per minute of the following hour.
+    t0 = datetime.datetime(2024, 3, 1, 22, 0, tzinfo=datetime.timezone.utc)
+    for hour in range(4):
+        created = t0 + datetime.timedelta(hours=hour)
+        rows = [(us(created + datetime.timedelta(minutes=minute)), f'site/{minute % 3}/temperature', b'%d' % minute)
+                for minute in range(60)]
+        make_file(tmp_path, created, rows, 'max-throughput' if hour % 2 else 'default')
+    return tmp_path, t0
+
+
+def test_select_files_prunes_by_name(stream):
+    from attic.reader import select_files
+    stream_path, t0 = stream
+    assert len(select_files(stream_path)) == 4
+    # data at 23:30 is in the 23:00 file; 22:00 can not hold it, because 00:00 was created before 23:30.
+    selected = select_files(stream_path, t0 + datetime.timedelta(minutes=90), t0 + datetime.timedelta(minutes=100))
+    assert [path.parent.name for path in selected] == ['01', '01']
+    assert len(select_files(stream_path, end=t0)) == 0
+
+
+def test_read_rows_pushes_down_time_and_topic(stream):
+    from attic.reader import read_rows
+    stream_path, t0 = stream
+    start = t0 + datetime.timedelta(minutes=50)
+    end = t0 + datetime.timedelta(minutes=130)
+    rows = list(read_rows(stream_path, start, end))
+    assert [row[0] for row in rows] == [us(start) + minute * 60_000_000 for minute in range(80)]
+    rows = list(read_rows(stream_path, start, end, topics=['site/+/temperature']))
+    assert len(rows) == 80
+    rows = list(read_rows(stream_path, start, end, topics=['site/1/temperature']))
+    assert len(rows) == 26
+    assert all(row[1] == 'site/1/temperature' for row in rows)
+    assert list(read_rows(stream_path, start, end, topics=['elsewhere/#'])) == []
+
+
+def test_read_batches(stream):
+    pytest.importorskip('numpy')
+    from attic.reader import read_batches
+    stream_path, t0 = stream
+    batches = list(read_batches(stream_path, batch_size=100))
+    assert [len(batch['reception_timestamp']) for batch in batches] == [100, 100, 40]
+    assert batches[0]['reception_timestamp'].dtype.name == 'int64'
+    assert batches[0]['payload'][0] == b'0'
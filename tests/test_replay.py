@@ -0,0 +1,80 @@
+import threading
+import time
+
+
+def record(stream_path, rows):
+    import datetime
+    from attic.storage import open_log_file
+    log_file = open_log_file(str(stream_path), now=datetime.datetime.fromtimestamp(rows[0][0] / 1e6,
+                                                                                    datetime.timezone.utc))
+    log_file.insert_many(rows)
+    log_file.seal()
+
+
+def test_replay_merges_streams_in_reception_order(tmp_path):
+    import paho.mqtt.client as mqtt
+    from attic.fakebroker import FakeBroker
+    from attic.replay import main
+    start = 1_700_000_000_000_000
+    # two streams, interleaved in time, over 0.4 seconds
+    first = [(start + i * 2000, f'a/{i % 3}', b'%d' % i) for i in range(200)]
+    second = [(start + i * 2000 + 1000, 'b', b'%d' % i) for i in range(200)]
+    record(tmp_path / 'first', first)
+    record(tmp_path / 'second', second)
+
+    broker = FakeBroker().start()
+    received = []
+    done = threading.Event()
+
+    def on_message(client, userdata, message):
+        received.append((message.topic, message.payload))
+        if len(received) == 400:
+            done.set()
+
+    subscriber = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+    subscriber.on_connect = lambda client, *args: client.subscribe('replay/#')
+    subscriber.on_message = on_message
+    subscriber.connect(broker.host, broker.port)
+    subscriber.loop_start()
+    try:
+        deadline = time.time() + 5
+        while broker.subscription_count() == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        report = main(['--config', str(tmp_path / 'none.yaml'), '--data-folder', str(tmp_path), '--speed', '2',
+                       '--topic-prefix', 'replay/', '--broker-address', broker.host, '--broker-port', str(broker.port)])
+        assert done.wait(5)
+    finally:
+        subscriber.loop_stop()
+        broker.stop()
+    expected = [(f'replay/{topic}', payload) for _, topic, payload in sorted(first + second)]
+    assert received == expected
+    assert report['messages'] == 400
+    # 0.4 seconds of recording, at twice the speed
+    assert report['seconds'] >= 0.19
+    assert report['lateness_seconds']['count'] == 400
+
+
+def test_replay_as_fast_as_possible():
+    from attic.replay import replay
+
+    class Client:
+        def __init__(self):
+            self.published = []
+
+        def publish(self, topic, payload):
+            self.published.append((topic, payload))
+
+        def flush(self):
+            pass
+
+        def close(self):
+            pass
+
+    client = Client()
+    # one hour of recording
+    rows = [(i * 36_000_000, 't', b'x') for i in range(100)]
+    report = replay(client, [rows[:50], rows[50:]], speed=0)
+    assert len(client.published) == 100 and report['seconds'] < 1
+    # or at the original pace, with the silences shortened
+    report = replay(client, [rows], speed=1, max_gap_seconds=0.001)
+    assert report['messages'] == 100 and report['seconds'] < 1
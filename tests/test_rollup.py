@@ -0,0 +1,64 @@
+import json
+import sqlite3
+import time
+
+
+def test_rollups_at_seal_in_the_file_and_the_stream_database(tmp_path):
+    from attic.rollup import read_rollups, resolve_rollups
+    from attic.storage import RotationEngine
+    # the next minute boundary: the files are named by the clock, and hold no data older than their name
+    start = int((time.time() // 60 + 1) * 60) * 1_000_000
+    for target in ('file', 'stream'):
+        stream_path = tmp_path / target
+        rollups = resolve_rollups({
+            'interval-seconds': 60, 'target': target,
+            'fields': [{'topic': 'sensors/+/climate', 'path': 'readings.0.celsius'}, {'topic': 'power'}]},
+            str(stream_path))
+        rotation = RotationEngine(str(stream_path), log_rotation_time=600, max_rows=150, rollups=rollups)
+        # 3 minutes, one message per second per topic; rotated every 150 rows, i.e. in the middle of a minute
+        for second in range(180):
+            now = start / 1e6 + second
+            log_file = rotation.log_file_for(now)
+            timestamp = start + second * 1_000_000
+            log_file.insert(timestamp, 'sensors/1/climate', json.dumps({'readings': [{'celsius': second}]}).encode())
+            log_file.insert(timestamp, 'power', b'%d' % (2 * second))
+            log_file.insert(timestamp, 'sensors/1/status', b'not a number')
+        rotation.close()
+
+        rows = read_rollups(stream_path)
+        assert rows == [(start + minute * 60_000_000, topic, field, 60, first * scale, (first + 59) * scale,
+                         (first + 29.5) * scale)
+                        for minute in range(3) for first in [minute * 60]
+                        for topic, field, scale in (('power', 'value', 2), ('sensors/1/climate', 'readings.0.celsius', 1))]
+        if target == 'stream':
+            # (the files of this test are all named within a few milliseconds, too close for a time range on them)
+            assert read_rollups(stream_path, start + 60_000_000, start + 120_000_000, topics=['power']) == [rows[2]]
+        files = sorted(stream_path.rglob('20*.sqlite'))
+        assert len(files) == 4
+        with sqlite3.connect(files[0]) as connection:
+            has_table = connection.execute("SELECT count(*) FROM sqlite_master WHERE name = 'rollup'").fetchone()[0]
+        assert has_table == (target == 'file')
+        assert (stream_path / 'rollup.sqlite').exists() == (target == 'stream')
+
+
+def test_compaction_merges_the_rollups(tmp_path):
+    import datetime
+    from attic.compact import compact_files
+    from attic.rollup import read_rollups, resolve_rollups, write_rollups
+    from attic.storage import open_log_file, resolve_storage_profile
+    rollups = resolve_rollups({'fields': [{'topic': 'power'}]}, str(tmp_path))
+    start = 1_700_000_040_000_000
+    paths = []
+    for part in range(2):
+        log_file = open_log_file(str(tmp_path), now=datetime.datetime.fromtimestamp(
+            start / 1e6 + part * 30, datetime.timezone.utc))
+        log_file.insert_many([(start + (part * 30 + i) * 1_000_000, 'power', b'%d' % (part * 30 + i))
+                              for i in range(30)])
+        write_rollups(log_file.connection, rollups)
+        log_file.seal()
+        paths.append(log_file.path)
+    before = read_rollups(tmp_path)
+    assert before == [(start, 'power', 'value', 60, 0.0, 59.0, 29.5)]
+    compact_files(paths, resolve_storage_profile('max-throughput'))
+    assert len(list(tmp_path.rglob('20*.sqlite'))) == 1
+    assert read_rollups(tmp_path) == before
@@ -0,0 +1,155 @@
+import json
+import sqlite3
+import struct
+import time
+
+import pytest
+
+SCHEMAS = [
+    {'topic': 'sensors/+/climate', 'table': 'climate', 'format': 'json',
+     'columns': [{'name': 'celsius', 'path': 'readings.0.celsius', 'type': 'REAL'},
+                 {'name': 'status', 'type': 'TEXT'}, {'name': 'count', 'type': 'INTEGER'}]},
+    {'topic': 'power/+', 'table': 'power', 'format': 'struct', 'layout': '<Ifh',
+     'columns': ['sequence', 'watts', 'flags'], 'keep-raw': False},
+]
+
+
+def test_decoded_into_typed_tables_with_raw_fallback(tmp_path):
+    from attic.schemas import read_table
+    from attic.storage import RotationEngine, resolve_storage_profile
+    # the next minute boundary: the files are named by the clock, and hold no data older than their name
+    start = int((time.time() // 60 + 1) * 60) * 1_000_000
+    for profile in ('default', 'max-throughput'):
+        stream_path = tmp_path / profile
+        rotation = RotationEngine(str(stream_path), log_rotation_time=600, max_rows=100,
+                                  profile=resolve_storage_profile(profile), schemas=SCHEMAS)
+        rows = []
+        for i in range(150):
+            timestamp = start + i * 1_000_000
+            rows.append((timestamp, 'sensors/1/climate',
+                         json.dumps({'readings': [{'celsius': i / 2}], 'status': 'ok', 'count': i}).encode()))
+            rows.append((timestamp, 'power/a', struct.pack('<Ifh', i, 1.5 * i, -i)))
+            rows.append((timestamp, 'other', b'raw'))
+        rows.append((start + 150_000_000, 'power/a', b'too short'))
+        rows.append((start + 150_000_000, 'sensors/2/climate', b'not json'))
+        # one at a time, and in batches, as without and with the writer stage
+        for row in rows[:30]:
+            rotation.log_file_for(start / 1e6).insert(*row)
+        for index in range(30, len(rows), 50):
+            rotation.log_file_for(start / 1e6).insert_many(rows[index:index + 50])
+        report = rotation.performance_report()
+        rotation.close()
+
+        assert report['decoded_count'] == 300
+        assert report['undecodable_count'] == 2
+        assert report['rotation_rows_count'] >= 1
+        climate = read_table(stream_path, 'climate')
+        assert climate['celsius'].tolist() == [i / 2 for i in range(150)]
+        assert climate['count'].dtype.kind == 'i' and climate['count'].tolist() == list(range(150))
+        assert set(climate['status']) == {'ok'}
+        # (the files of this test are all named within a few milliseconds, too close for a time range on them)
+        power = read_table(stream_path, 'power', ['watts'], topics=['power/#'])
+        assert list(power) == ['reception_timestamp', 'topic', 'watts']
+        assert power['watts'].tolist() == [1.5 * i for i in range(150)]
+        assert power['reception_timestamp'].tolist() == [start + i * 1_000_000 for i in range(150)]
+        # the raw table: the climate rows (keep-raw), not the decoded power rows, and the undecodable ones
+        raw_topics = {}
+        for path in stream_path.rglob('20*.sqlite'):
+            with sqlite3.connect(path) as connection:
+                for topic, count in connection.execute('SELECT topic, count(*) FROM data GROUP BY topic'):
+                    raw_topics[topic] = raw_topics.get(topic, 0) + count
+        assert raw_topics == {'sensors/1/climate': 150, 'other': 150, 'power/a': 1, 'sensors/2/climate': 1}
+
+
+def test_schema_configuration_is_checked():
+    from attic.schemas import Schema, SchemaDecoder
+    with pytest.raises(ValueError):
+        Schema({'topic': 'a', 'table': 'drop table', 'format': 'json', 'columns': ['x']})
+    with pytest.raises(ValueError):
+        Schema({'topic': 'a', 'table': 'a', 'format': 'struct', 'layout': '<If', 'columns': ['x']})
+    with pytest.raises(ValueError):
+        SchemaDecoder([{'topic': 'a', 'table': 'a', 'format': 'json', 'columns': ['x']},
+                       {'topic': 'b', 'table': 'a', 'format': 'json', 'columns': ['x']}])
+    # repeat counts, and a byte string of fixed length
+    schema = Schema({'topic': 'a', 'table': 'a', 'format': 'struct', 'layout': '>2H4sx',
+                     'columns': ['low', 'high', 'tag']})
+    assert schema.columns == [('low', 'INTEGER'), ('high', 'INTEGER'), ('tag', 'BLOB')]
+    assert schema.decode(struct.pack('>2H4sx', 1, 2, b'abcd')) == [1, 2, b'abcd']
+
+
+def test_compaction_keeps_the_typed_tables(tmp_path):
+    import datetime
+    from attic.compact import compact_files
+    from attic.schemas import SchemaDecoder, read_table
+    from attic.storage import open_log_file, resolve_storage_profile
+    start = 1_700_000_040_000_000
+    decoder = SchemaDecoder(SCHEMAS)
+    paths = []
+    for part in range(2):
+        log_file = open_log_file(str(tmp_path), now=datetime.datetime.fromtimestamp(
+            start / 1e6 + part * 30, datetime.timezone.utc), schemas=decoder)
+        log_file.insert_many([(start + (part * 30 + i) * 1_000_000, 'power/a', struct.pack('<Ifh', part * 30 + i, 0, 0))
+                              for i in range(30)])
+        log_file.seal()
+        paths.append(log_file.path)
+    compact_files(paths, resolve_storage_profile('default'))
+    assert len(list(tmp_path.rglob('20*.sqlite'))) == 1
+    assert read_table(tmp_path, 'power', ['sequence'])['sequence'].tolist() == list(range(60))
+    assert read_table(tmp_path, 'power', ['sequence'], start=start + 45_000_000,
+                      end=start + 50_000_000)['sequence'].tolist() == list(range(45, 50))
+
+
+def test_avro():
+    pytest.importorskip('fastavro')
+    import io
+    import fastavro
+    from attic.schemas import Schema
+    avro_schema = {'type': 'record', 'name': 'Event', 'fields': [
+        {'name': 'code', 'type': 'int'}, {'name': 'label', 'type': ['null', 'string']}, {'name': 'level', 'type': 'double'}]}
+    schema = Schema({'topic': 'events', 'table': 'events', 'format': 'avro', 'schema': avro_schema})
+    assert schema.columns == [('code', 'INTEGER'), ('label', 'TEXT'), ('level', 'REAL')]
+    buffer = io.BytesIO()
+    fastavro.schemaless_writer(buffer, fastavro.parse_schema(avro_schema), {'code': 7, 'label': None, 'level': 0.5})
+    assert schema.decode(buffer.getvalue()) == [7, None, 0.5]
+    assert schema.decode(b'\x01') is None
+
+
+def test_decoded_only_rows_in_the_catalog_reader_and_replay(tmp_path):
+    import warnings
+    from attic.catalog import Catalog, find_files, open_catalog
+    from attic.reader import read_rows
+    from attic.replay import check_replayable
+    from attic.rollup import resolve_rollups
+    from attic.storage import RotationEngine
+    stream_path = tmp_path / 'stream'
+    rotation = RotationEngine(str(stream_path), catalog=Catalog(tmp_path), schemas=SCHEMAS)
+    start = int(time.time() * 1e6)
+    log_file = rotation.log_file_for(start / 1e6)
+    log_file.insert_many([(start + i, 'power/a', struct.pack('<Ifh', i, 0, 0)) for i in range(10)]
+                         + [(start + 10 + i, 'other', b'raw') for i in range(5)])
+    rotation.close()
+
+    # the catalog counts the rows of the typed table, with their time span
+    connection = open_catalog(tmp_path)
+    try:
+        assert connection.execute('SELECT topic, row_count, min_timestamp, max_timestamp FROM file_topics '
+                                  'ORDER BY topic').fetchall() == [('other', 5, start + 10, start + 14),
+                                                                   ('power/a', 10, start, start + 9)]
+        assert connection.execute('SELECT row_count FROM files').fetchone()[0] == 15
+    finally:
+        connection.close()
+    assert len(find_files(tmp_path, 'stream', topics=['power/a'])) == 1
+
+    # the reader returns the raw rows, and warns about the others
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always')
+        assert [row[1] for row in read_rows(stream_path)] == ['other'] * 5
+        assert [row[1] for row in read_rows(stream_path, topics=['other'])] == ['other'] * 5
+    assert len(caught) == 1 and 'decoded_power' in str(caught[0].message)
+
+    with pytest.raises(ValueError):
+        check_replayable([stream_path])
+    check_replayable([stream_path], topics=['other'])
+    with pytest.raises(ValueError):
+        RotationEngine(str(tmp_path / 'rollups'), schemas=SCHEMAS,
+                       rollups=resolve_rollups({'fields': [{'topic': 'power/+'}]}, str(tmp_path / 'rollups')))
@@ -0,0 +1,50 @@
+import time
+
+
+class Message:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+def test_shard_of_is_stable():
+    from attic.shards import shard_of
+    # crc32, not the salted hash(): the same shard in every process
+    assert [shard_of(f'sensor/{i}', 4) for i in range(8)] == [shard_of(f'sensor/{i}', 4) for i in range(8)]
+    assert len({shard_of(f'sensor/{i}', 4) for i in range(100)}) == 4
+
+
+def test_sharded_stream_reads_back_as_one(tmp_path):
+    import attic
+    from attic.catalog import Catalog, find_files
+    from attic.reader import read_rows, shard_folders
+    from attic.shards import shard_of
+    stream_path = tmp_path / 'everything'
+    attic.shared_state = {'streams': [None]}
+    on_message = attic.make_on_message_callback(0, '#', str(stream_path), catalog=Catalog(tmp_path),
+                                                writer_batch_seconds=0.05, shards=3)
+    state = attic.shared_state['streams'][0]
+    for i in range(600):
+        on_message(None, None, Message(f'sensor/{i % 7}', b'%d' % i))
+        if i == 300:
+            time.sleep(0.01)  # so that the timestamps are not all the same
+    state.stop_request = True
+    deadline = time.time() + 10
+    while not state.stop_request_ack and time.time() < deadline:
+        time.sleep(0.05)
+    assert state.stop_request_ack
+    assert state.writer.written_count == 600
+
+    assert [folder.name for folder in shard_folders(stream_path)] == ['shard-0', 'shard-1', 'shard-2']
+    for topic_idx in range(7):
+        shard = stream_path / f'shard-{shard_of(f"sensor/{topic_idx}", 3)}'
+        assert any(shard.rglob('*.sqlite'))
+    rows = list(read_rows(stream_path))
+    assert len(rows) == 600
+    assert [row[0] for row in rows] == sorted(row[0] for row in rows)
+    # per topic, in the order sent
+    for topic_idx in range(7):
+        payloads = [int(payload) for _, topic, payload in rows if topic == f'sensor/{topic_idx}']
+        assert payloads == list(range(topic_idx, 600, 7))
+    # cataloged under the stream, not the shard folder
+    assert len(find_files(tmp_path, 'everything')) == 3
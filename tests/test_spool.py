@@ -0,0 +1,133 @@
+import sqlite3
+import time
+
+
+def test_spool_wraps_around_and_drains(tmp_path):
+    from attic.spool import Spool
+    spool = Spool(tmp_path / 'spool.bin', 1000)
+    received = []
+    for i in range(200):
+        assert spool.append(i, f'sensor/{i % 3}', bytes([i]) * (i % 50))
+        if i % 7 == 6:
+            received += spool.read(1000)
+            spool.mark_drained()
+    received += spool.read(1000)
+    assert received == [(i, f'sensor/{i % 3}', bytes([i]) * (i % 50)) for i in range(200)]
+    assert spool.depth() == 0
+
+
+def test_spool_overflow_policies(tmp_path):
+    from attic.spool import Spool
+    drop_newest = Spool(tmp_path / 'newest.bin', 1000, overflow='drop-newest')
+    drop_oldest = Spool(tmp_path / 'oldest.bin', 1000, overflow='drop-oldest')
+    for i in range(100):
+        drop_newest.append(i, 'a', b'x' * 20)
+        drop_oldest.append(i, 'a', b'x' * 20)
+    kept_newest = [row[0] for row in drop_newest.read(1000)]
+    kept_oldest = [row[0] for row in drop_oldest.read(1000)]
+    assert kept_newest == list(range(len(kept_newest)))
+    assert kept_oldest == list(range(100 - len(kept_oldest), 100))
+    assert drop_newest.performance_report()['spool_dropped'] == 100 - len(kept_newest)
+    assert drop_oldest.performance_report()['spool_dropped'] == 100 - len(kept_oldest)
+    assert drop_newest.performance_report()['spool_fill'] > 0.9
+    # larger than half the spool: never fits
+    assert not drop_oldest.append(100, 'a', b'x' * 600)
+
+
+def test_drop_oldest_keeps_the_records_read_but_not_committed(tmp_path):
+    import threading
+    from attic.spool import Spool
+    spool = Spool(tmp_path / 'spool.bin', 1000, overflow='drop-oldest')
+    for i in range(20):
+        assert spool.append(i, 'a', b'x' * 20)
+    in_flight = spool.read(5)
+    # overflow, while the drainer holds 5 records: it waits for their commit rather than dropping them
+    appended = threading.Thread(target=lambda: [spool.append(i, 'a', b'x' * 20) for i in range(20, 40)])
+    appended.start()
+    appended.join(timeout=0.2)
+    assert appended.is_alive()
+    spool.close()
+    appended.join(timeout=5)
+    # as after a crash: the header still points at the first record read
+    recovered = Spool(tmp_path / 'spool.bin', 1000)
+    assert [row[0] for row in recovered.undrained()][:5] == [row[0] for row in in_flight] == list(range(5))
+
+    spool = Spool(tmp_path / 'committed.bin', 1000, overflow='drop-oldest')
+    for i in range(20):
+        spool.append(i, 'a', b'x' * 20)
+    spool.read(5)
+    appended = threading.Thread(target=lambda: [spool.append(i, 'a', b'x' * 20) for i in range(20, 40)])
+    appended.start()
+    time.sleep(0.05)
+    spool.mark_drained()  # the commit: the waiting append goes on, dropping the oldest records not read yet
+    appended.join(timeout=5)
+    assert not appended.is_alive()
+    kept = [row[0] for row in spool.read(1000)]
+    assert kept == sorted(kept) and kept[-1] == 39 and 5 not in kept
+
+
+def test_undrained_messages_are_replayed_on_start(tmp_path):
+    from attic.spool import Spool, SpoolWriter
+    from attic.state import StreamState
+    from attic.storage import RotationEngine
+    stream_path = tmp_path / 'stream'
+    spool = Spool(stream_path / 'spool.bin', 1 << 16)
+    for i in range(10):
+        spool.append(1_700_000_000_000_000 + i, 'sensor/1', b'%d' % i)
+    spool.read(5)
+    spool.mark_drained()
+    del spool  # as if the process had died here: 5 messages drained, 5 not
+
+    writer = SpoolWriter(StreamState(), RotationEngine(str(stream_path)), spool_path=stream_path / 'spool.bin',
+                         spool_size_bytes=1 << 16)
+    assert writer.replayed_count == 5
+    files = list(stream_path.rglob('*.sqlite'))
+    assert len(files) == 1 and files[0].name.startswith('2023-11-14T22_13_20_000005')
+    with sqlite3.connect(files[0]) as connection:
+        rows = connection.execute('SELECT reception_timestamp, payload FROM data').fetchall()
+    assert rows == [(1_700_000_000_000_000 + i, b'%d' % i) for i in range(5, 10)]
+
+    # replayed once only
+    writer.spool.close()
+    again = SpoolWriter(StreamState(), RotationEngine(str(tmp_path / 'other')), spool_path=stream_path / 'spool.bin',
+                        spool_size_bytes=1 << 16)
+    assert again.replayed_count == 0
+
+
+def test_stop_is_bounded_and_keeps_the_rest_in_the_spool(tmp_path):
+    from attic.spool import SpoolWriter
+    from attic.state import StreamState
+    from attic.storage import RotationEngine
+    stream_state = StreamState()
+    writer = SpoolWriter(stream_state, RotationEngine(str(tmp_path)), spool_path=tmp_path / 'spool.bin',
+                         stop_seconds=0.0, batch_size=10)
+    for i in range(1000):
+        writer.put(i, 'a', b'x')
+    writer.start()
+    stream_state.stop_request = True
+    start = time.time()
+    writer.join(timeout=5)
+    assert stream_state.stop_request_ack and time.time() - start < 2
+    assert writer.written_count < 1000
+
+    later = SpoolWriter(StreamState(), RotationEngine(str(tmp_path)), spool_path=tmp_path / 'spool.bin')
+    assert writer.written_count + later.replayed_count == 1000
+
+
+def test_replayed_file_gets_its_rollups(tmp_path):
+    from attic.rollup import read_rollups, resolve_rollups
+    from attic.spool import Spool, SpoolWriter
+    from attic.state import StreamState
+    from attic.storage import RotationEngine
+    stream_path = tmp_path / 'stream'
+    spool = Spool(stream_path / 'spool.bin', 1 << 16)
+    for i in range(10):
+        spool.append(1_700_000_040_000_000 + i * 1_000_000, 'power', b'%d' % i)
+    del spool  # as if the process had died here
+
+    rotation = RotationEngine(str(stream_path), rollups=resolve_rollups({'fields': [{'topic': 'power'}]},
+                                                                        str(stream_path)))
+    writer = SpoolWriter(StreamState(), rotation, spool_path=stream_path / 'spool.bin', spool_size_bytes=1 << 16)
+    assert writer.replayed_count == 10
+    writer.spool.close()
+    assert read_rollups(stream_path) == [(1_700_000_040_000_000, 'power', 'value', 10, 0.0, 9.0, 4.5)]
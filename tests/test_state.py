@@ -0,0 +1,75 @@
+import sqlite3
+import threading
+import time
+
+
+class Message:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+def test_on_message_updates_the_stream_state(tmp_path):
+    import attic
+    from attic.state import PROCESSING_SAMPLE_PERIOD, StreamState
+    attic.shared_state = {'streams': [None]}
+    on_message = attic.make_on_message_callback(0, '#', str(tmp_path))
+    state = attic.shared_state['streams'][0]
+    assert isinstance(state, StreamState)
+
+    before = time.time()
+    for i in range(100):
+        on_message(None, None, Message(f'sensor/{i % 3}', b'x'))
+    snapshot = state.snapshot()
+    assert snapshot['messageCount'] == 100
+    assert before <= snapshot['lastRxTimestamp_unix'] / 1e6 <= time.time()
+    assert snapshot['lastRxTimestamp_iso_string'].endswith('+00:00')
+    assert snapshot['totalProcessingTime'] > 0
+    # one message in PROCESSING_SAMPLE_PERIOD is timed
+    assert snapshot['metrics'].processing_seconds.count() == -(-100 // PROCESSING_SAMPLE_PERIOD)
+
+    state.stop_request = True
+    on_message(None, None, Message('sensor/0', b'x'))
+    assert state.stop_request_ack
+    files = list(tmp_path.rglob('*.sqlite'))
+    with sqlite3.connect(files[0]) as connection:
+        assert connection.execute('SELECT count(*) FROM data').fetchone()[0] == 100
+
+
+def test_the_hot_path_refreshes_the_clock_offset(tmp_path):
+    import attic
+    from attic.state import PROCESSING_SAMPLE_PERIOD
+    attic.shared_state = {'streams': [None]}
+    on_message = attic.make_on_message_callback(0, '#', str(tmp_path))
+    state = attic.shared_state['streams'][0]
+    # as after a step of the wall clock: a stale offset, an hour off, and no monitor to re-read it
+    state.clock_offset -= 3600
+    for _ in range(PROCESSING_SAMPLE_PERIOD + 1):
+        on_message(None, None, Message('sensor/0', b'x'))
+    assert abs(state.last_rx_timestamp_unix / 1e6 - time.time()) < 60
+    state.stop_request = True
+    on_message(None, None, Message('sensor/0', b'x'))
+
+
+def test_snapshot_is_consistent_while_updating():
+    from attic.state import StreamState
+    state = StreamState()
+    stop = threading.Event()
+
+    def update():
+        # as the closures do: the message count and the timestamp move together
+        while not stop.is_set():
+            state.sequence += 1
+            state.last_rx_timestamp_unix = state.message_count + 1
+            state.message_count += 1
+            state.sequence += 1
+
+    thread = threading.Thread(target=update)
+    thread.start()
+    try:
+        for _ in range(2000):
+            message_count, last_rx_timestamp_unix, _, _ = state.counters()
+            assert message_count == (last_rx_timestamp_unix or 0)
+    finally:
+        stop.set()
+        thread.join()
@@ -0,0 +1,149 @@
+import sqlite3
+
+
+def test_rotation_engine_swaps_prepared_file(tmp_path):
+    from attic.storage import RotationEngine
+    rotation = RotationEngine(str(tmp_path), log_rotation_time=10, prepare_lead_seconds=5)
+    first = rotation.log_file_for(100.0)
+    first.insert(1, 'a', b'1')
+    assert rotation.log_file_for(104.0) is first
+    assert not rotation.prepare_requested
+    # inside the lead time, the next file gets prepared in the background
+    assert rotation.log_file_for(106.0) is first
+    assert rotation.prepare_requested
+    second = rotation.log_file_for(111.0)
+    assert second is not first
+    second.insert(2, 'b', b'2')
+    assert rotation.rotation_count == 2
+    rotation.close()
+
+    files = sorted(tmp_path.rglob('*.sqlite'))
+    assert [f.name for f in files] == sorted([first.path.name, second.path.name])
+    for log_file, expected in ((first, [(1, 'a', b'1')]), (second, [(2, 'b', b'2')])):
+        with sqlite3.connect(log_file.path) as connection:
+            assert connection.execute('SELECT * FROM data').fetchall() == expected
+
+
+def test_rotation_engine_discards_unused_prepared_file(tmp_path):
+    from attic.storage import RotationEngine
+    rotation = RotationEngine(str(tmp_path), log_rotation_time=10, prepare_lead_seconds=20)
+    rotation.log_file_for(100.0).insert(1, 'a', b'1')
+    rotation.log_file_for(101.0)  # requests the next file
+    rotation.close()
+    assert len(list(tmp_path.rglob('*.sqlite'))) == 1
+
+
+def test_rotation_on_row_and_size_limits(tmp_path):
+    from attic.storage import RotationEngine
+    rotation = RotationEngine(str(tmp_path / 'rows'), log_rotation_time=600, max_rows=2500)
+    for i in range(6000):
+        rotation.log_file_for(100.0 + i / 1000).insert(i, 'a', b'x')
+    report = rotation.performance_report()
+    assert report['rotation_rows_count'] == 2 and report['rotation_time_count'] == 1
+    rotation.close()
+    counts = []
+    for path in sorted((tmp_path / 'rows').rglob('*.sqlite')):
+        with sqlite3.connect(path) as connection:
+            counts.append(connection.execute('SELECT count(*) FROM data').fetchone()[0])
+    assert counts == [2500, 2500, 1000]
+
+    rotation = RotationEngine(str(tmp_path / 'bytes'), log_rotation_time=600, max_bytes=1 << 20)
+    for i in range(3000):
+        rotation.log_file_for(100.0 + i / 1000).insert(i, 'a', b'x' * 1000)
+    assert rotation.performance_report()['rotation_bytes_count'] == 2
+    rotation.close()
+
+
+def test_aligned_rotation(tmp_path):
+    from attic.storage import RotationEngine, next_aligned_time
+    assert next_aligned_time(1_700_000_123.5, 300) == 1_700_000_400
+    assert next_aligned_time(1_700_000_400, 300) == 1_700_000_700
+    rotation = RotationEngine(str(tmp_path), log_rotation_time=300, align=True)
+    first = rotation.log_file_for(1_700_000_123.5)
+    assert rotation.next_rotation_time == 1_700_000_400
+    assert rotation.log_file_for(1_700_000_400) is first
+    second = rotation.log_file_for(1_700_000_400.1)
+    assert second is not first and rotation.next_rotation_time == 1_700_000_700
+    # a quiet stream: the next file is not prepared in time, and is named after the start of its period still
+    third = rotation.log_file_for(1_700_001_234.5)
+    assert third is not second and rotation.next_rotation_time == 1_700_001_300
+    rotation.close()
+    # the first file is named after its first row, the others after their boundary
+    assert [log_file.path.name for log_file in (first, second, third)] == [
+        '2023-11-14T22_15_23_500000+00_00.sqlite',
+        '2023-11-14T22_20_00_000000+00_00.sqlite',
+        '2023-11-14T22_30_00_000000+00_00.sqlite',
+    ]
+    assert sorted(path.name for path in tmp_path.rglob('*.sqlite')) == [
+        log_file.path.name for log_file in (first, second, third)]
+
+
+def test_storage_profiles():
+    from attic.storage import resolve_storage_profile
+    import pytest
+    assert resolve_storage_profile('max-throughput')['journal-mode'] == 'WAL'
+    custom = resolve_storage_profile('mine', {'mine': {'synchronous': 'normal'}})
+    assert custom['synchronous'] == 'NORMAL'
+    assert custom['deferred-index'] is False
+    assert custom['name'] == 'mine'
+    with pytest.raises(ValueError):
+        resolve_storage_profile('no-such-profile')
+    with pytest.raises(ValueError):
+        resolve_storage_profile('mine', {'mine': {'page-size': 1000}})
+
+
+def test_deferred_index_is_built_at_seal(tmp_path):
+    from attic.storage import resolve_storage_profile, open_log_file
+    log_file = open_log_file(str(tmp_path), resolve_storage_profile('max-throughput'))
+    log_file.insert_many([(i, f't/{i % 5}', b'p') for i in range(100)])
+
+    def indexes(connection):
+        return [row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL")]
+
+    assert indexes(log_file.connection) == []
+    log_file.seal()
+    assert [p.name for p in log_file.path.parent.iterdir()] == [log_file.path.name]  # no -wal / -shm left
+    with sqlite3.connect(log_file.path) as connection:
+        assert indexes(connection) == ['records_topic_id']
+        assert connection.execute('PRAGMA journal_mode').fetchone()[0] == 'delete'
+        assert connection.execute('PRAGMA page_size').fetchone()[0] == 65536
+        assert connection.execute('SELECT count(*) FROM data').fetchone()[0] == 100
+
+
+def test_schema_version_2_dictionary_encodes_topics(tmp_path):
+    from attic.storage import resolve_storage_profile, open_log_file
+    log_file = open_log_file(str(tmp_path), resolve_storage_profile('v2', {'v2': {'schema-version': 2}}))
+    log_file.insert(1, 'a/b', b'1')
+    log_file.insert_many([(2, 'a/c', b'2'), (3, 'a/b', b'3')])
+    log_file.seal()
+    with sqlite3.connect(log_file.path) as connection:
+        assert connection.execute('PRAGMA user_version').fetchone()[0] == 2
+        assert connection.execute('SELECT id, name FROM topics ORDER BY id').fetchall() == [(1, 'a/b'), (2, 'a/c')]
+        # the compatibility view presents the same columns as schema 1
+        assert connection.execute(
+            'SELECT reception_timestamp, topic, payload FROM data ORDER BY reception_timestamp').fetchall() == \
+               [(1, 'a/b', b'1'), (2, 'a/c', b'2'), (3, 'a/b', b'3')]
+
+
+def test_dedup_stores_repeated_payloads_once(tmp_path):
+    import pytest
+    from attic.reader import read_file
+    from attic.storage import LogFile, resolve_storage_profile
+    profile = resolve_storage_profile('dedup', {'dedup': {'schema-version': 2, 'dedup': True}})
+    rows = [(i, f'sensor/{i % 4}', b'{"status": "online", "firmware": "1.2.3"}' if i % 2 else b'%d' % i)
+            for i in range(2000)]
+    log_file = LogFile(tmp_path / 'dedup.sqlite', profile)
+    log_file.insert_many(rows[:1000])
+    for row in rows[1000:]:
+        log_file.insert(*row)
+    assert log_file.deduplicator.blob_count == 1 and log_file.deduplicator.reference_count == 1000
+    log_file.seal()
+
+    with sqlite3.connect(tmp_path / 'dedup.sqlite') as connection:
+        assert connection.execute('SELECT count(*) FROM blobs').fetchone()[0] == 1
+        # the view still returns the full payloads
+        assert connection.execute('SELECT * FROM data ORDER BY reception_timestamp').fetchall() == rows
+    assert list(read_file(tmp_path / 'dedup.sqlite', topics=['sensor/1'])) == [row for row in rows if row[1] == 'sensor/1']
+
+    with pytest.raises(ValueError):
+        resolve_storage_profile('bad', {'bad': {'dedup': True}})
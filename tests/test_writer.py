@@ -0,0 +1,63 @@
+import sqlite3
+import time
+
+
+def test_batch_writer_flushes_on_stop(tmp_path):
+    from attic.state import StreamState
+    from attic.storage import RotationEngine
+    from attic.writer import BatchWriter
+    stream_state = StreamState()
+    writer = BatchWriter(stream_state, RotationEngine(str(tmp_path)), batch_size=10, batch_seconds=0.05)
+    writer.start()
+    for i in range(25):
+        writer.put(i, f'sensor/{i % 3}', b'x' * i)
+    stream_state.stop_request = True
+    writer.join(timeout=5)
+    assert stream_state.stop_request_ack
+    assert writer.written_count == 25
+
+    files = list(tmp_path.rglob('*.sqlite'))
+    assert len(files) == 1
+    with sqlite3.connect(files[0]) as connection:
+        rows = connection.execute('SELECT reception_timestamp, topic, payload FROM data').fetchall()
+    assert rows == [(i, f'sensor/{i % 3}', b'x' * i) for i in range(25)]
+
+
+def test_batch_writer_commits_on_time(tmp_path):
+    from attic.state import StreamState
+    from attic.storage import RotationEngine
+    from attic.writer import BatchWriter
+    stream_state = StreamState()
+    writer = BatchWriter(stream_state, RotationEngine(str(tmp_path)), batch_size=1000, batch_seconds=0.05)
+    writer.start()
+    writer.put(1, 'a', b'1')
+    time.sleep(0.5)
+    files = list(tmp_path.rglob('*.sqlite'))
+    # the row must be visible from another connection before the batch is full.
+    with sqlite3.connect(files[0]) as connection:
+        assert connection.execute('SELECT count(*) FROM data').fetchone()[0] == 1
+    stream_state.stop_request = True
+    writer.join(timeout=5)
+
+
+def test_batch_writer_rotates_on_the_reception_timestamps(tmp_path):
+    from attic.reader import read_rows
+    from attic.state import StreamState
+    from attic.storage import RotationEngine
+    from attic.writer import BatchWriter
+    # a backlog of rows received a while ago, across two rotations, all written in one batch
+    start = 1_700_000_000_000_000
+    rows = [(start + i * 300_000, f'sensor/{i % 3}', b'%d' % i) for i in range(10)]
+    stream_state = StreamState()
+    writer = BatchWriter(stream_state, RotationEngine(str(tmp_path), log_rotation_time=1, prepare_lead_seconds=0.5),
+                         batch_size=100, batch_seconds=0.05)
+    for row in rows:
+        writer.put(*row)
+    writer.start()
+    stream_state.stop_request = True
+    writer.join(timeout=5)
+    assert stream_state.stop_request_ack
+
+    assert len(list(tmp_path.rglob('*.sqlite'))) == 3
+    assert list(read_rows(tmp_path, start, start + 3_000_000)) == rows
+    assert list(read_rows(tmp_path, start + 1_500_000, start + 2_100_000)) == rows[5:7]